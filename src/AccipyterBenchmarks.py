@@ -0,0 +1,1006 @@
+"""
+Micro benchmarks for the performance sensitive parts of Accipyter.
+
+Usage: python AccipyterBenchmarks.py [benchmark ...]
+
+Runs every benchmark when none are named.
+"""
+import sys
+import os
+import errno
+import time
+import socket
+import struct
+import hashlib
+import multiprocessing
+import threading
+import random
+import shutil
+import tempfile
+import resource
+import BaseHTTPServer
+from io import BytesIO
+from collections import OrderedDict
+
+import PeerConnection
+import PeerEngine
+import PieceHasher
+import Storage
+import ReadCache
+import Recheck
+import TorrentReader
+import PiecePicker
+import PieceTable
+import PeerStore
+import Bitfield
+import RateLimiter
+import Torrent
+import Tracker
+import Session
+
+BENCHMARKS = OrderedDict()
+# Socket errors that only mean the other end has gone, which a benchmark peer takes as the end of its connection
+CONNECTION_CLOSED_ERRORS = (errno.EBADF, errno.EPIPE, errno.ECONNRESET)
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__.replace('benchmark_', '')] = func
+    return func
+
+
+def cpu_time():
+    process_times = os.times()
+    return process_times[0] + process_times[1]
+
+
+def report(name, **values):
+    print '{:<24} {}'.format(name, '  '.join('{}={}'.format(key, values[key]) for key in sorted(values)))
+
+
+class BenchmarkTorrent(object):
+    # Just enough of a Torrent for a PeerConnection to run against
+    def __init__(self, num_pieces, piece_length):
+        self.info_hash = '00' * 20
+        self.info_hash_bytes = '\0' * 20
+        self.peer_id = '-AC0000-benchmark000'
+        self.num_pieces = num_pieces
+        self.piece_length = piece_length
+        self.completed_pieces = Bitfield.Bitfield(num_pieces)
+        self.peer_download_limit = self.peer_upload_limit = RateLimiter.UNLIMITED
+        self.download_buckets = self.upload_buckets = ()
+
+    def get_piece_length(self, piece_index):
+        return self.piece_length
+
+    def register_bitfield(self, peer, bitfield_bytes):
+        peer.bitfield.load(bitfield_bytes)
+
+    def register_have(self, peer, piece_index):
+        peer.bitfield.set(piece_index)
+
+    def get_next_piece(self, peer):
+        peer.assigned_piece = None
+        return True
+
+    def connection_closed(self, peer):
+        pass
+
+    def connection_established(self, peer):
+        pass
+
+    def peer_interested(self, peer):
+        pass
+
+    def block_downloaded(self, block_length):
+        pass
+
+
+class ReceiveBenchmarkPeer(PeerConnection.PeerConnection):
+    # Runs the real receive path on an accepted socket and copies each block into a destination piece buffer
+    def __init__(self, connection, torrent, read_size):
+        self.connection = connection
+        self.destination = bytearray(torrent.piece_length)
+        self.bytes_received = 0
+        self.benchmark_read_size = read_size
+        PeerConnection.PeerConnection.__init__(self, '127.0.0.1', 0, torrent)
+
+    def run(self):
+        self.read_size = self.benchmark_read_size
+        self.socket = self.connection
+        self.socket.setblocking(0)
+        self.socket_read_loop()
+
+    def handle_piece_message(self, message):
+        block = message['block']
+        self.destination[message['begin']:message['begin'] + len(block)] = block
+        self.bytes_received += len(block)
+
+
+def send_piece_stream(port, total_bytes, block_length):
+    sender = socket.create_connection(('127.0.0.1', port))
+    sender.sendall('\x13BitTorrent protocol' + '\0' * 48)
+    block = os.urandom(block_length)
+    blocks_per_piece = 16
+    frames = ''.join(struct.pack('>IBII', 9 + block_length, PeerConnection.PIECE, 0, block_number * block_length) +
+                     block for block_number in range(blocks_per_piece))
+    try:
+        for _ in range(total_bytes / len(frames)):
+            sender.sendall(frames)
+        # Drain whatever the receiver sent so closing does not reset the connection before it has read everything
+        sender.shutdown(socket.SHUT_WR)
+        while sender.recv(4096):
+            pass
+    except socket.error:
+        # The receiver hung up first
+        pass
+    sender.close()
+
+
+@benchmark
+def benchmark_receive(total_bytes=256 * 2**20, block_length=PeerConnection.MAX_BLOCK_LENGTH):
+    # Loopback PIECE stream through socket_read_loop/extract_messages for a range of read sizes
+    for read_size in [2**12, 2**14, 2**16, 2**18]:
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        sender = multiprocessing.Process(target=send_piece_stream,
+                                         args=(listener.getsockname()[1], total_bytes, block_length))
+        sender.start()
+        connection, _ = listener.accept()
+        listener.close()
+
+        start_time = time.time()
+        start_cpu = cpu_time()
+        peer = ReceiveBenchmarkPeer(connection, BenchmarkTorrent(1, 16 * block_length), read_size)
+        peer.join()
+        elapsed = time.time() - start_time
+        cpu_elapsed = cpu_time() - start_cpu
+        sender.join()
+
+        megabytes = peer.bytes_received / float(2**20)
+        report('receive', read_size=read_size, mb=int(megabytes),
+               mb_per_sec='{:.1f}'.format(megabytes / elapsed),
+               mb_per_cpu_sec='{:.1f}'.format(megabytes / cpu_elapsed))
+
+
+@benchmark
+def benchmark_rate_limit(limit=8 * 2**20, num_peers=4, seconds=5, block_length=PeerConnection.MAX_BLOCK_LENGTH):
+    # Loopback PIECE streams from several peers drawing on one download limit: how closely the limit is held, how
+    # evenly it is shared and what the throttling costs in CPU. The first second, spent on the initial burst, is not
+    # counted.
+    bucket = RateLimiter.TokenBucket(limit)
+    torrent = BenchmarkTorrent(1, 16 * block_length)
+    torrent.download_buckets = (bucket,)
+    peers = []
+    senders = []
+    for _ in range(num_peers):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        sender = multiprocessing.Process(target=send_piece_stream,
+                                         args=(listener.getsockname()[1], limit * (seconds + 2), block_length))
+        sender.start()
+        senders.append(sender)
+        connection, _ = listener.accept()
+        listener.close()
+        peer = ReceiveBenchmarkPeer(connection, torrent, PeerConnection.READ_SIZE)
+        peer.debug_level = 0
+        peers.append(peer)
+
+    time.sleep(1)
+    start_time = time.time()
+    start_cpu = cpu_time()
+    start_bytes = [peer.bytes_received for peer in peers]
+    time.sleep(seconds)
+    elapsed = time.time() - start_time
+    cpu_elapsed = cpu_time() - start_cpu
+    shares = [peer.bytes_received - start for peer, start in zip(peers, start_bytes)]
+    for peer in peers:
+        peer.kill()
+    for sender in senders:
+        sender.join()
+
+    report('rate_limit', limit_mb='{:.1f}'.format(limit / float(2**20)), peers=num_peers,
+           mb_per_sec='{:.2f}'.format(sum(shares) / elapsed / 2**20),
+           share_spread='{:.2f}'.format(min(shares) / float(max(max(shares), 1))),
+           cpu_per_sec='{:.2f}'.format(cpu_elapsed / elapsed))
+
+
+def serve_idle_swarm(port_queue, num_pieces):
+    # Accept any number of connections, send each a handshake, an empty bitfield and no UNCHOKE, then stay silent
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1024)
+    listener.setblocking(0)
+    port_queue.put(listener.getsockname()[1])
+
+    bitfield_length = (num_pieces + 7) / 8
+    greeting = ('\x13BitTorrent protocol' + '\0' * 28 + '-AC0000-idle-swarm00' +
+                struct.pack('>IB', 1 + bitfield_length, PeerConnection.BITFIELD) + '\0' * bitfield_length)
+    poller = PeerEngine.Poller()
+    poller.register(listener.fileno(), PeerEngine.READ)
+    connections = {}
+    while True:
+        for fd, events in poller.poll(None):
+            if fd == listener.fileno():
+                try:
+                    connection, _ = listener.accept()
+                except socket.error:
+                    continue
+                connection.sendall(greeting)
+                connection.setblocking(0)
+                connections[connection.fileno()] = connection
+                poller.register(connection.fileno(), PeerEngine.READ)
+            else:
+                try:
+                    data = connections[fd].recv(4096)
+                except socket.error:
+                    data = ''
+                if not data:
+                    poller.unregister(fd)
+                    connections.pop(fd).close()
+
+
+@benchmark
+def benchmark_engines(peer_counts=(15, 100, 1000), threaded_peer_limit=100, idle_seconds=3):
+    # Connect to an idle local swarm with each peer engine and measure connect time, thread count and idle CPU
+    PeerConnection.DEBUG_LEVEL = 0
+    for engine in ['threaded', 'event']:
+        for num_peers in peer_counts:
+            if engine == 'threaded' and num_peers > threaded_peer_limit:
+                report('engines', engine=engine, peers=num_peers, skipped='thread per connection')
+                continue
+
+            port_queue = multiprocessing.Queue()
+            swarm = multiprocessing.Process(target=serve_idle_swarm, args=(port_queue, 64))
+            swarm.start()
+            port = port_queue.get()
+
+            torrent = BenchmarkTorrent(64, 2**18)
+            peer_engine = None
+            if engine == 'event':
+                peer_engine = PeerEngine.PeerEngine()
+                peer_engine.start()
+
+            start_time = time.time()
+            if peer_engine is not None:
+                peers = [PeerEngine.EventPeerConnection('127.0.0.1', port, torrent, peer_engine)
+                         for _ in range(num_peers)]
+            else:
+                peers = [PeerConnection.PeerConnection('127.0.0.1', port, torrent) for _ in range(num_peers)]
+            while time.time() - start_time < 60:
+                if all(peer.peer_id is not None or not peer.alive for peer in peers):
+                    break
+                time.sleep(0.01)
+            connect_time = time.time() - start_time
+
+            start_cpu = cpu_time()
+            time.sleep(idle_seconds)
+            idle_cpu = (cpu_time() - start_cpu) / idle_seconds * 100
+            connected = len([peer for peer in peers if peer.alive and peer.peer_id is not None])
+            threads = threading.active_count()
+
+            for peer in peers:
+                peer.kill()
+            if peer_engine is not None:
+                peer_engine.stop()
+            swarm.terminate()
+            swarm.join()
+
+            report('engines', engine=engine, peers=num_peers, connected=connected, threads=threads,
+                   connect_sec='{:.2f}'.format(connect_time), idle_cpu_percent='{:.1f}'.format(idle_cpu))
+            time.sleep(1)
+
+
+def read_exactly(connection, length):
+    data = ''
+    while len(data) < length:
+        chunk = connection.recv(length - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+def serve_seed_connection(connection, source_data, piece_length, info_hash_bytes, rate):
+    # Handshake, a full bitfield and UNCHOKE, then answer REQUESTs in order at rate bytes per second. A CANCEL
+    # withdraws a request that has not been sent yet. Returns quietly once the downloader hangs up.
+    num_pieces = (len(source_data) + piece_length - 1) / piece_length
+    bitfield = bytearray((num_pieces + 7) / 8)
+    for piece_index in range(num_pieces):
+        bitfield[piece_index / 8] |= 0x80 >> (piece_index % 8)
+    condition = threading.Condition()
+    # None tells the sender the connection is closed
+    requests = []
+
+    def send_blocks():
+        try:
+            while True:
+                with condition:
+                    while not requests:
+                        condition.wait()
+                    if requests[0] is None:
+                        return
+                    piece_index, begin, length = requests.pop(0)
+                offset = piece_index * piece_length + begin
+                connection.sendall(struct.pack('>IBII', 9 + length, PeerConnection.PIECE, piece_index, begin) +
+                                   source_data[offset:offset + length])
+                time.sleep(length / float(rate))
+        except socket.error as e:
+            if e.errno not in CONNECTION_CLOSED_ERRORS:
+                raise
+
+    try:
+        read_exactly(connection, 68)
+        connection.sendall('\x13BitTorrent protocol' + '\0' * 8 + info_hash_bytes + '-AC0000-swarm-seed00' +
+                           struct.pack('>IB', 1 + len(bitfield), PeerConnection.BITFIELD) + str(bitfield) +
+                           struct.pack('>IB', 1, PeerConnection.UNCHOKE))
+        sender = threading.Thread(target=send_blocks)
+        sender.daemon = True
+        sender.start()
+        while True:
+            length = struct.unpack('>I', read_exactly(connection, 4))[0]
+            if not length:
+                continue
+            message = read_exactly(connection, length)
+            message_id = ord(message[0])
+            if message_id in (PeerConnection.REQUEST, PeerConnection.CANCEL):
+                request = struct.unpack('>III', message[1:13])
+                with condition:
+                    if message_id == PeerConnection.REQUEST:
+                        requests.append(request)
+                        condition.notify()
+                    elif request in requests:
+                        requests.remove(request)
+    except EOFError:
+        pass
+    except socket.error as e:
+        if e.errno not in CONNECTION_CLOSED_ERRORS:
+            raise
+    finally:
+        with condition:
+            requests[:] = [None]
+            condition.notify()
+        connection.close()
+
+
+def serve_seed(port_queue, source_path, piece_length, info_hash_bytes, rate):
+    with open(source_path, 'rb') as source_file:
+        source_data = source_file.read()
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+    port_queue.put(listener.getsockname()[1])
+    while True:
+        connection, _ = listener.accept()
+        thread = threading.Thread(target=serve_seed_connection,
+                                  args=(connection, source_data, piece_length, info_hash_bytes, rate))
+        thread.daemon = True
+        thread.start()
+
+
+def run_swarm_download(torrent_path, download_directory, seed_ports, engine, endgame_peers, result_queue):
+    # Download from the local seeds and return the seconds until 90% of the pieces and every piece were written
+    Torrent.DEBUG = False
+    Tracker.DEBUG = False
+    PeerConnection.DEBUG_LEVEL = 0
+    Torrent.ENDGAME_PEERS_PER_PIECE = endgame_peers
+    # write_piece prints its progress unconditionally
+    sys.stdout = open(os.devnull, 'w')
+    torrent = Torrent.Torrent(torrent_path, download_directory, engine=engine)
+    torrent.update_available_peers([('127.0.0.1', port) for port in seed_ports])
+    start_time = time.time()
+    torrent.start()
+    ninety_percent_time = None
+    while not torrent.complete and time.time() - start_time < 120:
+        if ninety_percent_time is None and torrent.completed_pieces.count >= 0.9 * torrent.num_pieces:
+            ninety_percent_time = time.time() - start_time
+        time.sleep(0.01)
+    total_time = time.time() - start_time
+    torrent.stop()
+    result_queue.put((torrent.complete, ninety_percent_time or total_time, total_time))
+
+
+@benchmark
+def benchmark_swarm(total_bytes=2**24, piece_length=2**20, slow_rate=2**15, fast_rate=2**22, num_fast_seeds=3):
+    # A local swarm of one slow seed and several fast ones, with and without endgame. The tail is the time from 90% of
+    # the pieces written to the last one, which without endgame waits on whatever the slow seed still holds.
+    source_directory = tempfile.mkdtemp(prefix='accipyter-swarm-')
+    seeds = []
+    try:
+        source_path = os.path.join(source_directory, 'source')
+        with open(source_path, 'wb') as f:
+            f.write(os.urandom(total_bytes))
+        torrent_path = source_path + '.torrent'
+        # Nothing listens on port 1, the peers come from the seeds instead
+        info_hash = TorrentReader.create_torrent(source_path, torrent_path, announce='http://127.0.0.1:1/announce',
+                                                 piece_length=piece_length)
+        seed_ports = []
+        for rate in [slow_rate] + [fast_rate] * num_fast_seeds:
+            port_queue = multiprocessing.Queue()
+            seed = multiprocessing.Process(target=serve_seed, args=(port_queue, source_path, piece_length,
+                                                                    info_hash.decode('hex'), rate))
+            seed.start()
+            seeds.append(seed)
+            seed_ports.append(port_queue.get())
+
+        for engine in [Torrent.THREADED_ENGINE, Torrent.EVENT_ENGINE]:
+            for endgame_peers in [0, Torrent.ENDGAME_PEERS_PER_PIECE]:
+                download_directory = tempfile.mkdtemp(prefix='accipyter-swarm-download-')
+                result_queue = multiprocessing.Queue()
+                runner = multiprocessing.Process(target=run_swarm_download,
+                                                 args=(torrent_path, download_directory, seed_ports, engine,
+                                                       endgame_peers, result_queue))
+                runner.start()
+                complete, ninety_percent_time, total_time = result_queue.get()
+                runner.join()
+                with open(os.path.join(download_directory, os.path.basename(source_path)), 'rb') as f:
+                    with open(source_path, 'rb') as source_file:
+                        ok = complete and f.read() == source_file.read()
+                shutil.rmtree(download_directory)
+                report('swarm', engine=engine, endgame='on' if endgame_peers else 'off', ok=ok,
+                       total_sec='{:.2f}'.format(total_time),
+                       tail_sec='{:.2f}'.format(total_time - ninety_percent_time))
+    finally:
+        for seed in seeds:
+            seed.terminate()
+            seed.join()
+        shutil.rmtree(source_directory)
+
+
+@benchmark
+def benchmark_hashing(total_bytes=256 * 2**20, piece_length=2**20):
+    # Verified MB/s through the hash pool as the number of hashing threads grows
+    piece = os.urandom(piece_length)
+    num_pieces = total_bytes / piece_length
+    thread_counts = sorted(set([1, 2, 4, multiprocessing.cpu_count(), 2 * multiprocessing.cpu_count()]))
+    for num_threads in thread_counts:
+        pool = PieceHasher.HashPool(num_threads)
+        finished = threading.Event()
+        verified_lock = threading.Lock()
+        verified = [0]
+        expected_hash = hashlib.sha1(piece).digest()
+
+        def hashed(piece_hash):
+            with verified_lock:
+                if piece_hash == expected_hash:
+                    verified[0] += 1
+                if verified[0] == num_pieces:
+                    finished.set()
+
+        start_time = time.time()
+        for _ in range(num_pieces):
+            pool.submit(hashlib.sha1(), [memoryview(piece)], hashed)
+        finished.wait()
+        elapsed = time.time() - start_time
+        pool.stop()
+
+        report('hashing', threads=num_threads, cores=multiprocessing.cpu_count(),
+               mb_per_sec='{:.1f}'.format(total_bytes / float(2**20) / elapsed))
+
+
+def scan_write(download_directory, files, offset, data):
+    # Per piece linear scan over every file with an open/seek/write/close for each file touched
+    end = offset + len(data)
+    for dl_file in files:
+        file_start = dl_file['byte_position']
+        file_end = file_start + dl_file['length']
+        if file_start < end and offset < file_end:
+            with open(os.path.join(download_directory, dl_file['path']), 'rb+') as f:
+                f.seek(max(0, offset - file_start))
+                f.write(data[max(0, file_start - offset):min(len(data), file_end - offset)])
+
+
+@benchmark
+def benchmark_storage(num_files=50000, mean_file_length=2**12, piece_length=2**18):
+    # Random order piece writes into a synthetic many file torrent, scan and reopen versus bisect and cached handles
+    download_directory = tempfile.mkdtemp(prefix='accipyter-storage-')
+    try:
+        files = []
+        byte_position = 0
+        for file_index in range(num_files):
+            length = random.randint(0, 2 * mean_file_length)
+            files.append({'path': os.path.join(str(file_index % 100), str(file_index)), 'length': length,
+                          'byte_position': byte_position})
+            byte_position += length
+        for directory in range(100):
+            os.makedirs(os.path.join(download_directory, str(directory)))
+        for dl_file in files:
+            with open(os.path.join(download_directory, dl_file['path']), 'wb') as f:
+                f.truncate(dl_file['length'])
+
+        num_pieces = (byte_position + piece_length - 1) / piece_length
+        piece_order = range(num_pieces)
+        random.shuffle(piece_order)
+        piece = memoryview(bytearray(os.urandom(piece_length)))
+
+        storage = Storage.Storage(download_directory, files)
+        storage.allocate(Storage.ALLOCATE_SKIP)
+        writers = [('scan', lambda offset, data: scan_write(download_directory, files, offset, data)),
+                   ('storage', storage.write)]
+        for name, write in writers:
+            start_time = time.time()
+            for piece_index in piece_order:
+                offset = piece_index * piece_length
+                write(offset, piece[:min(piece_length, byte_position - offset)])
+            elapsed = time.time() - start_time
+            report('storage', writer=name, files=num_files, pieces=num_pieces,
+                   pieces_per_sec='{:.1f}'.format(num_pieces / elapsed))
+        storage.close()
+    finally:
+        shutil.rmtree(download_directory)
+
+
+@benchmark
+def benchmark_recheck(total_bytes=2**30, num_files=7, piece_length=2**20):
+    # Recheck MB/s over a synthetic dataset whose file boundaries fall inside pieces, warm page cache
+    download_directory = tempfile.mkdtemp(prefix='accipyter-recheck-')
+    try:
+        block = os.urandom(piece_length)
+        files = []
+        byte_position = 0
+        for file_index in range(num_files):
+            length = total_bytes / num_files
+            files.append({'path': str(file_index), 'length': length, 'byte_position': byte_position})
+            with open(os.path.join(download_directory, str(file_index)), 'wb') as f:
+                for _ in range(length / piece_length):
+                    f.write(block)
+                f.write(block[:length % piece_length])
+            byte_position += length
+
+        # Expected hashes come from a plain sequential read of the files, which doubles as the baseline
+        start_time = time.time()
+        piece_hashes = []
+        piece_data = ''
+        for dl_file in files:
+            with open(os.path.join(download_directory, dl_file['path']), 'rb') as f:
+                while True:
+                    data = f.read(piece_length - len(piece_data))
+                    if not data:
+                        break
+                    piece_data += data
+                    if len(piece_data) == piece_length:
+                        piece_hashes.append(hashlib.sha1(piece_data).digest())
+                        piece_data = ''
+        if piece_data:
+            piece_hashes.append(hashlib.sha1(piece_data).digest())
+        piece_hashes = ''.join(piece_hashes)
+        report('recheck', reader='sequential', files=num_files,
+               mb_per_sec='{:.1f}'.format(byte_position / float(2**20) / (time.time() - start_time)))
+
+        storage = Storage.Storage(download_directory, files)
+
+        thread_counts = sorted(set([1, multiprocessing.cpu_count()]))
+        for num_threads in thread_counts:
+            verified = []
+            recheck = Recheck.Recheck(storage, piece_hashes, piece_length, byte_position, verified.append,
+                                      num_threads=num_threads)
+            start_time = time.time()
+            recheck.start()
+            recheck.join()
+            elapsed = time.time() - start_time
+            report('recheck', reader='mmap', threads=num_threads, cores=multiprocessing.cpu_count(), files=num_files,
+                   verified=len(verified), mb_per_sec='{:.1f}'.format(byte_position / float(2**20) / elapsed))
+    finally:
+        shutil.rmtree(download_directory)
+
+
+@benchmark
+def benchmark_decode(num_files=100000, piece_length=2**18):
+    # Time to load a large multi file .torrent from disk, including hashing the info dictionary
+    files = [{'length': 1000 + file_index,
+              'path': ['directory{}'.format(file_index % 1000), 'file{}.bin'.format(file_index)]}
+             for file_index in range(num_files)]
+    total_size = sum(dl_file['length'] for dl_file in files)
+    info = {'name': 'benchmark', 'piece length': piece_length, 'files': files,
+            'pieces': os.urandom(20 * ((total_size + piece_length - 1) / piece_length))}
+    torrent_data = TorrentReader.encode({'announce': 'http://127.0.0.1/announce', 'info': info})
+
+    torrent_file = tempfile.NamedTemporaryFile(suffix='.torrent', delete=False)
+    try:
+        torrent_file.write(torrent_data)
+        torrent_file.close()
+        start_time = time.time()
+        document, info_hash = TorrentReader.read_torrent(torrent_file.name)
+        elapsed = time.time() - start_time
+    finally:
+        os.remove(torrent_file.name)
+
+    report('decode', files=len(document[0]['info']['files']), mb='{:.1f}'.format(len(torrent_data) / float(2**20)),
+           ms='{:.0f}'.format(elapsed * 1000), hash_ok=info_hash == hashlib.sha1(TorrentReader.encode(info)).hexdigest())
+
+
+class ObjectPiece(object):
+    # Shape of the one object per piece layout PieceTable replaced
+    def __init__(self, index, sha1_hash):
+        self.index = index
+        self.owners = set()
+        self.sha1_hash = sha1_hash
+        self.assigned_peers = set()
+        self.bytes = BytesIO()
+        self.status = PieceTable.Piece.NOT_FOUND
+
+
+def build_piece_map(layout, piece_hashes, result_queue):
+    # Runs in a fresh process so max RSS reflects only this layout
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = time.time()
+    if layout == 'objects':
+        hash_list = [piece_hashes[offset:offset + 20] for offset in range(0, len(piece_hashes), 20)]
+        piece_map = [ObjectPiece(piece_index, hash_list[piece_index]) for piece_index in range(len(hash_list))]
+    else:
+        piece_map = PieceTable.PieceTable(piece_hashes, PiecePicker.PiecePicker(len(piece_hashes) / 20).availability)
+    elapsed = time.time() - start_time
+    result_queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss, len(piece_map)))
+
+
+@benchmark
+def benchmark_piece_table(num_pieces=10**6):
+    # Construction time and memory of the piece map, the table figure includes the PiecePicker it shares counts with
+    piece_hashes = os.urandom(20 * num_pieces)
+    for layout in ['objects', 'table']:
+        result_queue = multiprocessing.Queue()
+        builder = multiprocessing.Process(target=build_piece_map, args=(layout, piece_hashes, result_queue))
+        builder.start()
+        elapsed, rss_kb, pieces = result_queue.get()
+        builder.join()
+        report('piece_table', layout=layout, pieces=pieces, ms='{:.0f}'.format(elapsed * 1000),
+               mb='{:.0f}'.format(rss_kb / 1024.0))
+
+
+@benchmark
+def benchmark_create(total_bytes=2**29, num_files=9, piece_length=2**20):
+    # create_torrent MB/s over a directory whose file boundaries fall inside pieces, warm page cache
+    source_directory = tempfile.mkdtemp(prefix='accipyter-create-')
+    try:
+        block = os.urandom(2**20)
+        for file_index in range(num_files):
+            with open(os.path.join(source_directory, str(file_index)), 'wb') as f:
+                length = total_bytes / num_files
+                for _ in range(length / len(block)):
+                    f.write(block)
+                f.write(block[:length % len(block)])
+
+        torrent_path = source_directory + '.torrent'
+        for num_threads in sorted(set([1, multiprocessing.cpu_count()])):
+            start_time = time.time()
+            info_hash = TorrentReader.create_torrent(source_directory, torrent_path, piece_length=piece_length,
+                                                     num_threads=num_threads)
+            elapsed = time.time() - start_time
+            report('create', threads=num_threads, cores=multiprocessing.cpu_count(), files=num_files,
+                   round_trip=TorrentReader.read_torrent(torrent_path)[1] == info_hash,
+                   mb_per_sec='{:.1f}'.format(total_bytes / float(2**20) / elapsed))
+        os.remove(torrent_path)
+    finally:
+        shutil.rmtree(source_directory)
+
+
+@benchmark
+def benchmark_peer_store(num_peers=10000):
+    # Decode and merge compact tracker peer lists, first as new peers and then as repeats
+    compact = ''.join(os.urandom(4) + struct.pack('>H', 6881 + peer_index % 4) for peer_index in range(num_peers))
+    compact6 = os.urandom(18 * num_peers)
+    store = PeerStore.PeerStore()
+    for name, add, data in [('ipv4', store.add_compact, compact), ('ipv4_repeat', store.add_compact, compact),
+                            ('ipv6', store.add_compact6, compact6)]:
+        start_time = time.time()
+        new_peers = add(data, 'benchmark')
+        elapsed = time.time() - start_time
+        report('peer_store', batch=name, peers=num_peers, new=new_peers,
+               us_per_peer='{:.2f}'.format(elapsed * 1e6 / num_peers))
+
+
+@benchmark
+def benchmark_upload(total_bytes=2**28, piece_length=2**20, num_peers=8, blocks_served=2**15):
+    # Serve interleaved block REQUESTs from peers each working through random pieces, reading every block from
+    # storage versus through read caches of a few sizes. Warm page cache.
+    download_directory = tempfile.mkdtemp(prefix='accipyter-upload-')
+    try:
+        files = [{'path': 'data', 'length': total_bytes, 'byte_position': 0}]
+        with open(os.path.join(download_directory, 'data'), 'wb') as f:
+            for _ in range(total_bytes / 2**24):
+                f.write(os.urandom(2**24))
+        storage = Storage.Storage(download_directory, files)
+        storage.allocate(Storage.ALLOCATE_SKIP)
+
+        num_pieces = total_bytes / piece_length
+        blocks_per_piece = piece_length / PeerConnection.MAX_BLOCK_LENGTH
+        random.seed(1)
+        peer_pieces = [random.sample(range(num_pieces), num_pieces) for _ in range(num_peers)]
+        requests = []
+        for block_number in range(blocks_served / num_peers):
+            piece_number, block_index = divmod(block_number, blocks_per_piece)
+            for pieces in peer_pieces:
+                requests.append((pieces[piece_number % num_pieces], block_index * PeerConnection.MAX_BLOCK_LENGTH))
+
+        def direct_read(piece_index, block_begin, block_length):
+            return storage.read(piece_index * piece_length + block_begin, block_length)
+
+        readers = [('direct', direct_read, None)]
+        for capacity in [2**23, 2**26]:
+            cache = ReadCache.ReadCache(storage, piece_length, total_bytes, capacity)
+            readers.append(('cache_{}mb'.format(capacity / 2**20), cache.read_block, cache))
+        for name, read_block, cache in readers:
+            start_time = time.time()
+            for piece_index, block_begin in requests:
+                read_block(piece_index, block_begin, PeerConnection.MAX_BLOCK_LENGTH)
+            elapsed = time.time() - start_time
+            values = {'peers': num_peers, 'mb_per_sec': '{:.1f}'.format(
+                len(requests) * PeerConnection.MAX_BLOCK_LENGTH / float(2**20) / elapsed)}
+            if cache is not None:
+                values['hit_rate'] = '{:.3f}'.format(cache.hit_rate())
+                values['disk_mb'] = cache.bytes_read / 2**20
+            report('upload', reader=name, **values)
+        storage.close()
+    finally:
+        shutil.rmtree(download_directory)
+
+
+class IdleTrackerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Answers every announce with no peers and a long interval
+    def do_GET(self):
+        body = 'd8:intervali1800e5:peers0:e'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_idle_tracker(port_queue):
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), IdleTrackerHandler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def run_idle_torrents(torrent_paths, download_directory, use_session, idle_seconds, result_queue):
+    # Start every torrent, standalone or in one Session with a slot for each, and measure once they have announced
+    Torrent.DEBUG = False
+    Session.DEBUG = False
+    if use_session:
+        session = Session.Session(port=0, max_active=len(torrent_paths))
+        for torrent_path in torrent_paths:
+            session.add_torrent(torrent_path, download_directory)
+        session.start()
+    else:
+        for torrent_path in torrent_paths:
+            Torrent.Torrent(torrent_path, download_directory).start()
+    time.sleep(1)
+    start_cpu = cpu_time()
+    time.sleep(idle_seconds)
+    result_queue.put((threading.active_count(), (cpu_time() - start_cpu) / idle_seconds * 100))
+
+
+@benchmark
+def benchmark_session(torrent_counts=(1, 50, 200), idle_seconds=3):
+    # Threads and idle CPU as the number of torrents grows, each torrent starting its own workers against all of them
+    # sharing a Session. Every torrent has announced to a local tracker that returned no peers.
+    port_queue = multiprocessing.Queue()
+    tracker = multiprocessing.Process(target=serve_idle_tracker, args=(port_queue,))
+    tracker.start()
+    announce = 'http://127.0.0.1:{}/announce'.format(port_queue.get())
+    source_directory = tempfile.mkdtemp(prefix='accipyter-session-')
+    try:
+        torrent_paths = []
+        for torrent_index in range(max(torrent_counts)):
+            source_path = os.path.join(source_directory, 'source-{}'.format(torrent_index))
+            with open(source_path, 'wb') as f:
+                f.write(os.urandom(2**14))
+            torrent_paths.append(source_path + '.torrent')
+            TorrentReader.create_torrent(source_path, torrent_paths[-1], announce=announce, piece_length=2**14,
+                                         num_threads=1)
+
+        for use_session in [False, True]:
+            for num_torrents in torrent_counts:
+                download_directory = tempfile.mkdtemp(prefix='accipyter-session-download-')
+                result_queue = multiprocessing.Queue()
+                runner = multiprocessing.Process(target=run_idle_torrents,
+                                                 args=(torrent_paths[:num_torrents], download_directory, use_session,
+                                                       idle_seconds, result_queue))
+                runner.start()
+                threads, idle_cpu = result_queue.get()
+                # Quicker than stopping hundreds of torrents one at a time
+                runner.terminate()
+                runner.join()
+                shutil.rmtree(download_directory)
+                report('session', mode='session' if use_session else 'standalone', torrents=num_torrents,
+                       threads=threads, idle_cpu_percent='{:.1f}'.format(idle_cpu))
+    finally:
+        tracker.terminate()
+        tracker.join()
+        shutil.rmtree(source_directory)
+
+
+class UDPTrackerStandIn(object):
+    # Just enough of a BEP 15 tracker to put UDPTracker through its paces. Drops the first drop_packets requests, sends
+    # a datagram for another transaction and a truncated one ahead of every answer when stray_datagrams is set, and
+    # answers with error instead when it is given. Every request is recorded as (action, event or hash count).
+    def __init__(self, drop_packets=0, stray_datagrams=False, error=None):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.url = 'udp://127.0.0.1:{}/announce'.format(self.socket.getsockname()[1])
+        self.drop_packets = drop_packets
+        self.stray_datagrams = stray_datagrams
+        self.error = error
+        self.connection_id = random.getrandbits(64)
+        self.requests = []
+        server = threading.Thread(target=self.serve)
+        server.daemon = True
+        server.start()
+
+    def serve(self):
+        while True:
+            packet, address = self.socket.recvfrom(Tracker.UDP_PACKET_SIZE)
+            connection_id, action, transaction_id = Tracker.UDP_HEADER.unpack_from(packet)
+            if action == Tracker.UDP_ANNOUNCE:
+                self.requests.append((action, Tracker.UDP_ANNOUNCE_REQUEST.unpack_from(packet)[8]))
+            else:
+                self.requests.append((action, (len(packet) - Tracker.UDP_HEADER.size) / 20))
+            if self.drop_packets:
+                self.drop_packets -= 1
+                continue
+            if self.stray_datagrams:
+                self.socket.sendto(Tracker.UDP_RESPONSE_HEADER.pack(action, transaction_id ^ 1) + '\0' * 16, address)
+                self.socket.sendto('\0' * 4, address)
+            if self.error is not None:
+                self.socket.sendto(Tracker.UDP_RESPONSE_HEADER.pack(Tracker.UDP_ERROR, transaction_id) + self.error,
+                                   address)
+            elif action == Tracker.UDP_CONNECT and connection_id == Tracker.UDP_PROTOCOL_ID:
+                self.socket.sendto(Tracker.UDP_RESPONSE_HEADER.pack(action, transaction_id) +
+                                   struct.pack('>Q', self.connection_id), address)
+            elif connection_id != self.connection_id:
+                self.socket.sendto(Tracker.UDP_RESPONSE_HEADER.pack(Tracker.UDP_ERROR, transaction_id) +
+                                   'bad connection id', address)
+            elif action == Tracker.UDP_ANNOUNCE:
+                self.socket.sendto(Tracker.UDP_ANNOUNCE_RESPONSE.pack(action, transaction_id, 1800, 0, 1) +
+                                   socket.inet_aton('127.0.0.1') + struct.pack('>H', 6881), address)
+            elif action == Tracker.UDP_SCRAPE:
+                # Each hash starts with its index, which comes back as all three counts
+                info_hashes = packet[Tracker.UDP_HEADER.size:]
+                entries = [struct.unpack_from('>I', info_hashes, offset)[0]
+                           for offset in range(0, len(info_hashes), 20)]
+                self.socket.sendto(Tracker.UDP_RESPONSE_HEADER.pack(action, transaction_id) +
+                                   ''.join(Tracker.UDP_SCRAPE_ENTRY.pack(entry, entry, entry) for entry in entries),
+                                   address)
+
+    def actions(self, action):
+        return [detail for request_action, detail in self.requests if request_action == action]
+
+
+@benchmark
+def benchmark_udp_tracker(num_hashes=200, udp_timeout=0.2):
+    # UDPTracker against a local stand-in tracker: a dropped connect is retransmitted after udp_timeout, stray and
+    # error datagrams are handled, every event goes out with its BEP 15 code, scrapes are split into batches of
+    # UDP_SCRAPE_LIMIT and a tracker that never answers gives up at the round deadline
+    params = {'info_hash': '\0' * 20, 'peer_id': '-AC0000-benchmark000', 'port': 6881, 'uploaded': 0,
+              'downloaded': 0, 'left': 0}
+    default_timeout = Tracker.UDP_TIMEOUT
+    Tracker.UDP_TIMEOUT = udp_timeout
+
+    def retransmit(stand_in, tracker):
+        peers = tracker.announce(None, params, None)
+        return peers == [('127.0.0.1', 6881)] and len(stand_in.actions(Tracker.UDP_CONNECT)) == 2
+
+    def stray(stand_in, tracker):
+        return tracker.announce(None, params, None) == [('127.0.0.1', 6881)] and tracker.interval == 1800
+
+    def error(stand_in, tracker):
+        try:
+            tracker.announce(None, params, None)
+        except Tracker.TrackerError as e:
+            return 'torrent not registered' in str(e)
+        return False
+
+    def events(stand_in, tracker):
+        for event in [None, None, 'completed', 'stopped']:
+            tracker.announce(None, params, event)
+        return stand_in.actions(Tracker.UDP_ANNOUNCE) == [Tracker.UDP_EVENTS[event]
+                                                          for event in ['started', None, 'completed', 'stopped']]
+
+    def scrape(stand_in, tracker):
+        info_hashes = [struct.pack('>I', index) + '\0' * 16 for index in range(num_hashes)]
+        results = tracker.scrape(None, info_hashes)
+        batches = [min(Tracker.UDP_SCRAPE_LIMIT, num_hashes - start)
+                   for start in range(0, num_hashes, Tracker.UDP_SCRAPE_LIMIT)]
+        return (stand_in.actions(Tracker.UDP_SCRAPE) == batches and
+                all(results[info_hash] == (index, index, index) for index, info_hash in enumerate(info_hashes)))
+
+    def dead(stand_in, tracker):
+        try:
+            tracker.announce(None, params, None, time.time() + 3 * udp_timeout)
+        except Tracker.TrackerError:
+            return True
+        return False
+
+    try:
+        for name, stand_in_args, check in [('retransmit', {'drop_packets': 1}, retransmit),
+                                           ('stray', {'stray_datagrams': True}, stray),
+                                           ('error', {'error': 'torrent not registered'}, error),
+                                           ('events', {}, events),
+                                           ('scrape', {}, scrape),
+                                           ('dead', {'drop_packets': 10**6}, dead)]:
+            stand_in = UDPTrackerStandIn(**stand_in_args)
+            start_time = time.time()
+            ok = check(stand_in, Tracker.UDPTracker(stand_in.url))
+            report('udp_tracker', case=name, ok=ok, ms='{:.0f}'.format((time.time() - start_time) * 1000),
+                   packets=len(stand_in.requests))
+    finally:
+        Tracker.UDP_TIMEOUT = default_timeout
+
+
+def run_interrupted_download(torrent_path, download_directory, source_path, num_written, use_session, result_queue):
+    # Verify and write the first num_written pieces as a download would, then stop before the torrent completes
+    Torrent.DEBUG = False
+    Session.DEBUG = False
+    # write_piece prints its progress unconditionally
+    sys.stdout = open(os.devnull, 'w')
+    if use_session:
+        session = Session.Session(port=0)
+        torrent = session.add_torrent(torrent_path, download_directory)
+        session.start()
+    else:
+        torrent = Torrent.Torrent(torrent_path, download_directory)
+        torrent.start()
+    piece_length = torrent.info['piece length']
+    with open(source_path, 'rb') as source_file:
+        for piece_index in range(num_written):
+            data = source_file.read(piece_length)
+            with torrent.piece_acquisition_lock:
+                piece = torrent.piece_map.activate(piece_index)
+                piece.start_download(torrent.buffer_pool.checkout(piece_length), torrent.get_num_blocks(piece_index))
+                torrent.piece_picker.set_wanted(piece_index, False)
+            piece.buffer[:len(data)] = data
+            torrent.piece_verified(None, piece, hashlib.sha1(data).digest())
+    if use_session:
+        session.stop()
+    else:
+        torrent.stop()
+    result_queue.put(torrent.completed_pieces.count)
+
+
+@benchmark
+def benchmark_resume(num_pieces=24, num_written=10, piece_length=2**16):
+    # Restart a torrent that was stopped partway through, well inside RESUME_SAVE_INTERVAL, and time how long its
+    # resume file takes to load. Every piece written before the stop should come back without a recheck.
+    source_directory = tempfile.mkdtemp(prefix='accipyter-resume-')
+    try:
+        source_path = os.path.join(source_directory, 'source')
+        with open(source_path, 'wb') as f:
+            f.write(os.urandom(num_pieces * piece_length - 1000))
+        torrent_path = source_path + '.torrent'
+        # Nothing listens on port 1, announces fail straight away
+        TorrentReader.create_torrent(source_path, torrent_path, announce='http://127.0.0.1:1/announce',
+                                     piece_length=piece_length)
+
+        Torrent.DEBUG = False
+        for use_session in [False, True]:
+            download_directory = tempfile.mkdtemp(prefix='accipyter-resume-download-')
+            result_queue = multiprocessing.Queue()
+            runner = multiprocessing.Process(target=run_interrupted_download,
+                                             args=(torrent_path, download_directory, source_path, num_written,
+                                                   use_session, result_queue))
+            runner.start()
+            written = result_queue.get()
+            runner.join()
+
+            start = time.time()
+            torrent = Torrent.Torrent(torrent_path, download_directory)
+            restore_time = time.time() - start
+            report('resume', mode='session' if use_session else 'standalone', written=written,
+                   restored='{}/{}'.format(torrent.completed_pieces.count, num_pieces),
+                   ok=torrent.completed_pieces.count == written == num_written,
+                   restore_ms='{:.1f}'.format(restore_time * 1000))
+            shutil.rmtree(download_directory)
+    finally:
+        shutil.rmtree(source_directory)
+
+
+def main(names):
+    for name in names or BENCHMARKS.keys():
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
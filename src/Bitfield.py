@@ -0,0 +1,102 @@
+import re
+
+BYTE_BITS = [tuple(bit for bit in range(8) if byte & (0x80 >> bit)) for byte in range(256)]
+FIRST_CLEAR_BIT = [([bit for bit in range(8) if not byte & (0x80 >> bit)] + [None])[0] for byte in range(256)]
+NONZERO_BYTE = re.compile('[^\x00]')
+
+
+class Bitfield(object):
+    """
+    Fixed length bit array stored in BitTorrent wire order: index 0 is the high bit of the first byte.
+    """
+
+    def __init__(self, length):
+        self.length = length
+        self.bytes = bytearray((length + 7) // 8)
+        self.count = 0
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        return (self.bytes[index >> 3] >> (7 - (index & 7))) & 1
+
+    def set(self, index):
+        # Returns True if the bit was not already set
+        mask = 0x80 >> (index & 7)
+        byte_index = index >> 3
+        if self.bytes[byte_index] & mask:
+            return False
+        self.bytes[byte_index] |= mask
+        self.count += 1
+        return True
+
+    def clear(self, index):
+        # Returns True if the bit was previously set
+        mask = 0x80 >> (index & 7)
+        byte_index = index >> 3
+        if not self.bytes[byte_index] & mask:
+            return False
+        self.bytes[byte_index] &= ~mask & 0xff
+        self.count -= 1
+        return True
+
+    def reset(self):
+        self.bytes = bytearray(len(self.bytes))
+        self.count = 0
+
+    def load(self, data):
+        # Replace the contents with a wire format bitfield and return the indices that became set. Spare bits past
+        # the end of the field are ignored.
+        previous = self.bytes
+        self.bytes = bytearray(data[:len(previous)])
+        self.bytes.extend(bytearray(len(previous) - len(self.bytes)))
+        spare_bits = len(self.bytes) * 8 - self.length
+        if spare_bits:
+            self.bytes[-1] &= (0xff << spare_bits) & 0xff
+        self.count = sum(len(BYTE_BITS[byte]) for byte in self.bytes)
+
+        new_indices = []
+        for byte_index, byte in enumerate(self.bytes):
+            new_bits = byte & ~previous[byte_index]
+            if new_bits:
+                base = byte_index << 3
+                new_indices.extend(base + bit for bit in BYTE_BITS[new_bits])
+        return new_indices
+
+    def set_indices(self):
+        data = self.bytes
+        if self.count < len(data):
+            # Sparse: runs of empty bytes are skipped by the regex engine, so this costs little more than the set bits
+            for match in NONZERO_BYTE.finditer(data):
+                byte_index = match.start()
+                base = byte_index << 3
+                for bit in BYTE_BITS[data[byte_index]]:
+                    yield base + bit
+            return
+        for byte_index, byte in enumerate(data):
+            if byte:
+                base = byte_index << 3
+                for bit in BYTE_BITS[byte]:
+                    yield base + bit
+
+    def complete(self):
+        return self.count == self.length
+
+    def first_clear(self, start=0):
+        # Index of the first clear bit at or after start, or None if every remaining bit is set
+        byte_index = start >> 3
+        if byte_index >= len(self.bytes):
+            return None
+        # Treat the bits before start in the first byte as set
+        byte = self.bytes[byte_index] | ((0xff00 >> (start & 7)) & 0xff)
+        while byte == 0xff:
+            byte_index += 1
+            if byte_index == len(self.bytes):
+                return None
+            byte = self.bytes[byte_index]
+        index = (byte_index << 3) + FIRST_CLEAR_BIT[byte]
+        return index if index < self.length else None
+
+    def tobytes(self):
+        return bytes(self.bytes)
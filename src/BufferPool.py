@@ -0,0 +1,67 @@
+import threading
+
+# Ceiling on memory held by piece buffers that are downloading, verifying or waiting to be written, across every torrent
+# drawing on one pool
+PIECE_MEMORY_LIMIT = 256 * 2**20
+
+
+class PieceBufferPool(object):
+    """
+    Bytearray piece buffers under one memory ceiling, reused rather than reallocated for every piece. Torrents with
+    different piece lengths can share a pool: free buffers are kept by size, and free buffers of other sizes are
+    dropped to make room when a size has none. checkout returns None once the ceiling is reached, and the waiter it was
+    given is called when a buffer is next released.
+    """
+
+    def __init__(self, memory_limit=PIECE_MEMORY_LIMIT):
+        self.memory_limit = memory_limit
+        self.lock = threading.Lock()
+        # Free buffers by size, and the bytes of every buffer that exists, free or not
+        self.free_buffers = {}
+        self.allocated = 0
+        self.waiters = set()
+
+    def checkout(self, buffer_size, waiter=None):
+        with self.lock:
+            free_buffers = self.free_buffers.get(buffer_size)
+            if free_buffers:
+                return free_buffers.pop()
+            for size, buffers in self.free_buffers.items():
+                while buffers and self.allocated + buffer_size > self.memory_limit:
+                    buffers.pop()
+                    self.allocated -= size
+            # A single buffer is always allowed, however small the limit
+            if self.allocated + buffer_size > self.memory_limit and self.allocated:
+                if waiter is not None:
+                    self.waiters.add(waiter)
+                return None
+            self.allocated += buffer_size
+        return bytearray(buffer_size)
+
+    def release(self, buffer):
+        # Wakes every waiter, in case this buffer or the room it leaves suits them
+        with self.lock:
+            self.free_buffers.setdefault(len(buffer), []).append(buffer)
+            waiters = self.waiters
+            self.waiters = set()
+        for waiter in waiters:
+            waiter()
+
+    def remove_waiter(self, waiter):
+        with self.lock:
+            self.waiters.discard(waiter)
+
+    def in_use(self):
+        # Bytes of buffers checked out
+        with self.lock:
+            return self.allocated - sum(len(buffer) for buffers in self.free_buffers.itervalues() for buffer in buffers)
+
+
+# Shared by every torrent outside a Session
+shared_pool = PieceBufferPool()
+
+
+def set_memory_limit(memory_limit):
+    # Buffers already checked out are kept, new ones wait until usage is back under the limit
+    with shared_pool.lock:
+        shared_pool.memory_limit = memory_limit
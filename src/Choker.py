@@ -0,0 +1,123 @@
+import time
+import random
+import threading
+
+# Regular upload slots, given to the interested peers that reciprocate best
+UPLOAD_SLOTS = 4
+# Seconds between choking rounds
+CHOKE_INTERVAL = 10
+# Seconds the optimistic unchoke stays with one peer before moving on
+OPTIMISTIC_INTERVAL = 30
+
+
+class Choker(threading.Thread):
+    """
+    Decides which peers we upload to. Every CHOKE_INTERVAL seconds the UPLOAD_SLOTS interested peers with the best
+    reciprocation rate are unchoked: the rate they send to us while downloading, or the rate they take from us once
+    seeding. One more interested peer, rotated every OPTIMISTIC_INTERVAL seconds, is unchoked optimistically so peers
+    we have not traded with yet get a chance to show what they can do. Between rounds, peers that become interested
+    are unchoked straight away while slots are free.
+
+    Torrents in a Session do not start the thread. attach runs the rounds as timers on the session's PeerEngine.
+    """
+
+    def __init__(self, torrent):
+        threading.Thread.__init__(self, name='Choker')
+        self.daemon = True
+        self.torrent = torrent
+        self.condition = threading.Condition()
+        self.changed = False
+        self.running = True
+        self.optimistic_peer = None
+        self.optimistic_time = 0
+        self.unchoked = set()
+        self.round_time = time.time()
+        # Set by attach when the Choker runs on a PeerEngine instead of its own thread
+        self.engine = None
+
+    def notify(self):
+        # Thread safe: a peer became interested
+        with self.condition:
+            if self.engine is None:
+                self.changed = True
+                self.condition.notify()
+            elif not self.changed:
+                self.changed = True
+                self.engine.call_soon(self.scheduled_fill)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def upload_rate(self):
+        # Bytes per second uploaded to every peer
+        return self.torrent.upload_meter.rate()
+
+    def peers(self):
+        return [peer for peer in list(self.torrent.connection_manager.established) if peer.alive]
+
+    def rechoke(self):
+        now = self.round_time = time.time()
+        peers = self.peers()
+        # Read each rate once, a meter moves between reads
+        if self.torrent.complete:
+            rates = dict((peer, peer.upload_meter.rate(now)) for peer in peers)
+        else:
+            rates = dict((peer, peer.download_meter.rate(now)) for peer in peers)
+        interested = [peer for peer in peers if peer.peer_interested]
+        interested.sort(key=rates.get, reverse=True)
+        unchoked = set(interested[:UPLOAD_SLOTS])
+
+        if (self.optimistic_peer not in interested or self.optimistic_peer in unchoked or
+                now - self.optimistic_time >= OPTIMISTIC_INTERVAL):
+            candidates = [peer for peer in interested[UPLOAD_SLOTS:] if peer is not self.optimistic_peer]
+            self.optimistic_peer = random.choice(candidates) if candidates else None
+            self.optimistic_time = now
+        if self.optimistic_peer is not None:
+            unchoked.add(self.optimistic_peer)
+
+        for peer in peers:
+            peer.set_choking(peer not in unchoked)
+        self.unchoked = unchoked
+
+    def fill_slots(self):
+        self.unchoked = set(peer for peer in self.unchoked if peer.alive and peer.peer_interested)
+        for peer in self.peers():
+            if len(self.unchoked) > UPLOAD_SLOTS:
+                break
+            if peer.peer_interested and peer not in self.unchoked:
+                peer.set_choking(False)
+                self.unchoked.add(peer)
+
+    def run(self):
+        while True:
+            with self.condition:
+                next_round = self.round_time + CHOKE_INTERVAL
+                while self.running and not self.changed and time.time() < next_round:
+                    self.condition.wait(next_round - time.time())
+                if not self.running:
+                    break
+                changed = self.changed
+                self.changed = False
+
+            if time.time() >= next_round:
+                self.rechoke()
+            elif changed:
+                self.fill_slots()
+
+    def attach(self, engine):
+        # Run on engine's thread from now on instead of starting the thread
+        self.engine = engine
+        engine.call_soon(engine.call_later, CHOKE_INTERVAL, self.scheduled_round)
+
+    def scheduled_fill(self):
+        with self.condition:
+            self.changed = False
+        if self.running:
+            self.fill_slots()
+
+    def scheduled_round(self):
+        if self.running:
+            self.rechoke()
+            self.engine.call_later(CHOKE_INTERVAL, self.scheduled_round)
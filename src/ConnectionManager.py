@@ -0,0 +1,267 @@
+import time
+import threading
+
+import PeerStore
+
+# Most connections dialled but not yet handshaken at once
+MAX_CONCURRENT_DIALS = 30
+# Dial up to this many candidates per free slot, since many dials fail. Surplus connections that complete their
+# handshake once every slot is taken are closed again.
+DIAL_FACTOR = 3
+
+# Seconds between reviews of the established peers and the peer limit
+REVIEW_INTERVAL = 30
+# Peers are judged only after this many seconds connected. Those downloading at under SLOW_PEER_FRACTION of the
+# average rate, or snubbing us, are closed to make room for fresh candidates.
+MIN_REVIEW_TIME = 60
+SLOW_PEER_FRACTION = 0.1
+# The peer limit moves by PEER_LIMIT_STEP each review: on in the same direction while the total download rate grows
+# by more than PEER_LIMIT_GAIN, back when it falls by as much, and down when it holds since the extra peers bought
+# nothing
+PEER_LIMIT_STEP = 5
+PEER_LIMIT_GAIN = 0.05
+
+
+class ConnectionManager(threading.Thread):
+    """
+    Opens and retires peer connections for a torrent. The thread sleeps until something changes (a connection
+    handshakes or closes, new peers are found, pieces become wanted again or a failed peer's retry time comes up) and
+    then dials the best scoring candidates, several at once, for any free slots up to the torrent's peer_limit.
+    Every REVIEW_INTERVAL seconds while downloading it replaces slow and snubbing peers and moves peer_limit within
+    the torrent's bounds towards the count that gives the best total download rate.
+
+    Torrents in a Session do not start the thread. attach runs the same work as callbacks on the session's PeerEngine,
+    and dials stay within the session's connection budget.
+    """
+
+    def __init__(self, torrent):
+        threading.Thread.__init__(self, name='ConnectionManager')
+        self.daemon = True
+        self.torrent = torrent
+        self.condition = threading.Condition()
+        # Every open connection, and the ones among them that have handshaken
+        self.connections = set()
+        self.established = set()
+        self.closed_connections = set()
+        self.established_connections = set()
+        self.incoming_connections = set()
+        # Connections we closed only for want of room, their peers may be dialled again straight away
+        self.surplus = set()
+        self.changed = True
+        self.running = True
+        self.review_time = time.time() + REVIEW_INTERVAL
+        # Total download rate and peer limit at the last review, and the step taken to the limit after it
+        self.review_rate = None
+        self.review_limit = None
+        self.limit_step = PEER_LIMIT_STEP
+        # Set by attach when the manager runs on a PeerEngine instead of its own thread
+        self.engine = None
+        self.step_pending = False
+        self.wake_generation = 0
+
+    def wake(self):
+        # Called with the condition held once there is something to do
+        self.changed = True
+        if self.engine is None:
+            self.condition.notify()
+        elif not self.step_pending:
+            self.step_pending = True
+            self.engine.call_soon(self.scheduled_step)
+
+    def notify(self):
+        # Thread safe: ask the manager to look for free slots
+        with self.condition:
+            self.wake()
+
+    def connection_closed(self, connection):
+        # Thread safe, called once by each connection when it goes away
+        with self.condition:
+            self.closed_connections.add(connection)
+            self.wake()
+
+    def connection_established(self, connection):
+        # Thread safe, called when a connection receives the peer's handshake
+        with self.condition:
+            self.established_connections.add(connection)
+            self.wake()
+
+    def add_incoming(self, connection):
+        # Thread safe, a connection the peer opened to us
+        with self.condition:
+            self.incoming_connections.add(connection)
+            self.wake()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def next_wake_time(self):
+        # The next review, or sooner when a peer waiting out a failure comes up for retry
+        retry_time = self.torrent.peer_store.next_retry_time()
+        return self.review_time if retry_time is None else min(self.review_time, retry_time)
+
+    def take_changes(self):
+        # Called with the condition held
+        self.changed = False
+        changes = self.incoming_connections, self.established_connections, self.closed_connections
+        self.incoming_connections = set()
+        self.established_connections = set()
+        self.closed_connections = set()
+        return changes
+
+    def wait_for_change(self):
+        with self.condition:
+            if not self.changed and self.running:
+                self.condition.wait(max(0, self.next_wake_time() - time.time()))
+            return self.take_changes()
+
+    def add_established(self, connection):
+        torrent = self.torrent
+        if not connection.incoming:
+            key = (connection.peer_ip, connection.peer_port)
+            torrent.peer_store.record_handshake(key, connection.handshake_time - connection.connect_start_time)
+        if len(self.established) >= torrent.peer_limit:
+            self.close_surplus([connection])
+            return
+        self.established.add(connection)
+        if connection.peer_interested:
+            # It may have asked before it was counted here, give the Choker another look
+            torrent.choker.notify()
+
+    def remove_closed(self, connection):
+        torrent = self.torrent
+        torrent.log_msg('Removing dead peer: {}'.format(connection.peer_ip))
+        self.connections.discard(connection)
+        self.established.discard(connection)
+        torrent.remove_peer(connection)
+        surplus = connection in self.surplus
+        self.surplus.discard(connection)
+        if torrent.session is not None:
+            torrent.session.connection_released()
+        if connection.incoming:
+            # Incoming peers connect from a port nobody can dial, so they are not kept in the PeerStore
+            return
+
+        key = (connection.peer_ip, connection.peer_port)
+        if connection.handshake_time is not None:
+            connected_time = time.time() - connection.handshake_time
+            if connected_time > 0:
+                torrent.peer_store.record_throughput(key, connection.downloaded_bytes / connected_time)
+        torrent.peer_store.mark_disconnected(key, not connection.received_handshake,
+                                            0 if surplus else PeerStore.PEER_RETRY_DELAY)
+
+    def close_peers(self, peers, reason):
+        for connection in peers:
+            self.torrent.log_msg('Closing {} peer: {}'.format(reason, connection.peer_ip))
+            connection.kill()
+
+    def close_surplus(self, peers):
+        self.surplus.update(peers)
+        self.close_peers(peers, 'surplus')
+
+    def replace_slow_peers(self, rates, now):
+        torrent = self.torrent
+        # Peers we are uploading to on purpose are left to the Choker
+        reviewed = [connection for connection in rates if connection not in torrent.choker.unchoked and
+                    now - connection.handshake_time >= MIN_REVIEW_TIME]
+        if not reviewed:
+            return
+        threshold = SLOW_PEER_FRACTION * sum(rates.itervalues()) / len(rates)
+        slow = [connection for connection in reviewed if connection.snubbed(now) or rates[connection] < threshold]
+        # Closing a peer only helps when a candidate can take its slot
+        replacements = len(torrent.peer_store.candidates(len(slow)))
+        slow.sort(key=lambda connection: (not connection.snubbed(now), rates[connection]))
+        self.close_peers(slow[:replacements], 'slow')
+
+    def adjust_peer_limit(self, rates, rate):
+        torrent = self.torrent
+        previous_rate, previous_limit = self.review_rate, self.review_limit
+        # Only a limit that was filled says anything about whether more peers help, so rates are only compared
+        # between reviews that both filled theirs
+        self.review_rate = rate if len(rates) >= torrent.peer_limit else None
+        self.review_limit = torrent.peer_limit
+        if self.review_rate is None or previous_rate is None:
+            return
+        if torrent.peer_limit != previous_limit:
+            # Judge the last step
+            if rate < previous_rate * (1 - PEER_LIMIT_GAIN):
+                self.limit_step = -self.limit_step
+            elif rate <= previous_rate * (1 + PEER_LIMIT_GAIN):
+                self.limit_step = -PEER_LIMIT_STEP
+        peer_limit = max(torrent.min_peer_limit, min(torrent.max_peer_limit, torrent.peer_limit + self.limit_step))
+        if peer_limit == torrent.peer_limit:
+            # Pinned at a bound, try the other way next time
+            self.limit_step = -self.limit_step
+            return
+        torrent.log_msg('Peer limit {} -> {}'.format(torrent.peer_limit, peer_limit))
+        torrent.peer_limit = peer_limit
+        if len(rates) > peer_limit:
+            surplus = sorted(rates, key=rates.get)[:len(rates) - peer_limit]
+            self.close_surplus(surplus)
+
+    def review(self):
+        torrent = self.torrent
+        now = time.time()
+        self.review_time = now + REVIEW_INTERVAL
+        if torrent.complete or not torrent.pieces_wanted():
+            self.review_rate = None
+            return
+        rates = dict((connection, connection.download_meter.rate(now))
+                     for connection in self.established if connection.alive)
+        self.adjust_peer_limit(rates, torrent.download_meter.rate(now))
+        self.replace_slow_peers(dict((connection, rate) for connection, rate in rates.iteritems()
+                                     if connection.alive), now)
+
+    def dial(self):
+        torrent = self.torrent
+        # Peers share pieces block by block, so while anything is wanted every slot can be put to use
+        open_slots = torrent.peer_limit - len(self.established) if torrent.pieces_wanted() else 0
+        dialling = len(self.connections) - len(self.established)
+        dials = min(MAX_CONCURRENT_DIALS, open_slots * DIAL_FACTOR) - dialling
+        if dials > 0 and torrent.session is not None:
+            dials = torrent.session.reserve_dials(self, dials)
+        if dials > 0:
+            for peer in torrent.peer_store.candidates(dials):
+                torrent.peer_store.mark_connected(peer.key)
+                self.connections.add(torrent.create_peer_connection(peer.ip, peer.port))
+
+    def step(self, incoming_connections, established_connections, closed_connections):
+        self.connections.update(incoming_connections)
+        for connection in established_connections - closed_connections:
+            if connection in self.connections:
+                self.add_established(connection)
+        for connection in closed_connections:
+            if connection in self.connections:
+                self.remove_closed(connection)
+
+        if self.running and time.time() >= self.review_time:
+            self.review()
+        if self.running:
+            self.dial()
+
+    def run(self):
+        while self.running:
+            self.step(*self.wait_for_change())
+
+    def attach(self, engine):
+        # Run on engine's thread from now on instead of starting the thread
+        with self.condition:
+            self.engine = engine
+            self.wake()
+
+    def scheduled_step(self):
+        with self.condition:
+            self.step_pending = False
+            changes = self.take_changes()
+        if not self.running:
+            return
+        self.step(*changes)
+        # Come back for the next review or retry even if nothing else happens. Timers cannot be cancelled, older ones
+        # see a stale generation and do nothing.
+        self.wake_generation += 1
+        self.engine.call_later(max(0, self.next_wake_time() - time.time()), self.timer_wake, self.wake_generation)
+
+    def timer_wake(self, generation):
+        if generation == self.wake_generation and self.running:
+            self.notify()
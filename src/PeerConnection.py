@@ -3,12 +3,16 @@ import struct
 import time
 import Queue
 import threading
-import hashlib
 import errno
+import math
 from io import BytesIO
+from collections import deque
 
-import Torrent
+import Bitfield
+import RateMeter
+import RateLimiter
 
+INTERNAL_WAKE = -4
 INTERNAL_QUIT = -3
 KEEP_ALIVE = -2
 HANDSHAKE = -1
@@ -24,74 +28,171 @@ CANCEL = 8
 PORT = 9
 
 MAX_BLOCK_LENGTH = 2**14
+# Longest block we upload, larger REQUESTs are ignored
+MAX_REQUEST_LENGTH = 2**17
+# REQUESTs queued for upload per peer, further ones are ignored until the queue drains
+MAX_UPLOAD_QUEUE = 250
+
+# Outstanding REQUEST queue bounds. The queue is sized to keep REQUEST_QUEUE_TIME seconds (or two round trips,
+# whichever is longer) worth of blocks in flight at the peer's measured delivery rate.
+INITIAL_REQUEST_QUEUE = 4
+MIN_REQUEST_QUEUE = 2
+MAX_REQUEST_QUEUE = 250
+REQUEST_QUEUE_TIME = 1.0
+REQUEST_TIMEOUT = 30
+# A peer that has unchoked us but sent no blocks for this long despite outstanding requests is snubbing us
+SNUB_TIME = 60
+
+# Bytes requested from the socket per recv_into call. The receive buffer grows to fit the largest pending frame plus
+# one read.
+READ_SIZE = 2**16
+# Reads under a download limit take at least this much once the buckets allow any, so a slow limit is not spent in
+# tiny reads
+MIN_LIMITED_READ = 2**14
+
+CONNECTION_TIMEOUT = 120
+# Seconds allowed for the TCP connect, and for the peer's handshake counted from the start of the connect
+CONNECT_TIMEOUT = 5
+HANDSHAKE_TIMEOUT = 10
+
+DEBUG_LEVEL = 99
+
+
+class PeerProtocol(object):
+    """
+    BitTorrent wire protocol and download state for a single peer, independent of how the socket is driven. Subclasses
+    own the socket and provide send_message, dispatch_message and kill.
+    """
 
-
-class PeerConnection(threading.Thread):
     def __init__(self, ip, port, torrent):
-        threading.Thread.__init__(self)
-        self.debug_level = 99
+        self.debug_level = DEBUG_LEVEL
         # Consider a connection alive until proven otherwise. This prevents peers from being removed before they've had
         # a chance to connect
         self.alive = True
+        self.close_reported = False
         self.socket = None
         self.received_handshake = False
+        # True when the peer connected to us
+        self.incoming = False
         self.peer_ip = ip
         self.peer_port = port
         self.info_hash = torrent.info_hash
         self.peer_id = None
-        self.message_queue = Queue.Queue()
-        self.outgoing_message_queue = Queue.Queue()
+        self.last_message_time = time.time()
+        # Connection history used to score the peer once it disconnects
+        self.connect_start_time = time.time()
+        self.handshake_time = None
+        self.downloaded_bytes = 0
+
+        # Unparsed bytes live in receive_buffer[receive_start:receive_end]
+        self.read_size = READ_SIZE
+        self.receive_buffer = bytearray(2 * READ_SIZE)
+        self.receive_view = memoryview(self.receive_buffer)
+        self.receive_start = 0
+        self.receive_end = 0
+        self.receive_required = 0
+
+        # PIECE messages are handled as soon as they are parsed, other messages may be handled on another thread by
+        # dispatch_message. This lock guards the piece and request state shared between the two.
+        self.piece_lock = threading.RLock()
         self.torrent = torrent
         self.choked = True
+        # The piece new requests are drawn from. Block state lives on the piece, which other peers may be working on
+        # too. endgame is set when the piece was joined to duplicate blocks already in flight elsewhere.
         self.assigned_piece = None
-        self.received_block_ranges = []
-        self.discreet_block_ranges = []
-
-        num_pieces = len(torrent.info['pieces']) / 20
-        self.bitfield = [0] * num_pieces
-
-        self.start()
+        self.endgame = False
+
+        # Maps (piece index, block begin) to (block length, time requested, piece). Requests can span several pieces.
+        self.outstanding_requests = {}
+        self.min_request_queue = MIN_REQUEST_QUEUE
+        self.max_request_queue = MAX_REQUEST_QUEUE
+        self.request_queue_time = REQUEST_QUEUE_TIME
+        self.request_queue_size = INITIAL_REQUEST_QUEUE
+        self.download_rate = 0.0
+        self.rtt = None
+        self.rate_sample_start = time.time()
+        self.rate_sample_bytes = 0
+        # Rolling rates for choking, peer replacement and display
+        self.download_meter = RateMeter.RateMeter()
+        self.upload_meter = RateMeter.RateMeter()
+        self.last_block_time = time.time()
+        # This connection's own limits, drawn on together with the torrent's and the global ones
+        self.download_bucket = RateLimiter.TokenBucket(torrent.peer_download_limit)
+        self.upload_bucket = RateLimiter.TokenBucket(torrent.peer_upload_limit)
+        self.receive_buckets = (self.download_bucket,) + torrent.download_buckets
+        self.send_buckets = (self.upload_bucket,) + torrent.upload_buckets
+        self.upload_resume_time = 0
+
+        # Upload state. Peers start out choked, the torrent's Choker decides who is unchoked.
+        self.am_choking = True
+        self.peer_interested = False
+        self.upload_queue = deque()
+        self.uploaded_bytes = 0
+
+        self.bitfield = Bitfield.Bitfield(torrent.num_pieces)
 
     def reset(self):
         self.assigned_piece = None
-        self.received_block_ranges = []
-        self.discreet_block_ranges = []
+        self.endgame = False
 
-    def run(self):
-        if self.connect():
-            self.do_handshake()
-            self.socket_read_loop()
+    def drop_piece(self):
+        # Another peer finished the assigned piece, cancel whatever is still requested from this one
+        piece_index = self.assigned_piece.index
+        for request_key in [key for key in self.outstanding_requests if key[0] == piece_index]:
+            self.cancel_request(*request_key)
+        self.reset()
 
-    def kill(self):
-        self.alive = False
-        self.socket.close()
-        self.message_queue.put({'MESSAGE_ID': INTERNAL_QUIT})
+    @staticmethod
+    def advance_hash(piece, block_index, block):
+        # Hash blocks as soon as everything before them has been hashed, so that verifying a piece received in order
+        # only costs the final digest. Called with the piece's lock held.
+        if block_index != piece.hashed_blocks:
+            return
+        piece.hasher.update(block)
+        piece.hashed_blocks += 1
+
+        # Catch up over blocks that arrived ahead of this one. Once the piece is complete the remainder is left to the
+        # hash pool instead of holding up this connection.
+        if piece.received_blocks.complete():
+            return
+        piece_view = memoryview(piece.buffer)
+        while piece.received_blocks[piece.hashed_blocks]:
+            block_begin = piece.hashed_blocks * MAX_BLOCK_LENGTH
+            piece.hasher.update(piece_view[block_begin:block_begin + MAX_BLOCK_LENGTH])
+            piece.hashed_blocks += 1
+
+    def release_request(self, piece_index, block_begin):
+        # Make an outstanding block requestable again, by this or any other peer
+        piece = self.outstanding_requests.pop((piece_index, block_begin))[2]
+        if piece.release_block(self, block_begin / MAX_BLOCK_LENGTH):
+            self.torrent.block_released(piece)
+
+    def cancel_request(self, piece_index, block_begin):
+        # Thread safe. Withdraw a request for a block that has arrived from another peer.
+        with self.piece_lock:
+            request = self.outstanding_requests.pop((piece_index, block_begin), None)
+            if request is not None and self.alive:
+                self.send_message(struct.pack('>IBIII', 13, CANCEL, piece_index, block_begin, request[0]))
+
+    def report_closed(self):
+        # Tell the torrent, exactly once, that this connection is gone for good
+        with self.piece_lock:
+            if self.close_reported:
+                return
+            self.close_reported = True
+        self.torrent.connection_closed(self)
 
     def log_message(self, message, level):
         if level <= self.debug_level:
             print message
 
-    def connect(self):
-        self.log_message('Connecting to {}:{} ...'.format(self.peer_ip, self.peer_port), 2)
-        try:
-            self.socket = socket.create_connection((self.peer_ip, self.peer_port))
-        except (socket.error, socket.timeout) as e:
-            self.log_message("CONNECTION DONE GOOFED: {}".format(e), 1)
-            self.alive = False
-            return False
-        self.socket.setblocking(0)
-        self.log_message('connection established...', 2)
-        self.alive = True
-        return True
-
-    def do_handshake(self):
+    def handshake_message(self):
         protocol_strlen = chr(19)
         protocol_string = 'BitTorrent protocol'
         reserved = chr(0) * 8
         info_hash = self.torrent.info_hash_bytes
         peer_id = self.torrent.peer_id
-        message = '{}{}{}{}{}'.format(protocol_strlen, protocol_string, reserved, info_hash, peer_id)
-        self.socket.sendall(message)
+        return '{}{}{}{}{}'.format(protocol_strlen, protocol_string, reserved, info_hash, peer_id)
 
     @staticmethod
     def read_handshake(handshake_str):
@@ -110,37 +211,70 @@ class PeerConnection(threading.Thread):
 
         return handshake_dict
 
-    def extract_messages(self, data):
-        if not self.received_handshake:
-            first_byte = data.read(1)
-            if first_byte == '\x13':
-                data.seek(0)
-                handshake_message = self.read_handshake(data.read(68))
-                self.message_queue.put(handshake_message)
-            else:
-                raise(Exception('Expected Handshake, got: {}'.format(repr(first_byte))))
-
-        while True:
-            current_position = data.tell()
-            data.read()
-            end_position = data.tell()
-            data.seek(current_position)
+    def make_receive_space(self):
+        # Move the partial frame at the end of the buffer back to the front, growing the buffer if the frame will not
+        # fit alongside another read
+        pending = self.receive_end - self.receive_start
+        capacity = max(self.receive_required, pending) + self.read_size
+        tail = self.receive_view[self.receive_start:self.receive_end].tobytes()
+        if capacity > len(self.receive_buffer):
+            self.receive_buffer = bytearray(capacity)
+            self.receive_view = memoryview(self.receive_buffer)
+        self.receive_buffer[0:pending] = tail
+        self.receive_start = 0
+        self.receive_end = pending
+
+    def receive_allowance(self):
+        # (bytes, seconds): how much the next read may take, 0 while a download limit is used up, and in that case how
+        # long to leave the socket alone. Data left unread holds back the peer through TCP flow control.
+        allowed, wait = RateLimiter.allowance(self.receive_buckets)
+        if allowed is None:
+            return self.read_size, 0
+        if allowed <= 0:
+            return 0, wait
+        return min(self.read_size, max(int(allowed), MIN_LIMITED_READ)), 0
+
+    def receive(self, read_size):
+        # Read up to read_size bytes from the socket straight into the receive buffer. Returns the number of bytes
+        # read, 0 when the peer has closed the connection.
+        if self.receive_start == self.receive_end:
+            self.receive_start = self.receive_end = 0
+        if len(self.receive_buffer) - self.receive_end < read_size:
+            self.make_receive_space()
+        received = self.socket.recv_into(self.receive_view[self.receive_end:], read_size)
+        self.receive_end += received
+        RateLimiter.consume(self.receive_buckets, received)
+        return received
+
+    def extract_messages(self):
+        data = self.receive_buffer
+        position = self.receive_start
+        end_position = self.receive_end
 
-            if (end_position - current_position) < 5:
+        if not self.received_handshake:
+            if end_position - position < 68:
+                return
+            if data[position] != 19:
+                raise(Exception('Expected Handshake, got: {}'.format(repr(chr(data[position])))))
+            handshake_message = self.read_handshake(self.receive_view[position:position + 68].tobytes())
+            self.received_handshake = True
+            self.dispatch_message(handshake_message)
+            position += 68
+
+        while end_position - position >= 4:
+            message_length = struct.unpack_from('>I', data, position)[0]
+            if end_position - position - 4 < message_length:
+                self.receive_required = message_length + 4
                 break
 
-            message_length = struct.unpack('>I', data.read(4))[0]
-            data_available = (end_position - data.tell())
-            if data_available < message_length:
-                data.seek(data.tell()-4)
-                break
+            payload_position = position + 5
+            position += 4 + message_length
 
             new_message = {}
             if message_length == 0:
                 new_message['MESSAGE_ID'] = KEEP_ALIVE
             else:
-                message_id = struct.unpack('B', data.read(1))[0]
-                message = BytesIO(data.read(message_length - 1))
+                message_id = data[payload_position - 1]
 
                 new_message['MESSAGE_ID'] = message_id
 
@@ -153,198 +287,415 @@ class PeerConnection(threading.Thread):
                 elif message_id == NOT_INTERESTED:
                     pass
                 elif message_id == HAVE:
-                    piece_index = struct.unpack('>I', message.read(4))[0]
+                    piece_index = struct.unpack_from('>I', data, payload_position)[0]
                     new_message['piece_index'] = piece_index
 
                 elif message_id == BITFIELD:
-                    bitfield = message.read()
+                    bitfield = self.receive_view[payload_position:position].tobytes()
                     new_message['bitfield'] = bitfield
 
                 elif message_id in [REQUEST, CANCEL]:
-                    new_message['index'] = struct.unpack('>I', message.read(4))[0]
-                    new_message['begin'] = struct.unpack('>I', message.read(4))[0]
-                    new_message['length'] = struct.unpack('>I', message.read(4))[0]
+                    index, begin, length = struct.unpack_from('>III', data, payload_position)
+                    new_message['index'] = index
+                    new_message['begin'] = begin
+                    new_message['length'] = length
 
                 elif message_id == PIECE:
-                    new_message['index'] = struct.unpack('>I', message.read(4))[0]
-                    new_message['begin'] = struct.unpack('>I', message.read(4))[0]
-                    new_message['block'] = message.read(message_length-9)
+                    index, begin = struct.unpack_from('>II', data, payload_position)
+                    new_message['index'] = index
+                    new_message['begin'] = begin
+                    # The block is a view into the receive buffer and is only valid until the next read, so the piece
+                    # is handled right away rather than queued
+                    new_message['block'] = self.receive_view[payload_position + 8:position]
+                    self.handle_piece_message(new_message)
+                    continue
 
                 elif message_id == PORT:
-                    new_message['port'] = struct.unpack('>I', message.read(4))[0]
+                    new_message['port'] = struct.unpack_from('>H', data, payload_position)[0]
 
                 else:
-                    self.log_message('Unexpected message id: {}\n\tlength:{}\n\tpayload:{}'.format(message_id,
-                                                                                                   message_length,
-                                                                                                   message.read()), 1)
-
-            self.message_queue.put(new_message)
+                    self.log_message('Unexpected message id: {}\n\tlength:{}'.format(message_id, message_length), 1)
 
-    def find_block_gap(self):
-        # If the beginning of the block has not been filled in, prioritize that
-        if not self.received_block_ranges or self.received_block_ranges[0][0] != 0:
-            if not self.received_block_ranges:
-                gap_size = MAX_BLOCK_LENGTH
-            else:
-                gap_size = self.received_block_ranges[0][0] - 1
-            gap_start = 0
-        elif len(self.received_block_ranges) == 1:
-            piece_length = self.torrent.info['piece length']
-            gap_size = (piece_length - 1) - self.received_block_ranges[0][1]
-            gap_start = self.received_block_ranges[0][1] + 1
+            self.dispatch_message(new_message)
         else:
-            gap_size = self.received_block_ranges[1][0] - self.received_block_ranges[0][1] - 2
-            gap_start = self.received_block_ranges[0][1] + 1
+            self.receive_required = 0
 
-        gap_size = min(gap_size, MAX_BLOCK_LENGTH)
+        self.receive_start = position
+        self.last_message_time = time.time()
 
-        return gap_start, gap_size
-
-    def consolidate_block_ranges(self):
-        while True:
-            change_made = False
-            for byte_range_A in self.received_block_ranges:
-                for byte_range_B in self.received_block_ranges:
-                    if byte_range_A != byte_range_B:
-                        if byte_range_B[0] == (byte_range_A[1] + 1):
-                            new_range = (byte_range_A[0], byte_range_B[1])
-                            self.received_block_ranges.remove(byte_range_A)
-                            self.received_block_ranges.remove(byte_range_B)
-                            self.received_block_ranges.append(new_range)
-                            change_made = True
-                            break
-                if change_made:
-                    break
-            if not change_made:
-                break
-        self.received_block_ranges = sorted(self.received_block_ranges, key=lambda x: x[0])
-
-    def handle_piece_message(self, message):
+    def find_block_gap(self):
+        # Claim the next block of the assigned piece for this peer. Returns None if there is nothing left to request.
         if self.assigned_piece is None:
-            return
-        if message['index'] == self.assigned_piece.index:
-            self.assigned_piece.bytes.seek(message['begin'])
-            self.assigned_piece.bytes.write(message['block'])
-            block_range = (message['begin'], message['begin'] + len(message['block']) - 1)
-            if block_range in self.received_block_ranges or block_range in self.discreet_block_ranges:
-                pass
+            return None
+        block_index = self.assigned_piece.request_block(self, self.endgame)
+        if block_index is None:
+            return None
+
+        piece_length = self.torrent.get_piece_length(self.assigned_piece.index)
+        block_begin = block_index * MAX_BLOCK_LENGTH
+        return block_begin, min(MAX_BLOCK_LENGTH, piece_length - block_begin)
+
+    def update_request_queue_size(self, block_length, latency):
+        # Track the lowest observed request latency, letting it drift up slowly so that queueing delay caused by our
+        # own pipelining does not inflate it
+        if self.rtt is None or latency < self.rtt:
+            self.rtt = latency
+        else:
+            self.rtt += (latency - self.rtt) * 0.05
+
+        now = time.time()
+        self.rate_sample_bytes += block_length
+        self.downloaded_bytes += block_length
+        self.download_meter.add(block_length, now)
+        self.torrent.block_downloaded(block_length)
+        self.last_block_time = now
+        elapsed = now - self.rate_sample_start
+        if elapsed >= max(self.rtt, 0.25):
+            sample_rate = self.rate_sample_bytes / elapsed
+            if self.download_rate:
+                self.download_rate = (self.download_rate + sample_rate) / 2
             else:
-                self.discreet_block_ranges.append(block_range)
-                self.received_block_ranges.append(block_range)
-                self.consolidate_block_ranges()
-
-                bytes_completed = 0
-                for br in self.received_block_ranges:
-                    bytes_completed += br[1] - br[0]
-                completion_percent = (bytes_completed/float(self.torrent.info['piece length']))*100
-                self.log_message("{} {}% complete with piece {}".format(self.peer_ip,
-                                                                        completion_percent,
-                                                                        self.assigned_piece.index), 1)
-
-                if len(self.received_block_ranges) == 1:
-                    if self.received_block_ranges[0] == (0, self.torrent.info['piece length']-1):
-                        self.assigned_piece.bytes.seek(0)
-                        piece_hash = hashlib.sha1(self.assigned_piece.bytes.read()).digest()
-                        if piece_hash == self.assigned_piece.sha1_hash:
-                            self.torrent.finished_piece_queue.put(self.assigned_piece)
-                            self.reset()
-                        else:
-                            expected_hash = repr(self.assigned_piece.sha1_hash).replace('\'', '')
-                            actual_hash = repr(piece_hash).replace('\'', '')
-                            self.log_message('Hash mismatch expected:{} got:{}'.format(expected_hash, actual_hash), 1)
-                            self.assigned_piece.bytes.seek(0)
-                            self.received_block_ranges = []
-                            self.discreet_block_ranges = []
+                self.download_rate = sample_rate
+            self.rate_sample_start += elapsed
+            self.rate_sample_bytes = 0
 
-        else:
-            self.log_message('Piece index mismatch. Expected: {} Got: {}'.format(self.assigned_piece.index,
-                                                                                 message['index']), 1)
+        queue_time = max(self.request_queue_time, 2 * self.rtt)
+        desired_size = int(math.ceil(self.download_rate * queue_time / MAX_BLOCK_LENGTH))
+        self.request_queue_size = max(self.min_request_queue, min(self.max_request_queue, desired_size))
+
+    def handle_piece_message(self, message):
+        with self.piece_lock:
+            cancel_peers = self.store_block(message)
+            self.update_requests()
+        # Outside this peer's lock, cancel_request takes the other peer's
+        for peer in cancel_peers:
+            peer.cancel_request(message['index'], message['begin'])
+
+    def store_block(self, message):
+        # Returns the other peers the block was requested from in endgame, which should cancel their request
+        request = self.outstanding_requests.get((message['index'], message['begin']))
+        if request is None:
+            self.log_message('Unrequested block {} of piece {} from {}'.format(message['begin'],
+                                                                              message['index'],
+                                                                              self.peer_ip), 2)
+            return ()
+        piece = request[2]
+
+        piece_length = self.torrent.get_piece_length(piece.index)
+        block_index, block_offset = divmod(message['begin'], MAX_BLOCK_LENGTH)
+        block_length = len(message['block'])
+        if block_offset or block_length != min(MAX_BLOCK_LENGTH, piece_length - message['begin']):
+            self.log_message('Unexpected block {}+{} of piece {} from {}'.format(message['begin'],
+                                                                               block_length,
+                                                                               message['index'],
+                                                                               self.peer_ip), 1)
+            # The block is still missing, let any peer request it again
+            self.release_request(message['index'], message['begin'])
+            return ()
+        del self.outstanding_requests[(message['index'], message['begin'])]
+        self.update_request_queue_size(block_length, time.time() - request[1])
+
+        # The first copy of a block to arrive is kept, later ones are dropped
+        with piece.lock:
+            if piece.buffer is None:
+                # The piece was given up, and its buffer may already belong to another piece
+                self.log_message('Dropped block {} of released piece {} from {}'.format(message['begin'],
+                                                                                      message['index'],
+                                                                                      self.peer_ip), 2)
+                return ()
+            requesters = piece.block_requests.pop(block_index, ())
+            stored = piece.received_blocks.set(block_index)
+            if stored:
+                piece.buffer[message['begin']:message['begin'] + block_length] = message['block']
+                self.advance_hash(piece, block_index, message['block'])
+                received_count = piece.received_blocks.count
+                piece_complete = piece.received_blocks.complete()
+        if not stored:
+            self.log_message('Duplicate block {} of piece {} from {}'.format(message['begin'],
+                                                                            message['index'],
+                                                                            self.peer_ip), 2)
+            return ()
+
+        completion_percent = (received_count/float(len(piece.received_blocks)))*100
+        self.log_message("{} {}% complete with piece {}".format(self.peer_ip, completion_percent, piece.index), 1)
+
+        if piece_complete:
+            hashed_length = min(piece.hashed_blocks * MAX_BLOCK_LENGTH, piece_length)
+            self.torrent.piece_downloaded(self, piece, piece.hasher, hashed_length)
+            if piece is self.assigned_piece:
+                self.reset()
+        return [peer for peer in requesters if peer is not self]
+
+    def handle_message(self, message):
+        message_id = message['MESSAGE_ID']
+
+        if message_id == KEEP_ALIVE:
+            self.log_message('Got Keep Alive from: {}'.format(repr(self.peer_id)), 2)
+            keep_alive_message = '\x00\x00\x00\x00'
+            self.send_message(keep_alive_message)
+        elif message_id == CHOKE:
+            self.choked = True
+            # Without the fast extension a choking peer discards every pending request
+            with self.piece_lock:
+                for request_key in self.outstanding_requests.keys():
+                    self.release_request(*request_key)
+        elif message_id == UNCHOKE:
+            self.choked = False
+            self.rate_sample_start = self.last_block_time = time.time()
+            self.rate_sample_bytes = 0
+        elif message_id == INTERESTED:
+            self.peer_interested = True
+            self.torrent.peer_interested(self)
+        elif message_id == NOT_INTERESTED:
+            self.peer_interested = False
+        elif message_id == REQUEST:
+            self.handle_request_message(message)
+        elif message_id == CANCEL:
+            self.handle_cancel_message(message)
+        elif message_id == HAVE:
+            self.torrent.register_have(self, message['piece_index'])
+        elif message_id == BITFIELD:
+            self.handle_bitfield_message(message)
+        elif message_id == HANDSHAKE:
+            self.handle_handshake_message(message)
 
     def handle_bitfield_message(self, message):
-        bitfield_str = BytesIO(message['bitfield'])
-        piece_index = 0
-        while True:
-            next_byte = bitfield_str.read(1)
-            if next_byte:
-                next_byte = struct.unpack('B', next_byte)[0]
-                for i in range(7, -1, -1):
-                    if next_byte & (1 << i):
-                        self.bitfield[piece_index] = 1
-                    piece_index += 1
-            else:
-                break
+        self.torrent.register_bitfield(self, message['bitfield'])
 
     def handle_handshake_message(self, message):
         self.received_handshake = True
+        self.handshake_time = time.time()
         self.peer_id = message['peer_id']
+        self.torrent.connection_established(self)
         self.log_message('Got handshake from: {}'.format(self.peer_id), 2)
+        completed_pieces = self.torrent.completed_pieces
+        if completed_pieces.count:
+            bitfield_bytes = completed_pieces.tobytes()
+            self.send_message(struct.pack('>IB', 1 + len(bitfield_bytes), BITFIELD) + bitfield_bytes)
         interested_message = '\x00\x00\x00\x01\x02'
-        self.outgoing_message_queue.put(interested_message)
+        self.send_message(interested_message)
 
-    def request_block(self):
-        message_len = struct.pack('>I', 13)
-        message_id = struct.pack('B', REQUEST)
-        piece_index = struct.pack('>I', self.assigned_piece.index)
-        block_begin, block_length = self.find_block_gap()
-        block_begin = struct.pack('>I', block_begin)
-        block_length = struct.pack('>I', block_length)
+    def handle_request_message(self, message):
+        if self.am_choking:
+            return
+        piece_index, block_begin, block_length = message['index'], message['begin'], message['length']
+        if (piece_index >= self.torrent.num_pieces or not self.torrent.completed_pieces[piece_index] or
+                block_length > MAX_REQUEST_LENGTH or
+                block_begin + block_length > self.torrent.get_piece_length(piece_index)):
+            self.log_message('Invalid request for {}+{} of piece {} from {}'.format(block_begin, block_length,
+                                                                                   piece_index, self.peer_ip), 1)
+            return
+        if len(self.upload_queue) >= MAX_UPLOAD_QUEUE:
+            return
+        self.upload_queue.append((piece_index, block_begin, block_length))
+        self.upload_queued()
 
-        request_message = '{}{}{}{}{}'.format(message_len, message_id, piece_index, block_begin, block_length)
-        self.outgoing_message_queue.put(request_message)
+    def handle_cancel_message(self, message):
+        try:
+            self.upload_queue.remove((message['index'], message['begin'], message['length']))
+        except ValueError:
+            # Already sent
+            pass
+
+    def upload_queued(self):
+        # Transports that only write when asked to override this to start draining the upload queue
+        pass
+
+    def upload_throttled(self, wait):
+        # Transports that only write when asked to override this to look at the upload queue again after wait seconds
+        pass
+
+    def next_upload(self):
+        # The PIECE message for the next queued REQUEST, or None when there is nothing to send or an upload limit is
+        # used up. Transports call this once their outgoing messages are sent, so blocks are only read from disk as
+        # fast as the peer takes them.
+        if not self.upload_queue or self.am_choking:
+            return None
+        now = time.time()
+        if now < self.upload_resume_time:
+            return None
+        allowed, wait = RateLimiter.allowance(self.send_buckets, now)
+        if allowed is not None and allowed <= 0:
+            self.upload_resume_time = now + wait
+            self.upload_throttled(wait)
+            return None
+
+        while self.upload_queue and not self.am_choking:
+            try:
+                piece_index, block_begin, block_length = self.upload_queue.popleft()
+            except IndexError:
+                # Cleared by a CHOKE on another thread
+                break
+            try:
+                block = self.torrent.read_block(piece_index, block_begin, block_length)
+            except EnvironmentError as e:
+                self.log_message('Could not read piece {}: {}'.format(piece_index, e), 1)
+                continue
+            self.uploaded_bytes += block_length
+            RateLimiter.consume(self.send_buckets, block_length, now)
+            self.upload_meter.add(block_length, now)
+            self.torrent.block_uploaded(block_length)
+            return struct.pack('>IBII', 9 + block_length, PIECE, piece_index, block_begin) + block
+        return None
+
+    def snubbed(self, now=None):
+        if now is None:
+            now = time.time()
+        return not self.choked and bool(self.outstanding_requests) and now - self.last_block_time >= SNUB_TIME
+
+    def set_choking(self, choking):
+        # Called by the Choker to open or close this peer's upload slot
+        if choking == self.am_choking:
+            return
+        self.am_choking = choking
+        if choking:
+            # Without the fast extension choking discards every queued request
+            self.upload_queue.clear()
+        self.send_message(struct.pack('>IB', 1, CHOKE if choking else UNCHOKE))
+
+    def send_have(self, piece_index):
+        if not self.bitfield[piece_index]:
+            self.send_message(struct.pack('>IBI', 5, HAVE, piece_index))
+
+    def request_block(self, block_begin, block_length):
+        piece_index = self.assigned_piece.index
+        self.outstanding_requests[(piece_index, block_begin)] = (block_length, time.time(), self.assigned_piece)
+        request_message = struct.pack('>IBIII', 13, REQUEST, piece_index, block_begin, block_length)
+        self.send_message(request_message)
+
+    def fill_request_queue(self):
+        # Returns False if the queue could not be filled because every piece buffer is in use
+        while len(self.outstanding_requests) < self.request_queue_size:
+            # A connection killed from another thread may already have had its requests released by remove_peer
+            if not self.alive:
+                break
+            block_gap = self.find_block_gap()
+            if block_gap is None:
+                # Move on to another piece, leaving the requests already made for this one in flight
+                if not self.torrent.get_next_piece(self):
+                    return False
+                if self.assigned_piece is None:
+                    break
+                self.log_message("{} assigned piece {}".format(self.peer_ip, self.assigned_piece.index), 2)
+                block_gap = self.find_block_gap()
+                if block_gap is None or not self.alive:
+                    break
+            self.request_block(*block_gap)
+        return True
+
+    def expire_requests(self):
+        # Forget requests the peer has sat on for too long so their blocks are requested again. If the original
+        # block does eventually arrive it is treated as a duplicate.
+        now = time.time()
+        for request_key, request in self.outstanding_requests.items():
+            if now - request[1] > REQUEST_TIMEOUT:
+                self.release_request(*request_key)
+                self.request_queue_size = max(self.min_request_queue, self.request_queue_size / 2)
+
+    def update_requests(self):
+        if self.choked or not self.alive:
+            return
+
+        if self.assigned_piece is not None and self not in self.assigned_piece.assigned_peers:
+            self.drop_piece()
+
+        if not self.fill_request_queue():
+            # Every piece buffer is in use, wake_up is called once one is free
+            return
+
+        # If the connected peer does not have any of the pieces needed and wants nothing from us, close the connection
+        if self.assigned_piece is None and not self.outstanding_requests and not self.peer_interested:
+            self.log_message("No pieces left to download "
+                             "or peer {} does not have any pieces needed.".format(self.peer_ip), 1)
+            self.kill()
+
+
+class PeerConnection(PeerProtocol, threading.Thread):
+    """
+    Thread per connection transport: a socket thread reads and writes, a second thread handles messages.
+    """
+
+    def __init__(self, ip, port, torrent):
+        threading.Thread.__init__(self)
+        PeerProtocol.__init__(self, ip, port, torrent)
+        self.message_queue = Queue.Queue()
+        self.outgoing_message_queue = Queue.Queue()
+        # Unsent remainder of the message being written
+        self.send_buffer = None
+
+        self.start()
+
+    def run(self):
+        if self.connect():
+            self.do_handshake()
+            self.socket_read_loop()
+
+    def kill(self):
+        self.alive = False
+        if self.socket is not None:
+            self.socket.close()
+        self.message_queue.put({'MESSAGE_ID': INTERNAL_QUIT})
+        self.report_closed()
+
+    def connect(self):
+        self.log_message('Connecting to {}:{} ...'.format(self.peer_ip, self.peer_port), 2)
+        self.connect_start_time = time.time()
+        try:
+            self.socket = socket.create_connection((self.peer_ip, self.peer_port), CONNECT_TIMEOUT)
+        except (socket.error, socket.timeout) as e:
+            self.log_message("CONNECTION DONE GOOFED: {}".format(e), 1)
+            self.kill()
+            return False
+        self.socket.setblocking(0)
+        self.log_message('connection established...', 2)
+        self.alive = True
+        return True
+
+    def do_handshake(self):
+        self.socket.sendall(self.handshake_message())
+
+    def send_message(self, message):
+        self.outgoing_message_queue.put(message)
+
+    def wake_up(self):
+        self.message_queue.put({'MESSAGE_ID': INTERNAL_WAKE})
+
+    def dispatch_message(self, message):
+        self.message_queue.put(message)
 
     def message_worker(self):
         while True:
             try:
-                message = self.message_queue.get(5)
+                message = self.message_queue.get(timeout=5)
             except Queue.Empty:
                 message = None
+                with self.piece_lock:
+                    self.expire_requests()
 
             if message:
-                message_id = message['MESSAGE_ID']
-
-                if message_id == KEEP_ALIVE:
-                    self.log_message('Got Keep Alive from: {}'.format(repr(self.peer_id)), 2)
-                    keep_alive_message = '\x00\x00\x00\x00'
-                    self.outgoing_message_queue.put(keep_alive_message)
-                elif message_id == CHOKE:
-                    self.choked = True
-                elif message_id == UNCHOKE:
-                    self.choked = False
-                elif message_id == HAVE:
-                    self.bitfield[message['piece_index']] = 1
-                elif message_id == BITFIELD:
-                    self.handle_bitfield_message(message)
-                elif message_id == PIECE:
-                    self.handle_piece_message(message)
-                elif message_id == HANDSHAKE:
-                    self.handle_handshake_message(message)
-                elif message_id == INTERNAL_QUIT:
+                if message['MESSAGE_ID'] == INTERNAL_QUIT:
                     break
+                if message['MESSAGE_ID'] != INTERNAL_WAKE:
+                    self.handle_message(message)
 
-            if not self.choked:
-                if self.assigned_piece is None:
-                    self.torrent.get_next_piece(self)
-
-                    # If the connected peer does not have any of the pieces needed, close the connection
-                    if self.assigned_piece is None:
-                        self.log_message("No pieces left to download "
-                                         "or peer {} does not have any pieces needed.".format(self.peer_ip), 1)
-                        self.kill()
-                        break
-                    else:
-                        self.log_message("{} assigned piece {}".format(self.peer_ip, self.assigned_piece.index), 2)
-
-                self.request_block()
+            with self.piece_lock:
+                self.update_requests()
+            if not self.alive:
+                break
 
     def socket_read_loop(self):
-        data = BytesIO()
-        last_msg_time = time.time()
+        self.last_message_time = time.time()
         message_worker = threading.Thread(target=self.message_worker)
         message_worker.start()
 
         while self.alive:
+            read_size, throttle_wait = self.receive_allowance()
             try:
-                socket_received = self.socket.recv(4096)
+                socket_received = self.receive(read_size) if read_size else None
+                if socket_received == 0:
+                    self.log_message('Connection closed by {}'.format(self.peer_ip), 1)
+                    self.kill()
+                    break
             except socket.error as e:
                 error_number = e.args[0]
                 if error_number == errno.EWOULDBLOCK:
@@ -355,25 +706,41 @@ class PeerConnection(threading.Thread):
                     break
 
             if socket_received:
-                # Seek to end of data
-                data.read()
-                data.write(socket_received)
-                data.seek(0)
-                self.extract_messages(data)
-                data = BytesIO(data.read())
-                last_msg_time = time.time()
-
-            if not self.outgoing_message_queue.empty():
-                outgoing_message = self.outgoing_message_queue.get()
-                self.socket.sendall(outgoing_message)
-
-            if time.time() - last_msg_time >= 120:
+                self.extract_messages()
+
+            if self.send_buffer is None:
+                if not self.outgoing_message_queue.empty():
+                    self.send_buffer = memoryview(self.outgoing_message_queue.get())
+                elif self.upload_queue:
+                    upload_message = self.next_upload()
+                    if upload_message is not None:
+                        self.send_buffer = memoryview(upload_message)
+            if self.send_buffer is not None:
+                try:
+                    sent = self.socket.send(self.send_buffer)
+                except socket.error as e:
+                    if e.args[0] != errno.EWOULDBLOCK:
+                        self.log_message("WE HAD A PROBLEM: {}".format(e), 1)
+                        self.kill()
+                        break
+                    sent = 0
+                self.send_buffer = self.send_buffer[sent:] if sent < len(self.send_buffer) else None
+            elif throttle_wait and self.outgoing_message_queue.empty():
+                # Download limit used up and nothing to send, sleep off the wait instead of spinning
+                time.sleep(throttle_wait)
+
+            if time.time() - self.last_message_time >= CONNECTION_TIMEOUT:
                 self.log_message('Connection timed out', 1)
-                self.alive = False
+                self.kill()
+                break
+            if not self.received_handshake and time.time() - self.connect_start_time >= HANDSHAKE_TIMEOUT:
+                self.log_message('Handshake timed out', 1)
+                self.kill()
                 break
 
 
 if __name__ == '__main__':
+    import Torrent
     t = Torrent.Torrent(r"C:\Users\Andrew\Downloads\torrent stuff\ubuntu-16.10-desktop-amd64.iso.torrent",
                         r"C:\Users\Andrew\Downloads")
     t.start()
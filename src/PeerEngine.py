@@ -0,0 +1,457 @@
+import socket
+import select
+import errno
+import heapq
+import threading
+import time
+from collections import deque
+
+import PeerConnection
+
+READ = 1
+WRITE = 2
+
+# How often idle connections are checked for timeouts and expired requests
+TICK_INTERVAL = 5
+# Upper bound on how much queued outgoing data is joined into a single send
+SEND_SIZE = 2**16
+
+CONNECT_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, getattr(errno, 'WSAEWOULDBLOCK', -1))
+
+
+class Poller(object):
+    """
+    Socket readiness notification using epoll, poll or select, whichever the platform provides.
+    """
+
+    def __init__(self):
+        # epoll and poll objects share the same interface apart from the poll timeout units
+        if hasattr(select, 'epoll'):
+            self.native = select.epoll()
+            self.timeout_scale = 1
+        elif hasattr(select, 'poll'):
+            self.native = select.poll()
+            self.timeout_scale = 1000
+        else:
+            self.native = None
+            self.readers = set()
+            self.writers = set()
+
+    def register(self, fd, events):
+        if self.native is not None:
+            self.native.register(fd, self.to_native(events))
+        else:
+            self.modify(fd, events)
+
+    def modify(self, fd, events):
+        if self.native is not None:
+            self.native.modify(fd, self.to_native(events))
+        else:
+            for fd_set, event in [(self.readers, READ), (self.writers, WRITE)]:
+                if events & event:
+                    fd_set.add(fd)
+                else:
+                    fd_set.discard(fd)
+
+    def unregister(self, fd):
+        if self.native is not None:
+            self.native.unregister(fd)
+        else:
+            self.readers.discard(fd)
+            self.writers.discard(fd)
+
+    @staticmethod
+    def to_native(events):
+        # epoll and poll share flag values
+        native = 0
+        if events & READ:
+            native |= select.POLLIN
+        if events & WRITE:
+            native |= select.POLLOUT
+        return native
+
+    @staticmethod
+    def from_native(native):
+        # Errors and hang ups are reported as both readable and writable so the handler finds out on its next call
+        events = 0
+        if native & (select.POLLIN | select.POLLERR | select.POLLHUP):
+            events |= READ
+        if native & (select.POLLOUT | select.POLLERR | select.POLLHUP):
+            events |= WRITE
+        return events
+
+    def poll(self, timeout):
+        # Returns (fd, events) pairs. A timeout of None waits indefinitely.
+        if self.native is not None:
+            if timeout is None:
+                native_timeout = -1
+            else:
+                native_timeout = timeout * self.timeout_scale
+            return [(fd, self.from_native(native)) for fd, native in self.native.poll(native_timeout)]
+
+        readable, writable, errored = select.select(self.readers, self.writers, self.readers | self.writers, timeout)
+        events = {}
+        for fd in readable:
+            events[fd] = events.get(fd, 0) | READ
+        for fd in writable:
+            events[fd] = events.get(fd, 0) | WRITE
+        for fd in errored:
+            events[fd] = READ | WRITE
+        return events.items()
+
+
+def make_wakeup_pair():
+    # socket.socketpair is not available everywhere, a loopback TCP connection is
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    writer = socket.create_connection(listener.getsockname())
+    reader, _ = listener.accept()
+    listener.close()
+    reader.setblocking(0)
+    writer.setblocking(0)
+    return reader, writer
+
+
+class PeerEngine(threading.Thread):
+    """
+    Single threaded event loop driving any number of EventPeerConnections. Everything except call_soon and stop must
+    be called from the engine thread.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='PeerEngine')
+        self.daemon = True
+        self.poller = Poller()
+        self.handlers = {}
+        self.connections = set()
+        self.timers = []
+        self.timer_sequence = 0
+        self.callbacks = deque()
+        self.callback_lock = threading.Lock()
+        self.running = False
+
+        self.wakeup_reader, self.wakeup_writer = make_wakeup_pair()
+        self.poller.register(self.wakeup_reader.fileno(), READ)
+
+    def in_engine_thread(self):
+        return threading.current_thread() is self
+
+    def call_soon(self, callback, *args):
+        # Thread safe: run callback on the engine thread
+        with self.callback_lock:
+            self.callbacks.append((callback, args))
+        if not self.in_engine_thread():
+            try:
+                self.wakeup_writer.send('\0')
+            except socket.error:
+                # The wake up socket is already full, the loop will wake regardless
+                pass
+
+    def call_later(self, delay, callback, *args):
+        self.timer_sequence += 1
+        heapq.heappush(self.timers, (time.time() + delay, self.timer_sequence, callback, args))
+
+    def add_connection(self, connection):
+        self.call_soon(self.open_connection, connection)
+
+    def open_connection(self, connection):
+        self.connections.add(connection)
+        connection.open()
+
+    def register(self, connection, events):
+        fd = connection.socket.fileno()
+        self.handlers[fd] = connection
+        self.poller.register(fd, events)
+
+    def modify(self, connection, events):
+        self.poller.modify(connection.socket.fileno(), events)
+
+    def unregister(self, connection):
+        self.connections.discard(connection)
+        fd = connection.socket.fileno()
+        if self.handlers.pop(fd, None) is not None:
+            self.poller.unregister(fd)
+
+    def stop(self):
+        self.call_soon(self.shutdown)
+
+    def shutdown(self):
+        self.running = False
+        for connection in list(self.connections):
+            connection.kill()
+
+    def tick(self):
+        for connection in list(self.connections):
+            connection.check_timeout()
+        self.call_later(TICK_INTERVAL, self.tick)
+
+    def run_callbacks(self):
+        with self.callback_lock:
+            callbacks = self.callbacks
+            self.callbacks = deque()
+        for callback, args in callbacks:
+            callback(*args)
+
+    def run_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self.timers)
+            callback(*args)
+
+    def dispatch(self, connection, events):
+        try:
+            if events & READ:
+                connection.handle_read()
+            if events & WRITE and connection.alive:
+                connection.handle_write()
+        except Exception as e:
+            connection.log_message('Connection to {} failed: {}'.format(connection.peer_ip, e), 1)
+            connection.kill()
+
+    def run(self):
+        self.running = True
+        self.call_later(TICK_INTERVAL, self.tick)
+        wakeup_fd = self.wakeup_reader.fileno()
+
+        while self.running:
+            if self.callbacks:
+                timeout = 0
+            elif self.timers:
+                timeout = max(0, self.timers[0][0] - time.time())
+            else:
+                timeout = None
+
+            for fd, events in self.poller.poll(timeout):
+                if fd == wakeup_fd:
+                    try:
+                        while self.wakeup_reader.recv(4096):
+                            pass
+                    except socket.error:
+                        pass
+                    continue
+                connection = self.handlers.get(fd)
+                if connection is not None:
+                    self.dispatch(connection, events)
+
+            self.run_timers()
+            self.run_callbacks()
+
+
+class EventPeerConnection(PeerConnection.PeerProtocol):
+    """
+    Non-blocking connection driven by a PeerEngine. Messages are handled on the engine thread as soon as they are
+    parsed. A connection the peer opened is passed in as accepted_socket along with the handshake already read from
+    it.
+    """
+
+    def __init__(self, ip, port, torrent, engine, accepted_socket=None, handshake=None):
+        PeerConnection.PeerProtocol.__init__(self, ip, port, torrent)
+        self.engine = engine
+        self.send_queue = deque()
+        self.connected = False
+        self.events = 0
+        # Reading is suspended while a download limit is used up
+        self.receive_throttled = False
+        self.incoming = accepted_socket is not None
+        self.accepted_socket = accepted_socket
+        self.accepted_handshake = handshake
+
+        engine.add_connection(self)
+
+    def open(self):
+        if self.incoming:
+            self.open_accepted()
+            return
+        self.log_message('Connecting to {}:{} ...'.format(self.peer_ip, self.peer_port), 2)
+        self.connect_start_time = time.time()
+        try:
+            family, socket_type, protocol, _, address = socket.getaddrinfo(self.peer_ip, self.peer_port, 0,
+                                                                          socket.SOCK_STREAM)[0]
+            self.socket = socket.socket(family, socket_type, protocol)
+            self.socket.setblocking(0)
+            error_number = self.socket.connect_ex(address)
+        except socket.error as e:
+            self.log_message("CONNECTION DONE GOOFED: {}".format(e), 1)
+            self.kill()
+            return
+
+        if error_number and error_number not in CONNECT_IN_PROGRESS:
+            self.log_message("CONNECTION DONE GOOFED: {}".format(errno.errorcode.get(error_number, error_number)), 1)
+            self.kill()
+            return
+
+        self.events = WRITE
+        self.engine.register(self, self.events)
+        self.engine.call_later(PeerConnection.CONNECT_TIMEOUT, self.check_connect_timeout)
+        self.engine.call_later(PeerConnection.HANDSHAKE_TIMEOUT, self.check_handshake_timeout)
+
+    def open_accepted(self):
+        self.socket = self.accepted_socket
+        self.accepted_socket = None
+        if not self.alive:
+            # Killed before the engine got to it
+            self.socket.close()
+            return
+        self.socket.setblocking(0)
+        self.connected = True
+        # Answer with our handshake, then handle theirs as if it had just been read
+        self.send_queue.append(self.handshake_message())
+        self.receive_buffer[0:len(self.accepted_handshake)] = self.accepted_handshake
+        self.receive_end = len(self.accepted_handshake)
+        self.accepted_handshake = None
+        self.events = READ | WRITE
+        self.engine.register(self, self.events)
+        try:
+            self.extract_messages()
+        except Exception as e:
+            self.log_message('Connection from {} failed: {}'.format(self.peer_ip, e), 1)
+            self.kill()
+
+    def update_events(self):
+        events = READ if self.connected and not self.receive_throttled else 0
+        if (self.send_queue or not self.connected or
+                (self.upload_queue and not self.am_choking and time.time() >= self.upload_resume_time)):
+            events |= WRITE
+        if events != self.events:
+            self.events = events
+            self.engine.modify(self, events)
+
+    def kill(self):
+        if not self.engine.in_engine_thread():
+            self.engine.call_soon(self.kill)
+            return
+        if self.socket is not None and self.alive:
+            self.engine.unregister(self)
+            self.socket.close()
+        self.engine.connections.discard(self)
+        self.alive = False
+        self.report_closed()
+
+    def send_message(self, message):
+        if not self.engine.in_engine_thread():
+            # HAVE and CHOKE messages come from the torrent's other threads
+            self.engine.call_soon(self.send_message, message)
+            return
+        self.send_queue.append(message)
+        if self.connected and self.alive and not self.events & WRITE:
+            self.update_events()
+
+    def upload_queued(self):
+        if self.connected and not self.events & WRITE:
+            self.update_events()
+
+    def upload_throttled(self, wait):
+        self.engine.call_later(wait, self.resume_upload)
+
+    def resume_upload(self):
+        if self.alive:
+            self.update_events()
+
+    def resume_receive(self):
+        # Read straight away rather than waiting for the next poll. Timers run in the order they were set, so
+        # connections held back by a shared limit take turns in the order they were throttled.
+        self.receive_throttled = False
+        if self.alive:
+            self.engine.dispatch(self, READ)
+        if self.alive:
+            self.update_events()
+
+    def dispatch_message(self, message):
+        self.handle_message(message)
+        with self.piece_lock:
+            self.update_requests()
+
+    def wake_up(self):
+        self.engine.call_soon(self.resume_requests)
+
+    def resume_requests(self):
+        with self.piece_lock:
+            self.update_requests()
+
+    def check_connect_timeout(self):
+        if self.alive and not self.connected:
+            self.log_message('Connect timed out', 1)
+            self.kill()
+
+    def check_handshake_timeout(self):
+        if self.alive and not self.received_handshake:
+            self.log_message('Handshake timed out', 1)
+            self.kill()
+
+    def check_timeout(self):
+        if time.time() - self.last_message_time >= PeerConnection.CONNECTION_TIMEOUT:
+            self.log_message('Connection timed out', 1)
+            self.kill()
+            return
+        with self.piece_lock:
+            self.expire_requests()
+
+    def handle_connected(self):
+        error_number = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error_number:
+            self.log_message("CONNECTION DONE GOOFED: {}".format(errno.errorcode.get(error_number, error_number)), 1)
+            self.kill()
+            return False
+        self.log_message('connection established...', 2)
+        self.connected = True
+        self.send_queue.appendleft(self.handshake_message())
+        return True
+
+    def handle_write(self):
+        if not self.connected and not self.handle_connected():
+            return
+
+        while self.send_queue or self.queue_upload():
+            if len(self.send_queue) > 1 and len(self.send_queue[0]) < SEND_SIZE:
+                # Coalesce small messages such as REQUESTs into one send
+                chunk = []
+                chunk_size = 0
+                while self.send_queue and chunk_size < SEND_SIZE:
+                    message = self.send_queue.popleft()
+                    chunk.append(message)
+                    chunk_size += len(message)
+                self.send_queue.appendleft(''.join(chunk))
+
+            data = self.send_queue[0]
+            try:
+                sent = self.socket.send(data)
+            except socket.error as e:
+                if e.args[0] == errno.EWOULDBLOCK:
+                    break
+                raise
+            if sent < len(data):
+                self.send_queue[0] = memoryview(data)[sent:].tobytes()
+                break
+            self.send_queue.popleft()
+
+        self.update_events()
+
+    def queue_upload(self):
+        upload_message = self.next_upload()
+        if upload_message is None:
+            return False
+        self.send_queue.append(upload_message)
+        return True
+
+    def handle_read(self):
+        if not self.connected:
+            # A failed connect shows up as readable, let the write path report it
+            return
+        read_size, wait = self.receive_allowance()
+        if not read_size:
+            self.receive_throttled = True
+            self.update_events()
+            self.engine.call_later(wait, self.resume_receive)
+            return
+        try:
+            received = self.receive(read_size)
+        except socket.error as e:
+            if e.args[0] == errno.EWOULDBLOCK:
+                return
+            raise
+        if not received:
+            self.log_message('Connection closed by {}'.format(self.peer_ip), 1)
+            self.kill()
+            return
+        self.extract_messages()
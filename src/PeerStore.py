@@ -0,0 +1,166 @@
+import time
+import heapq
+import socket
+import struct
+import threading
+
+# A peer whose connection failed is retried after PEER_RETRY_DELAY * 2**(failures - 1) seconds, at most
+# MAX_PEER_RETRY_DELAY, so a peer that was down for a while is tried again once it is back. Peers that disconnect after
+# a handshake wait PEER_RETRY_DELAY.
+PEER_RETRY_DELAY = 60
+MAX_PEER_RETRY_DELAY = 16 * 60
+
+SOURCE_MANUAL = 'manual'
+
+# Peers never connected to score as if they had a one second handshake, ahead of peers known to be slow and behind
+# ones known to be fast
+UNTRIED_SCORE = 5.0
+# Weight of the newest sample in the handshake latency and throughput averages
+SCORE_SMOOTHING = 0.5
+
+
+def decode_compact(data):
+    # [(ip, port)] from a compact IPv4 peer string, six bytes per peer. One unpack call covers the whole string.
+    if len(data) % 6 != 0:
+        raise ValueError('Unexpected peer byte length')
+    fields = struct.unpack('>' + '4sH' * (len(data) // 6), data)
+    return zip(map(socket.inet_ntoa, fields[0::2]), fields[1::2])
+
+
+def format_ipv6(address_bytes):
+    if hasattr(socket, 'inet_ntop'):
+        return socket.inet_ntop(socket.AF_INET6, address_bytes)
+    return ':'.join('{:x}'.format(group) for group in struct.unpack('>8H', address_bytes))
+
+
+def decode_compact6(data):
+    # [(ip, port)] from a compact IPv6 peer string, eighteen bytes per peer
+    if len(data) % 18 != 0:
+        raise ValueError('Unexpected IPv6 peer byte length')
+    fields = struct.unpack('>' + '16sH' * (len(data) // 18), data)
+    return zip(map(format_ipv6, fields[0::2]), fields[1::2])
+
+
+class PeerInfo(object):
+    """
+    What is known about one (ip, port).
+    """
+
+    __slots__ = ('ip', 'port', 'source', 'first_seen', 'last_seen', 'failures', 'retry_time', 'connected',
+                 'handshake_latency', 'throughput')
+
+    def __init__(self, ip, port, source, now):
+        self.ip = ip
+        self.port = port
+        self.source = source
+        self.first_seen = now
+        self.last_seen = now
+        self.failures = 0
+        self.retry_time = 0
+        self.connected = False
+        # Smoothed seconds from dial to handshake, and bytes per second of piece data while connected
+        self.handshake_latency = None
+        self.throughput = None
+
+    @property
+    def key(self):
+        return self.ip, self.port
+
+    def score(self):
+        if self.handshake_latency is None and self.throughput is None:
+            score = UNTRIED_SCORE
+        else:
+            # Throughput in KiB/s dominates once known, a quick handshake is worth up to 10
+            score = (self.throughput or 0) / 1024.0
+            if self.handshake_latency is not None:
+                score += 10.0 / (1 + self.handshake_latency)
+        return score / (1 + self.failures)
+
+    def __repr__(self):
+        return '{}:{} ({}, {} failures)'.format(self.ip, self.port, self.source, self.failures)
+
+
+class PeerStore(object):
+    """
+    Every peer heard of for a torrent, keyed by (ip, port) so peers behind one address on different ports are kept
+    apart and repeats from other sources are merged in constant time.
+    """
+
+    def __init__(self):
+        self.peers = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.peers)
+
+    def __contains__(self, key):
+        return key in self.peers
+
+    def get(self, key):
+        return self.peers.get(key)
+
+    def add_peers(self, addresses, source):
+        # Merge an iterable of (ip, port). Returns the number of peers that were not known before.
+        now = time.time()
+        peers = self.peers
+        new_peers = 0
+        with self.lock:
+            for key in addresses:
+                peer = peers.get(key)
+                if peer is None:
+                    peers[key] = PeerInfo(key[0], key[1], source, now)
+                    new_peers += 1
+                else:
+                    peer.last_seen = now
+        return new_peers
+
+    def add_compact(self, data, source):
+        return self.add_peers(decode_compact(data), source)
+
+    def add_compact6(self, data, source):
+        return self.add_peers(decode_compact6(data), source)
+
+    def candidates(self, limit):
+        # The limit best scoring peers that are neither connected nor waiting out a failure
+        now = time.time()
+        with self.lock:
+            eligible = [peer for peer in self.peers.itervalues()
+                        if not peer.connected and peer.retry_time <= now]
+        return heapq.nlargest(limit, eligible, key=PeerInfo.score)
+
+    @staticmethod
+    def smooth(average, sample):
+        return sample if average is None else average + SCORE_SMOOTHING * (sample - average)
+
+    def record_handshake(self, key, latency):
+        with self.lock:
+            peer = self.peers[key]
+            peer.handshake_latency = self.smooth(peer.handshake_latency, latency)
+
+    def record_throughput(self, key, throughput):
+        with self.lock:
+            peer = self.peers[key]
+            peer.throughput = self.smooth(peer.throughput, throughput)
+
+    def next_retry_time(self):
+        # Earliest time a peer now waiting out a failure becomes a candidate again, or None
+        now = time.time()
+        with self.lock:
+            retry_times = [peer.retry_time for peer in self.peers.itervalues()
+                           if not peer.connected and peer.retry_time > now]
+        return min(retry_times) if retry_times else None
+
+    def mark_connected(self, key):
+        with self.lock:
+            self.peers[key].connected = True
+
+    def mark_disconnected(self, key, failed, retry_delay=PEER_RETRY_DELAY):
+        with self.lock:
+            peer = self.peers[key]
+            peer.connected = False
+            if failed:
+                peer.failures += 1
+                peer.retry_time = time.time() + min(MAX_PEER_RETRY_DELAY, PEER_RETRY_DELAY * 2 ** (peer.failures - 1))
+            else:
+                peer.failures = 0
+                peer.retry_time = time.time() + retry_delay
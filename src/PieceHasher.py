@@ -0,0 +1,74 @@
+import threading
+import Queue
+import multiprocessing
+
+DEBUG = True
+
+
+class HashPool(object):
+    """
+    Bounded pool of threads that finish SHA-1 hashes off the network threads. hashlib releases the GIL while hashing
+    large buffers, so throughput scales with the number of threads up to the number of cores. submit blocks once
+    max_pending jobs it queued are unfinished, pushing back on whoever is producing pieces; with block=False it never
+    waits, for callers such as the PeerEngine thread whose pending pieces are already bounded by their buffers.
+    """
+
+    def __init__(self, num_threads=None, max_pending=None):
+        self.num_threads = num_threads or multiprocessing.cpu_count()
+        self.jobs = Queue.Queue()
+        # Taken by each blocking submit and given back once its job is done
+        self.pending_slots = threading.Semaphore(max_pending or self.num_threads * 4)
+        self.threads = []
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        with self.start_lock:
+            while len(self.threads) < self.num_threads:
+                thread = threading.Thread(target=self.hash_worker, name='HashPool-{}'.format(len(self.threads)))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, hasher, chunks, callback, block=True):
+        # Feed each chunk to hasher on a pool thread, then call callback with the digest, or with None if hashing
+        # failed
+        if len(self.threads) < self.num_threads:
+            self.start()
+        if block:
+            self.pending_slots.acquire()
+        self.jobs.put((hasher, chunks, callback, block))
+
+    def stop(self):
+        threads = self.threads
+        self.threads = []
+        for _ in threads:
+            self.jobs.put(None)
+        for thread in threads:
+            thread.join()
+
+    def hash_worker(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            hasher, chunks, callback, holds_slot = job
+            try:
+                for chunk in chunks:
+                    hasher.update(chunk)
+                digest = hasher.digest()
+            except Exception as e:
+                self.log_msg('Hashing failed: {}'.format(e))
+                digest = None
+            try:
+                callback(digest)
+            except Exception as e:
+                # The worker outlives a failing callback, the pool is shared by every torrent
+                self.log_msg('Hash callback failed: {}'.format(e))
+            finally:
+                if holds_slot:
+                    self.pending_slots.release()
+
+    @staticmethod
+    def log_msg(message):
+        if DEBUG:
+            print message
@@ -0,0 +1,73 @@
+import array
+
+
+class PiecePicker(object):
+    """
+    Rarest first piece selection. Wanted pieces are kept in buckets keyed by the number of connected peers that own
+    them, so availability changes and picks never need to sort or scan the whole piece map. Callers are expected to
+    hold the torrent's piece_acquisition_lock.
+    """
+
+    def __init__(self, num_pieces):
+        self.availability = array.array('I', [0]) * num_pieces
+        # buckets[n] holds the indices of wanted pieces owned by exactly n peers
+        self.buckets = [set(range(num_pieces))]
+
+    def increment(self, piece_index):
+        count = self.availability[piece_index]
+        self.availability[piece_index] = count + 1
+        if count + 1 == len(self.buckets):
+            self.buckets.append(set())
+        if piece_index in self.buckets[count]:
+            self.remove_from_bucket(count, piece_index)
+            self.buckets[count + 1].add(piece_index)
+
+    def decrement(self, piece_index):
+        count = self.availability[piece_index]
+        if count == 0:
+            return
+        self.availability[piece_index] = count - 1
+        if piece_index in self.buckets[count]:
+            self.remove_from_bucket(count, piece_index)
+            self.buckets[count - 1].add(piece_index)
+
+    def remove_from_bucket(self, count, piece_index):
+        bucket = self.buckets[count]
+        bucket.remove(piece_index)
+        if not bucket:
+            # A set never shrinks its table, and walking an emptied one would cost as much as when it was full
+            self.buckets[count] = set()
+
+    def set_wanted(self, piece_index, wanted):
+        count = self.availability[piece_index]
+        if wanted:
+            self.buckets[count].add(piece_index)
+        elif piece_index in self.buckets[count]:
+            self.remove_from_bucket(count, piece_index)
+
+    def pieces_wanted(self):
+        return sum(len(bucket) for bucket in self.buckets)
+
+    def pieces_available(self):
+        # Wanted pieces that at least one connected peer owns
+        return sum(len(bucket) for bucket in self.buckets[1:])
+
+    def pick(self, bitfield):
+        # Return the rarest wanted piece present in the bitfield, or None if the peer has nothing we want. A peer that
+        # owns fewer pieces than are wanted and available is looked at piece by piece: O(pieces it owns) lookups,
+        # plus a regex pass over its bitfield bytes that skips empty bytes in C. Otherwise the buckets are walked from
+        # the rarest up, O(wanted pieces it lacks in the buckets before the first match), which for a peer owning most
+        # of the torrent ends after a few tests.
+        if bitfield.count < self.pieces_available():
+            availability = self.availability
+            rarest = None
+            for piece_index in bitfield.set_indices():
+                count = availability[piece_index]
+                if count and (rarest is None or count < availability[rarest]) and piece_index in self.buckets[count]:
+                    rarest = piece_index
+            return rarest
+        for bucket in self.buckets[1:]:
+            for piece_index in bucket:
+                if bitfield[piece_index]:
+                    return piece_index
+        return None
@@ -0,0 +1,184 @@
+import hashlib
+import threading
+
+import Bitfield
+
+# In endgame a block that has not arrived is requested from at most this many peers at once
+ENDGAME_BLOCK_REQUESTS = 2
+
+
+class Piece(object):
+    """
+    View of one entry in a PieceTable. Status and hash live in the table; the assigned peers, download buffer and block
+    state only exist while the piece is active. Block state belongs to the piece rather than to a connection, so
+    several peers can fetch different blocks of it at once and a peer that disconnects only gives back the blocks it
+    had in flight. The piece's lock guards everything the peers share.
+    """
+
+    NOT_FOUND = 1
+    WAITING = 2
+    ASSIGNED = 3
+    COMPLETE = 4
+
+    __slots__ = ('table', 'index', 'assigned_peers', 'buffer', 'lock', 'received_blocks', 'requested_blocks',
+                 'block_requests', 'block_cursor', 'hasher', 'hashed_blocks')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+        # Peers currently requesting blocks of this piece
+        self.assigned_peers = set()
+        # Checked out of the torrent's PieceBufferPool while the piece is being downloaded
+        self.buffer = None
+        self.lock = None
+        # One bit per block, set by whichever peer delivers the block first
+        self.received_blocks = None
+        # Blocks that are in flight from at least one peer or received, and the peers each in flight block was
+        # requested from
+        self.requested_blocks = None
+        self.block_requests = None
+        self.block_cursor = 0
+        # SHA-1 of the leading run of received blocks, advanced as blocks arrive
+        self.hasher = None
+        self.hashed_blocks = 0
+
+    def start_download(self, buffer, num_blocks):
+        self.buffer = buffer
+        self.lock = threading.Lock()
+        self.received_blocks = Bitfield.Bitfield(num_blocks)
+        self.requested_blocks = Bitfield.Bitfield(num_blocks)
+        self.block_requests = {}
+        self.block_cursor = 0
+        self.hasher = hashlib.sha1()
+        self.hashed_blocks = 0
+
+    def fully_requested(self):
+        return self.requested_blocks.complete()
+
+    def request_block(self, peer, endgame=False):
+        # Claim a block for peer to request and return its index, or None if there is nothing left. Normally only
+        # blocks nobody has requested are handed out; in endgame a block still missing may also be requested again
+        # from another peer.
+        with self.lock:
+            if endgame:
+                block_index = self.received_blocks.first_clear()
+                while block_index is not None:
+                    requesters = self.block_requests.get(block_index, ())
+                    if peer not in requesters and len(requesters) < ENDGAME_BLOCK_REQUESTS:
+                        break
+                    block_index = self.received_blocks.first_clear(block_index + 1)
+            else:
+                block_index = self.requested_blocks.first_clear(self.block_cursor)
+                self.block_cursor = len(self.requested_blocks) if block_index is None else block_index
+            if block_index is None:
+                return None
+            self.requested_blocks.set(block_index)
+            self.block_requests.setdefault(block_index, set()).add(peer)
+            return block_index
+
+    def release_block(self, peer, block_index):
+        # Give back a block peer will not deliver. Returns True if it can now be requested from another peer.
+        with self.lock:
+            requesters = self.block_requests.get(block_index)
+            if requesters is None or peer not in requesters:
+                return False
+            requesters.discard(peer)
+            if requesters:
+                return False
+            del self.block_requests[block_index]
+            if self.received_blocks[block_index]:
+                return False
+            self.requested_blocks.clear(block_index)
+            self.block_cursor = min(self.block_cursor, block_index)
+            return True
+
+    @property
+    def status(self):
+        return self.table.status[self.index]
+
+    @status.setter
+    def status(self, status):
+        self.table.status[self.index] = status
+
+    @property
+    def sha1_hash(self):
+        return self.table.get_hash(self.index)
+
+    @property
+    def owners(self):
+        # Number of connected peers that have the piece
+        return self.table.availability[self.index]
+
+    def remove_assigned_peer(self, peer):
+        # The piece stays ASSIGNED and keeps its blocks after its last peer leaves, until the torrent drops it
+        self.assigned_peers.discard(peer)
+
+    def unassign(self):
+        self.status = Piece.WAITING if self.owners else Piece.NOT_FOUND
+
+    def assign_peer(self, peer):
+        self.assigned_peers.add(peer)
+        self.status = Piece.ASSIGNED
+
+    def detach_peers(self):
+        # Forget every assigned peer once all blocks have arrived, returning them. The status stays ASSIGNED until the
+        # piece is written or fails its hash check.
+        peers = self.assigned_peers
+        self.assigned_peers = set()
+        return peers
+
+    def __str__(self):
+        return 'Piece Number: {}\nOwners: {}\nsha1: {}\npeers: {}\nbuffer: {}\nstatus: {}\n'.format(
+            self.index, self.owners, self.sha1_hash.tobytes().encode('hex'), self.assigned_peers, bool(self.buffer),
+            self.status)
+
+
+class PieceTable(object):
+    """
+    Per piece state for a whole torrent kept in flat arrays: one status byte per piece, hashes served as views of the
+    torrent's pieces string and owner counts shared with the PiecePicker. Piece objects are only kept for pieces in
+    flight; indexing any other piece returns a throwaway view.
+    """
+
+    def __init__(self, piece_hashes, availability):
+        self.hashes = memoryview(piece_hashes)
+        self.num_pieces = len(piece_hashes) // 20
+        self.status = bytearray([Piece.NOT_FOUND]) * self.num_pieces
+        self.availability = availability
+        self.active = {}
+
+    def __len__(self):
+        return self.num_pieces
+
+    def __getitem__(self, index):
+        piece = self.active.get(index)
+        if piece is None:
+            if not 0 <= index < self.num_pieces:
+                raise IndexError('Piece index out of range: {}'.format(index))
+            piece = Piece(self, index)
+        return piece
+
+    def __iter__(self):
+        for index in xrange(self.num_pieces):
+            yield self[index]
+
+    def get_hash(self, index):
+        return self.hashes[index * 20:index * 20 + 20]
+
+    def activate(self, index):
+        # The Piece that keeps the in flight state of index until it is deactivated
+        piece = self.active.get(index)
+        if piece is None:
+            piece = self.active[index] = Piece(self, index)
+        return piece
+
+    def deactivate(self, index):
+        self.active.pop(index, None)
+
+    def owner_added(self, index):
+        if self.status[index] == Piece.NOT_FOUND:
+            self.status[index] = Piece.WAITING
+
+    def owner_removed(self, index):
+        if self.availability[index] == 0 and self.status[index] == Piece.WAITING:
+            self.status[index] = Piece.NOT_FOUND
@@ -0,0 +1,92 @@
+import time
+import threading
+
+UNLIMITED = 0
+# Tokens a bucket can save up while idle, in seconds of its rate
+BURST_TIME = 1.0
+# Longest a throttled connection waits before looking at its buckets again, so changed limits take effect promptly
+MAX_THROTTLE_WAIT = 0.25
+
+
+class TokenBucket(object):
+    """
+    A bytes per second limit shared by every connection that draws on it. Tokens refill continuously, up to BURST_TIME
+    seconds worth. A draw may overdraw the bucket and later draws wait until the debt is repaid, so reads can be sized
+    before knowing how much will arrive and the long run rate still comes out exact. Thread safe. A bucket with a rate
+    of UNLIMITED is skipped without taking its lock.
+    """
+
+    def __init__(self, rate=UNLIMITED):
+        self.lock = threading.Lock()
+        self.rate = UNLIMITED
+        self.tokens = 0.0
+        self.update_time = time.time()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        # Bytes per second, or UNLIMITED. Safe to call while connections are drawing on the bucket.
+        with self.lock:
+            now = time.time()
+            if self.rate:
+                self.refill(now)
+                self.tokens = min(self.tokens, rate * BURST_TIME) if rate else 0.0
+            else:
+                # Newly limited, start with a full bucket
+                self.tokens = rate * BURST_TIME
+            self.update_time = now
+            self.rate = rate
+
+    def refill(self, now):
+        # Called with the lock held
+        self.tokens = min(self.tokens + (now - self.update_time) * self.rate, self.rate * BURST_TIME)
+        self.update_time = now
+
+    def available(self, now):
+        # Tokens on hand, negative while in debt
+        with self.lock:
+            self.refill(now)
+            return self.tokens
+
+    def consume(self, count, now):
+        with self.lock:
+            self.refill(now)
+            self.tokens -= count
+
+
+def allowance(buckets, now=None):
+    # (bytes, seconds): how many bytes every limited bucket allows, None when none of them is limited, and once that
+    # is used up how long to wait before asking again. Unlimited buckets cost one attribute read.
+    allowed = None
+    wait = 0.0
+    for bucket in buckets:
+        rate = bucket.rate
+        if rate:
+            if now is None:
+                now = time.time()
+            tokens = bucket.available(now)
+            if allowed is None or tokens < allowed:
+                allowed = tokens
+            if tokens <= 0:
+                wait = max(wait, (1 - tokens) / rate)
+    return allowed, min(wait, MAX_THROTTLE_WAIT)
+
+
+def consume(buckets, count, now=None):
+    for bucket in buckets:
+        if bucket.rate:
+            if now is None:
+                now = time.time()
+            bucket.consume(count, now)
+
+
+# Limits across every torrent
+download_bucket = TokenBucket()
+upload_bucket = TokenBucket()
+
+
+def set_global_limits(download=None, upload=None):
+    # Bytes per second or UNLIMITED, None leaves a limit as it is
+    if download is not None:
+        download_bucket.set_rate(download)
+    if upload is not None:
+        upload_bucket.set_rate(upload)
@@ -0,0 +1,48 @@
+import time
+import threading
+
+# Seconds of history a rate is measured over
+RATE_WINDOW = 20
+
+
+class RateMeter(object):
+    """
+    Rolling bytes per second over the last RATE_WINDOW seconds. Counts are kept in one second buckets, so adding costs
+    a few integer operations and reading a rate sums at most RATE_WINDOW numbers. Thread safe.
+    """
+
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.buckets = [0] * window
+        self.start_time = time.time()
+        self.current_second = int(self.start_time)
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def advance(self, second):
+        # Empty the buckets for the seconds that have passed since the last update
+        gap = second - self.current_second
+        if gap <= 0:
+            return
+        for offset in range(1, min(gap, self.window) + 1):
+            self.buckets[(self.current_second + offset) % self.window] = 0
+        self.current_second = second
+
+    def add(self, count, now=None):
+        if now is None:
+            now = time.time()
+        second = int(now)
+        with self.lock:
+            self.advance(second)
+            self.buckets[second % self.window] += count
+            self.total += count
+
+    def rate(self, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.advance(int(now))
+            count = sum(self.buckets)
+        # The current second is only partly over, and a new meter has not seen a whole window yet
+        elapsed = min(self.window - 1 + now % 1, now - self.start_time)
+        return count / max(elapsed, 1.0)
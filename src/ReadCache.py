@@ -0,0 +1,58 @@
+import threading
+from collections import OrderedDict
+
+# Bytes of piece data kept for serving REQUESTs
+READ_CACHE_SIZE = 64 * 2**20
+
+
+class ReadCache(object):
+    """
+    Least recently used cache of whole pieces read from storage for uploading. Peers request a piece's blocks one
+    after another, so a miss reads the entire piece and the requests for the rest of it are served from memory.
+    """
+
+    def __init__(self, storage, piece_length, total_size, capacity=READ_CACHE_SIZE):
+        self.storage = storage
+        self.piece_length = piece_length
+        self.total_size = total_size
+        self.capacity = capacity
+        self.pieces = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+
+    def read_block(self, piece_index, begin, length):
+        # The requested block of the piece, read into the cache first if need be. Raises IOError if the piece cannot
+        # be read.
+        with self.lock:
+            data = self.pieces.pop(piece_index, None)
+            if data is not None:
+                self.hits += 1
+                # Reinserting moves the piece to the most recently used end
+                self.pieces[piece_index] = data
+            else:
+                self.misses += 1
+
+        if data is None:
+            # Read outside the lock so hits for other pieces are not held up by the disk
+            offset = piece_index * self.piece_length
+            data = self.storage.read(offset, min(self.piece_length, self.total_size - offset))
+            with self.lock:
+                self.bytes_read += len(data)
+                if piece_index not in self.pieces:
+                    self.pieces[piece_index] = data
+                    self.size += len(data)
+                    while self.size > self.capacity and len(self.pieces) > 1:
+                        self.size -= len(self.pieces.popitem(last=False)[1])
+        return data[begin:begin + length]
+
+    def hit_rate(self):
+        requests = self.hits + self.misses
+        return self.hits / float(requests) if requests else 0.0
+
+    def clear(self):
+        with self.lock:
+            self.pieces.clear()
+            self.size = 0
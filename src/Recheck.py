@@ -0,0 +1,104 @@
+import os
+import mmap
+import hashlib
+import threading
+
+import PieceHasher
+
+# Files smaller than this are read instead of memory mapped
+MMAP_THRESHOLD = 2**20
+
+
+class Recheck(threading.Thread):
+    """
+    Verifies data already on disk against piece_hashes, the torrent's concatenated 20 byte SHA-1 hashes. Files are
+    memory mapped and each piece range, including ranges that span several files, is hashed on a HashPool.
+    verified_callback(piece_index) is called for every piece that matches and progress_callback(checked, num_pieces)
+    after every piece, both from pool threads.
+    """
+
+    def __init__(self, storage, piece_hashes, piece_length, total_size, verified_callback, progress_callback=None,
+                 finished_callback=None, num_threads=None):
+        threading.Thread.__init__(self, name='Recheck')
+        self.daemon = True
+        self.storage = storage
+        self.piece_hashes = piece_hashes
+        self.num_pieces = len(piece_hashes) // 20
+        self.piece_length = piece_length
+        self.total_size = total_size
+        self.verified_callback = verified_callback
+        self.progress_callback = progress_callback
+        self.finished_callback = finished_callback
+        self.hash_pool = PieceHasher.HashPool(num_threads)
+        self.cancel_event = threading.Event()
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.verified = 0
+        # Mapped or read file contents for the files around the piece being queued
+        self.file_data = {}
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def load_file(self, file_index):
+        # The file as an mmap or a string, or None if it cannot be read
+        if file_index not in self.file_data:
+            try:
+                with open(self.storage.file_path(file_index), 'rb') as data_file:
+                    if os.fstat(data_file.fileno()).st_size < MMAP_THRESHOLD:
+                        data = data_file.read()
+                    else:
+                        data = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except EnvironmentError:
+                data = None
+            self.file_data[file_index] = data
+        return self.file_data[file_index]
+
+    def run(self):
+        for piece_index in range(self.num_pieces):
+            if self.cancelled():
+                break
+            offset = piece_index * self.piece_length
+            chunks = []
+            for file_index, file_offset, span_length in self.storage.spans(offset,
+                                                                           min(self.piece_length,
+                                                                               self.total_size - offset)):
+                data = self.load_file(file_index)
+                if data is None:
+                    chunks = None
+                    break
+                # Short files give short chunks, which simply fail to verify
+                chunks.append(buffer(data, file_offset, span_length))
+
+            # Pieces are queued in order, so files before this piece are no longer needed. Queued chunks keep their
+            # own reference to the data until they have been hashed.
+            if chunks:
+                first_file = self.storage.spans(offset, 1).next()[0]
+                for file_index in [index for index in self.file_data if index < first_file]:
+                    del self.file_data[file_index]
+
+            if chunks is None:
+                self.piece_hashed(piece_index, None)
+            else:
+                self.hash_pool.submit(hashlib.sha1(), chunks,
+                                      lambda digest, piece_index=piece_index: self.piece_hashed(piece_index, digest))
+
+        # Waits for the queued pieces to finish
+        self.hash_pool.stop()
+        self.file_data = {}
+        if self.finished_callback is not None:
+            self.finished_callback()
+
+    def piece_hashed(self, piece_index, piece_hash):
+        if self.cancelled():
+            return
+        with self.lock:
+            self.checked += 1
+            if piece_hash == self.piece_hashes[piece_index * 20:piece_index * 20 + 20]:
+                self.verified += 1
+                self.verified_callback(piece_index)
+            if self.progress_callback is not None:
+                self.progress_callback(self.checked, self.num_pieces)
@@ -0,0 +1,65 @@
+import os
+import struct
+
+MAGIC = 'ACRS'
+VERSION = 1
+
+# magic, version, info hash, piece count, file count, uploaded, downloaded
+HEADER = struct.Struct('>4sB20sIIQQ')
+# size and mtime of each file, a size of -1 marks a file that did not exist
+FILE_STAT = struct.Struct('>qd')
+
+
+def file_stat(file_path):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return -1, 0.0
+    return stat.st_size, stat.st_mtime
+
+
+def save(resume_path, info_hash_bytes, num_pieces, completed_bytes, file_stats, uploaded, downloaded):
+    # Written to a temporary file and renamed over the old one so a crash never leaves a half written resume file
+    directory = os.path.dirname(resume_path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    temp_path = resume_path + '.tmp'
+    with open(temp_path, 'wb') as resume_file:
+        resume_file.write(HEADER.pack(MAGIC, VERSION, info_hash_bytes, num_pieces, len(file_stats), uploaded,
+                                      downloaded))
+        for size, mtime in file_stats:
+            resume_file.write(FILE_STAT.pack(size, mtime))
+        resume_file.write(completed_bytes)
+        resume_file.flush()
+        os.fsync(resume_file.fileno())
+
+    if os.name == 'nt' and os.path.exists(resume_path):
+        # rename does not replace an existing file on Windows
+        os.remove(resume_path)
+    os.rename(temp_path, resume_path)
+
+
+def load(resume_path):
+    # Returns a dict of the saved state, or None if there is no usable resume file
+    try:
+        with open(resume_path, 'rb') as resume_file:
+            data = resume_file.read()
+    except IOError:
+        return None
+
+    if len(data) < HEADER.size:
+        return None
+    magic, version, info_hash_bytes, num_pieces, num_files, uploaded, downloaded = HEADER.unpack_from(data)
+    bitfield_position = HEADER.size + num_files * FILE_STAT.size
+    if magic != MAGIC or version != VERSION or len(data) != bitfield_position + (num_pieces + 7) // 8:
+        return None
+
+    file_stats = [FILE_STAT.unpack_from(data, HEADER.size + file_index * FILE_STAT.size)
+                  for file_index in range(num_files)]
+    return {'info_hash_bytes': info_hash_bytes,
+            'num_pieces': num_pieces,
+            'file_stats': file_stats,
+            'uploaded': uploaded,
+            'downloaded': downloaded,
+            'completed': data[bitfield_position:]}
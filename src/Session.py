@@ -0,0 +1,266 @@
+import socket
+import errno
+import threading
+from collections import deque
+
+import PeerEngine
+import PieceHasher
+import BufferPool
+import WorkerPool
+import Torrent
+
+# Torrents downloading at once, the rest wait their turn in the order they were added. Complete torrents seed without
+# taking a slot.
+MAX_ACTIVE_TORRENTS = 8
+# Connections open at once across every torrent, dialled and incoming
+MAX_CONNECTIONS = 500
+LISTEN_PORT = 6881
+LISTEN_BACKLOG = 64
+# Threads writing pieces and announcing to trackers, shared by every torrent
+DISK_THREADS = 4
+ANNOUNCE_THREADS = 4
+# An incoming connection gets this many seconds to send a handshake naming one of our torrents
+INCOMING_HANDSHAKE_TIMEOUT = 10
+HANDSHAKE_LENGTH = 68
+
+DEBUG = True
+
+
+class Listener(object):
+    """
+    The session's listening socket, driven by its PeerEngine like a connection.
+    """
+
+    def __init__(self, session, port):
+        self.session = session
+        self.alive = True
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('', port))
+        self.socket.listen(LISTEN_BACKLOG)
+        self.socket.setblocking(0)
+        self.port = self.socket.getsockname()[1]
+
+    def handle_read(self):
+        while True:
+            try:
+                accepted_socket, address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] != errno.EWOULDBLOCK:
+                    self.log_message('Accept failed: {}'.format(e), 1)
+                return
+            self.session.accept(accepted_socket, address)
+
+    def handle_write(self):
+        pass
+
+    def log_message(self, message, level):
+        self.session.log_msg(message)
+
+    def kill(self):
+        if self.alive:
+            self.alive = False
+            self.session.engine.unregister(self)
+            self.socket.close()
+
+
+class IncomingHandshake(object):
+    """
+    An accepted connection waiting for the peer's handshake, which names the torrent the peer wants.
+    """
+
+    def __init__(self, session, accepted_socket, address):
+        self.session = session
+        self.socket = accepted_socket
+        self.address = address
+        self.alive = True
+        self.data = ''
+        self.socket.setblocking(0)
+        session.engine.register(self, PeerEngine.READ)
+        session.engine.call_later(INCOMING_HANDSHAKE_TIMEOUT, self.check_timeout)
+
+    def handle_read(self):
+        try:
+            # Only the handshake, anything after it is left for the connection that takes over the socket
+            data = self.socket.recv(HANDSHAKE_LENGTH - len(self.data))
+        except socket.error as e:
+            if e.args[0] == errno.EWOULDBLOCK:
+                return
+            raise
+        if not data:
+            self.kill()
+            return
+        self.data += data
+        if len(self.data) == HANDSHAKE_LENGTH:
+            self.alive = False
+            self.session.engine.unregister(self)
+            self.session.handshake_received(self)
+
+    def handle_write(self):
+        pass
+
+    def check_timeout(self):
+        if self.alive:
+            self.log_message('Handshake from {} timed out'.format(self.address[0]), 1)
+            self.kill()
+
+    def log_message(self, message, level):
+        self.session.log_msg(message)
+
+    def kill(self):
+        if self.alive:
+            self.alive = False
+            self.session.engine.unregister(self)
+            self.socket.close()
+            self.session.handshaking.discard(self)
+
+
+class Session(object):
+    """
+    Runs any number of torrents on shared resources: one PeerEngine for every connection and for each torrent's
+    connection manager and choker, one HashPool, one PieceBufferPool under a single memory ceiling, a WorkerPool for
+    disk writes and another for tracker announces, and a single listening port whose connections are handed to
+    torrents by the info hash in their handshake. Connections across all torrents stay within max_connections, and at
+    most max_active torrents download at once. Threads and idle CPU depend on the pool sizes rather than on the number
+    of torrents.
+    """
+
+    def __init__(self, port=LISTEN_PORT, max_active=MAX_ACTIVE_TORRENTS, max_connections=MAX_CONNECTIONS,
+                 disk_threads=DISK_THREADS, announce_threads=ANNOUNCE_THREADS,
+                 memory_limit=BufferPool.PIECE_MEMORY_LIMIT):
+        self.max_active = max_active
+        self.max_connections = max_connections
+        self.engine = PeerEngine.PeerEngine()
+        self.hash_pool = PieceHasher.HashPool()
+        self.buffer_pool = BufferPool.PieceBufferPool(memory_limit)
+        self.disk_pool = WorkerPool.WorkerPool(disk_threads, 'DiskPool')
+        self.announce_pool = WorkerPool.WorkerPool(announce_threads, 'AnnouncePool')
+        # Bound straight away so torrents announce the port actually in use
+        self.listener = Listener(self, port)
+        self.port = self.listener.port
+
+        self.lock = threading.Lock()
+        self.running = False
+        # Every torrent added, by info hash bytes, then those waiting for a download slot and those started
+        self.torrents = {}
+        self.queued = deque()
+        self.active = set()
+        # Engine thread only: accepted connections yet to handshake, and connection managers short of budget
+        self.handshaking = set()
+        self.budget_waiters = set()
+
+    def start(self):
+        self.running = True
+        self.engine.start()
+        self.disk_pool.start()
+        self.announce_pool.start()
+        self.engine.call_soon(self.engine.register, self.listener, PeerEngine.READ)
+        self.schedule()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            active = list(self.active)
+        for torrent in active:
+            torrent.stop()
+        self.engine.call_soon(self.listener.kill)
+        self.engine.stop()
+        self.disk_pool.stop()
+        self.announce_pool.stop()
+        self.hash_pool.stop()
+
+    def add_torrent(self, file_path, download_directory, **kwargs):
+        # Returns the new Torrent, which starts once a download slot is free
+        torrent = Torrent.Torrent(file_path, download_directory, session=self, **kwargs)
+        with self.lock:
+            self.torrents[torrent.info_hash_bytes] = torrent
+            self.queued.append(torrent)
+        self.schedule()
+        return torrent
+
+    def remove_torrent(self, torrent):
+        with self.lock:
+            self.torrents.pop(torrent.info_hash_bytes, None)
+            if torrent in self.queued:
+                self.queued.remove(torrent)
+            active = torrent in self.active
+        if active:
+            torrent.stop()
+
+    def schedule(self):
+        # Start queued torrents while download slots are free
+        started = []
+        with self.lock:
+            if not self.running:
+                return
+            downloading = len([torrent for torrent in self.active if not torrent.complete])
+            for torrent in list(self.queued):
+                if torrent.complete or downloading < self.max_active:
+                    self.queued.remove(torrent)
+                    self.active.add(torrent)
+                    started.append(torrent)
+                    if not torrent.complete:
+                        downloading += 1
+        for torrent in started:
+            self.log_msg('Starting {}'.format(torrent.name))
+            torrent.start()
+            self.announce_pool.submit(torrent, self.announce, torrent)
+
+    def torrent_completed(self, torrent):
+        # The torrent's download slot is free for the next one
+        self.schedule()
+
+    def torrent_stopped(self, torrent):
+        with self.lock:
+            self.active.discard(torrent)
+        self.schedule()
+
+    def announce(self, torrent):
+        # Runs on the announce pool, and comes back there when the next announce is due
+        if torrent not in self.active:
+            return
+        interval = torrent.announce()
+        self.engine.call_soon(self.engine.call_later, interval, self.announce_pool.submit, torrent, self.announce,
+                              torrent)
+
+    def connection_count(self):
+        return len(self.handshaking) + sum(len(torrent.connection_manager.connections)
+                                           for torrent in list(self.active))
+
+    def reserve_dials(self, connection_manager, dials):
+        # Engine thread. The number of dials out of those asked for that fit the connection budget. A manager left
+        # short is woken when a connection closes.
+        budget = self.max_connections - self.connection_count()
+        if budget < dials:
+            self.budget_waiters.add(connection_manager)
+        return max(0, min(dials, budget))
+
+    def connection_released(self):
+        # Engine thread
+        if self.budget_waiters:
+            budget_waiters = self.budget_waiters
+            self.budget_waiters = set()
+            for connection_manager in budget_waiters:
+                connection_manager.notify()
+
+    def accept(self, accepted_socket, address):
+        # Engine thread
+        if self.connection_count() >= self.max_connections:
+            accepted_socket.close()
+            return
+        self.handshaking.add(IncomingHandshake(self, accepted_socket, address))
+
+    def handshake_received(self, incoming):
+        # Engine thread. Bytes 28 to 48 of a handshake are the info hash.
+        self.handshaking.discard(incoming)
+        torrent = self.torrents.get(incoming.data[28:48])
+        if incoming.data[0] != chr(19) or torrent is None or torrent not in self.active or torrent.stopped:
+            self.log_msg('Closing incoming connection from {} for an unknown torrent'.format(incoming.address[0]))
+            incoming.socket.close()
+            return
+        torrent.accept_connection(incoming.socket, incoming.address, incoming.data)
+
+    @staticmethod
+    def log_msg(message):
+        if DEBUG:
+            print message
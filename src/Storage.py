@@ -0,0 +1,180 @@
+import os
+import bisect
+import errno
+import threading
+import Queue
+from collections import OrderedDict
+
+# Most file descriptors kept open at once, least recently used ones are closed first
+MAX_OPEN_FILES = 128
+
+OPEN_FLAGS = os.O_RDWR | getattr(os, 'O_BINARY', 0)
+
+# File allocation modes
+# Create missing files and extend short ones without writing any data, existing data is kept
+ALLOCATE_SPARSE = 'sparse'
+# Reserve every byte up front so files are laid out contiguously for later sequential reads
+ALLOCATE_FULL = 'full'
+# Leave existing files of the right size alone, anything else is created or resized to its exact length
+ALLOCATE_SKIP = 'skip'
+
+# Files allocated at once
+ALLOCATION_THREADS = 8
+# Zero fill chunk used when the platform has no fallocate
+FILL_SIZE = 2**20
+
+
+class Storage(object):
+    """
+    Maps byte ranges of a torrent onto the files that hold them. Files are found by bisecting a table of cumulative
+    file offsets and written through a small LRU cache of open file descriptors.
+    """
+
+    def __init__(self, download_directory, files, max_open_files=MAX_OPEN_FILES):
+        self.download_directory = download_directory
+        self.files = files
+        self.offsets = [dl_file['byte_position'] for dl_file in files]
+        self.max_open_files = max_open_files
+        self.handles = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Files that are ready for writing, writes to a file wait here until its allocation is done
+        self.allocated = set()
+        self.allocation_condition = threading.Condition()
+        self.allocation_error = None
+
+    def file_path(self, file_index):
+        return os.path.join(self.download_directory, self.files[file_index]['path'])
+
+    def spans(self, offset, length):
+        # Yields (file index, offset in file, length) for every file the range touches, in order
+        file_index = max(0, bisect.bisect_right(self.offsets, offset) - 1)
+        end = offset + length
+        while offset < end and file_index < len(self.files):
+            dl_file = self.files[file_index]
+            file_offset = offset - dl_file['byte_position']
+            span_length = min(end - offset, dl_file['length'] - file_offset)
+            if span_length > 0:
+                yield file_index, file_offset, span_length
+                offset += span_length
+            file_index += 1
+
+    def allocate(self, mode=ALLOCATE_SPARSE, num_threads=ALLOCATION_THREADS):
+        # Allocate every file on background threads and return immediately
+        if mode not in (ALLOCATE_SPARSE, ALLOCATE_FULL, ALLOCATE_SKIP):
+            raise ValueError('Unknown allocation mode: {}'.format(mode))
+        pending = Queue.Queue()
+        for file_index in range(len(self.files)):
+            pending.put(file_index)
+        for thread_number in range(min(num_threads, len(self.files))):
+            thread = threading.Thread(target=self.allocation_worker, args=(pending, mode),
+                                      name='Allocate-{}'.format(thread_number))
+            thread.daemon = True
+            thread.start()
+
+    def allocation_worker(self, pending, mode):
+        while True:
+            try:
+                file_index = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                self.allocate_file(file_index, mode)
+            except (IOError, OSError) as e:
+                with self.allocation_condition:
+                    self.allocation_error = e
+                    self.allocation_condition.notify_all()
+                return
+            with self.allocation_condition:
+                self.allocated.add(file_index)
+                self.allocation_condition.notify_all()
+
+    def allocate_file(self, file_index, mode):
+        file_path = self.file_path(file_index)
+        length = self.files[file_index]['length']
+        directory = os.path.dirname(file_path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                # Another allocation thread may have just made it
+                if e.errno != errno.EEXIST:
+                    raise
+
+        fd = os.open(file_path, OPEN_FLAGS | os.O_CREAT)
+        try:
+            size = os.fstat(fd).st_size
+            if size == length:
+                return
+            if mode == ALLOCATE_SKIP or size < length:
+                os.ftruncate(fd, length)
+            if mode == ALLOCATE_FULL and size < length:
+                self.reserve(fd, size, length - size)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def reserve(fd, offset, length):
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, offset, length)
+            return
+        # Writing zeros is the portable way to get real blocks behind the range
+        zeros = bytearray(min(FILL_SIZE, length))
+        os.lseek(fd, offset, os.SEEK_SET)
+        while length > 0:
+            length -= os.write(fd, memoryview(zeros)[:min(len(zeros), length)])
+
+    def wait_allocated(self, file_index):
+        with self.allocation_condition:
+            while file_index not in self.allocated:
+                if self.allocation_error is not None:
+                    raise IOError('File allocation failed: {}'.format(self.allocation_error))
+                self.allocation_condition.wait()
+
+    def get_handle(self, file_index):
+        fd = self.handles.pop(file_index, None)
+        if fd is None:
+            self.wait_allocated(file_index)
+            fd = os.open(self.file_path(file_index), OPEN_FLAGS)
+            while len(self.handles) >= self.max_open_files:
+                _, old_fd = self.handles.popitem(last=False)
+                os.close(old_fd)
+        # Reinserting moves the handle to the most recently used end
+        self.handles[file_index] = fd
+        return fd
+
+    def write(self, offset, data):
+        # Write data, which may be a memoryview into a piece buffer, starting at offset in the torrent
+        data = memoryview(data)
+        data_offset = 0
+        with self.lock:
+            for file_index, file_offset, span_length in self.spans(offset, len(data)):
+                fd = self.get_handle(file_index)
+                os.lseek(fd, file_offset, os.SEEK_SET)
+                span = data[data_offset:data_offset + span_length]
+                while span:
+                    span = span[os.write(fd, span):]
+                data_offset += span_length
+
+    def read(self, offset, length):
+        # Read length bytes starting at offset in the torrent. Raises IOError if the files hold less than that.
+        chunks = []
+        with self.lock:
+            for file_index, file_offset, span_length in self.spans(offset, length):
+                fd = self.get_handle(file_index)
+                os.lseek(fd, file_offset, os.SEEK_SET)
+                while span_length > 0:
+                    chunk = os.read(fd, span_length)
+                    if not chunk:
+                        raise IOError('Short read from {}'.format(self.file_path(file_index)))
+                    chunks.append(chunk)
+                    span_length -= len(chunk)
+        data = ''.join(chunks)
+        if len(data) != length:
+            raise IOError('Read past the end of the torrent at {}'.format(offset))
+        return data
+
+    def close(self):
+        with self.lock:
+            while self.handles:
+                os.close(self.handles.popitem()[1])
@@ -1,94 +1,139 @@
-import requests
-import bencode
-import struct
 import time
 import threading
 import os
 import random
 import string
-from io import BytesIO
 import Queue
 
 import TorrentReader
+import Tracker
+import PeerStore
+import ConnectionManager
+import Choker
 import PeerConnection
+import PeerEngine
+import PiecePicker
+import PieceHasher
+import BufferPool
+import Storage
+import ReadCache
+import RateMeter
+import RateLimiter
+import Bitfield
+import ResumeData
+import Recheck
+import PieceTable
+from PieceTable import Piece
 
 DEBUG = True
 
+# Peer connection implementations selectable per torrent
+THREADED_ENGINE = 'threaded'
+EVENT_ENGINE = 'event'
 
-class Piece(object):
+# Connection limit bounds, the ConnectionManager moves peer_limit between them as throughput allows
+PEER_LIMIT = 15
+MIN_PEER_LIMIT = 5
+MAX_PEER_LIMIT = 80
 
-    NOT_FOUND = 1
-    WAITING = 2
-    ASSIGNED = 3
-    COMPLETE = 4
+# Once every available piece is in flight, idle peers join pieces other peers are downloading, at most this many
+# peers to a piece. The first copy of each block wins and the other peers are sent a CANCEL.
+ENDGAME_PEERS_PER_PIECE = 4
 
-    def __init__(self, index, file_path, sha1_hash):
-        self.index = index
-        self.file_path = file_path
-        self.owners = set()
-        self.sha1_hash = sha1_hash
-        self.assigned_peers = set()
-        self.bytes = BytesIO()
-        self.status = Piece.NOT_FOUND
-
-    def add_owner(self, peer):
-        self.owners.add(peer)
-        if self.status == Piece.NOT_FOUND:
-            self.status = Piece.WAITING
-
-    def remove_owner(self, peer):
-        self.owners.discard(peer)
-        if len(self.owners) == 0:
-            self.status = Piece.NOT_FOUND
-
-    def remove_assigned_peer(self, peer):
-        self.assigned_peers.discard(peer)
-        if len(self.assigned_peers) == 0:
-            self.status = Piece.WAITING
-
-    def assign_peer(self, peer):
-        self.assigned_peers.add(peer)
-        self.status = Piece.ASSIGNED
-
-    def __str__(self):
-        return 'Piece Number: {}\nOwners: {}\nsha1: {}\npeers: {}\nbytes: {}\nstatus: {}\n'.format(self.index,
-                                                                                                   self.owners,
-                                                                                                   self.sha1_hash,
-                                                                                                   self.assigned_peers,
-                                                                                                   self.bytes,
-                                                                                                   self.status)
+# Seconds between resume file updates while pieces are being written
+RESUME_SAVE_INTERVAL = 30
+# Resume files are kept here, under the download directory, unless told otherwise
+RESUME_DIRECTORY = '.accipyter'
 
 
 class Torrent(object):
 
-    def __init__(self, file_path, download_directory):
+    def __init__(self, file_path, download_directory, engine=THREADED_ENGINE, memory_limit=None,
+                 allocation=Storage.ALLOCATE_SPARSE, resume_directory=None, seed=True, min_peer_limit=MIN_PEER_LIMIT,
+                 max_peer_limit=MAX_PEER_LIMIT, download_limit=RateLimiter.UNLIMITED,
+                 upload_limit=RateLimiter.UNLIMITED, peer_download_limit=RateLimiter.UNLIMITED,
+                 peer_upload_limit=RateLimiter.UNLIMITED, session=None):
         self.complete = False
+        # Torrents in a Session share its engine, pools and listening port instead of starting their own workers
+        self.session = session
+        # With seed the torrent keeps uploading to connected peers once complete, until stop is called
+        self.seed = seed
+        self.stopped = False
+        # Set by stop, cuts short the wait for the next announce
+        self.stop_event = threading.Event()
         self.finished_piece_queue = Queue.Queue()
-        self.available_peers = []
-        self.connected_peers = []
-        self.dead_peers = []
+        self.peer_store = PeerStore.PeerStore()
+        self.connection_manager = ConnectionManager.ConnectionManager(self)
+        self.choker = Choker.Choker(self)
         self.files = []
         self.download_directory = download_directory
         self.document, self.info_hash = TorrentReader.read_torrent(file_path)
         self.info = self.document[0]['info']
         self.port = 21
         self.uploaded = 0
+        self.upload_lock = threading.Lock()
+        # Rolling rates over every connection
+        self.download_meter = RateMeter.RateMeter()
+        self.upload_meter = RateMeter.RateMeter()
+        # Bytes per second limits for this torrent and for each of its connections. Every connection draws on its own
+        # buckets, then these, then the global ones.
+        self.download_bucket = RateLimiter.TokenBucket(download_limit)
+        self.upload_bucket = RateLimiter.TokenBucket(upload_limit)
+        self.download_buckets = (self.download_bucket, RateLimiter.download_bucket)
+        self.upload_buckets = (self.upload_bucket, RateLimiter.upload_bucket)
+        self.peer_download_limit = peer_download_limit
+        self.peer_upload_limit = peer_upload_limit
         self.downloaded = 0
-        self.peer_limit = 15
+        self.min_peer_limit = min_peer_limit
+        self.max_peer_limit = max_peer_limit
+        self.peer_limit = max(min_peer_limit, min(max_peer_limit, PEER_LIMIT))
         self.total_size = None
         self.name = self.info['name']
         self.piece_acquisition_lock = threading.Lock()
+        self.engine = engine
+        self.allocation = allocation
+        self.peer_engine = None
+        if session is not None:
+            self.engine = EVENT_ENGINE
+            self.peer_engine = session.engine
+            self.hash_pool = session.hash_pool
+            self.disk_pool = session.disk_pool
+            self.buffer_pool = session.buffer_pool
+            self.port = session.port
+        else:
+            self.hash_pool = PieceHasher.HashPool()
+            self.disk_pool = None
+            self.buffer_pool = BufferPool.shared_pool
+        if memory_limit is not None:
+            # A ceiling of its own instead of sharing one with the other torrents
+            self.buffer_pool = BufferPool.PieceBufferPool(memory_limit)
         self.read_info()
+        self.storage = Storage.Storage(download_directory, self.files)
+        self.read_cache = ReadCache.ReadCache(self.storage, self.info['piece length'], self.total_size)
+        self.trackers = Tracker.TrackerGroup(self.document[0])
 
         self.peer_id = '-AC0000-{}'.format(''.join(random.choice(string.ascii_uppercase +
                                                                  string.ascii_lowercase +
                                                                  string.digits) for _ in range(12)))
         self.info_hash_bytes = self.get_hash_bytes(self.info_hash)
-        piece_hashes = self.info['pieces']
-        piece_hashes = [piece_hashes[i:i+20] for i in range(0, len(piece_hashes), 20)]
         self.num_pieces = len(self.info['pieces']) / 20
-        self.piece_map = [Piece(piece_index, file_path, piece_hashes[piece_index])
-                          for piece_index in range(self.num_pieces)]
+        self.piece_picker = PiecePicker.PiecePicker(self.num_pieces)
+        self.piece_map = PieceTable.PieceTable(self.info['pieces'], self.piece_picker.availability)
+        # Active pieces that may still have blocks nobody has requested. Pieces that turn out to be fully requested or
+        # no longer active are dropped as they are found.
+        self.partial_pieces = set()
+
+        # Pieces written to disk
+        self.completed_pieces = Bitfield.Bitfield(self.num_pieces)
+        self.resume_path = os.path.join(resume_directory or os.path.join(download_directory, RESUME_DIRECTORY),
+                                        '{}.resume'.format(self.info_hash))
+        self.last_resume_save = time.time()
+        # The write thread and a Recheck may both save, and they share the temporary file
+        self.resume_lock = threading.Lock()
+        # Set once the final resume file is saved, pieces verified after that are dropped rather than written
+        self.writes_finished = False
+        self.file_write_thread = None
+        self.restore_resume_data()
 
     def read_info(self):
         # Read Files and Paths
@@ -117,231 +162,446 @@ class Torrent(object):
                                 'selected': True}
             self.files.append(single_file_dict)
 
+    def get_piece_length(self, piece_index):
+        # The final piece holds whatever is left over and is usually shorter than the rest
+        if piece_index == self.num_pieces - 1:
+            return self.total_size - piece_index * self.info['piece length']
+        return self.info['piece length']
+
+    def file_stats(self):
+        return [ResumeData.file_stat(self.storage.file_path(file_index)) for file_index in range(len(self.files))]
+
+    def save_resume_data(self):
+        with self.resume_lock:
+            self.last_resume_save = time.time()
+            ResumeData.save(self.resume_path, self.info_hash_bytes, self.num_pieces, self.completed_pieces.tobytes(),
+                            self.file_stats(), self.uploaded, self.downloaded)
+
+    def restore_resume_data(self):
+        # Trust the saved piece states only while every file still has the size and mtime it was saved with, anything
+        # else means the data may have changed underneath us
+        resume_data = ResumeData.load(self.resume_path)
+        if resume_data is None:
+            return
+        if (resume_data['info_hash_bytes'] != self.info_hash_bytes or resume_data['num_pieces'] != self.num_pieces or
+                resume_data['file_stats'] != self.file_stats()):
+            self.log_msg('Resume data for {} is out of date, ignoring it'.format(self.name))
+            return
+
+        for piece_index in self.completed_pieces.load(resume_data['completed']):
+            self.piece_map.status[piece_index] = Piece.COMPLETE
+            self.piece_picker.set_wanted(piece_index, False)
+        self.uploaded = resume_data['uploaded']
+        self.downloaded = resume_data['downloaded']
+        self.complete = self.completed_pieces.complete()
+        self.log_msg('Resumed {} with {}/{} pieces'.format(self.name, self.completed_pieces.count, self.num_pieces))
+
+    def recheck(self, progress_callback=None):
+        # Verify the data already on disk in the background, before start is called. Returns the running Recheck, which
+        # can be joined or cancelled.
+        recheck = Recheck.Recheck(self.storage, self.info['pieces'], self.info['piece length'], self.total_size,
+                                  self.piece_rechecked, progress_callback, self.save_resume_data)
+        recheck.start()
+        return recheck
+
+    def piece_rechecked(self, piece_index):
+        with self.piece_acquisition_lock:
+            self.piece_map.status[piece_index] = Piece.COMPLETE
+            self.piece_picker.set_wanted(piece_index, False)
+            self.completed_pieces.set(piece_index)
+            self.complete = self.completed_pieces.complete()
+
+    def bytes_left(self):
+        # Bytes of the pieces not on disk yet, whether the rest were downloaded, resumed or found by a recheck
+        completed_bytes = self.completed_pieces.count * self.info['piece length']
+        if self.completed_pieces[self.num_pieces - 1]:
+            completed_bytes -= self.info['piece length'] - self.get_piece_length(self.num_pieces - 1)
+        return self.total_size - completed_bytes
+
     def update_selected_files(self):
         pass
 
-    def update_available_peers(self, new_peers):
-        for new_peer in new_peers:
-            for old_peer in self.available_peers:
-                if old_peer['ip'] == new_peer['ip']:
-                    break
-            else:
-                self.available_peers.append(new_peer)
-
-    def aggregate_bitfields(self):
-        for piece in self.piece_map:
-            piece_owners = set()
-            for peer in self.connected_peers:
-                if peer.bitfield[piece.index] == 1:
-                    piece_owners.add(peer)
-            piece.owners = piece_owners
+    def update_available_peers(self, new_peers, source=PeerStore.SOURCE_MANUAL):
+        # new_peers is an iterable of (ip, port)
+        new_peer_count = self.peer_store.add_peers(new_peers, source)
+        if new_peer_count:
+            self.connection_manager.notify()
+        self.log_msg('Peer Update: {} new from {}, {} known'.format(new_peer_count, source, len(self.peer_store)))
+
+    def add_piece_owner(self, peer, piece_index):
+        self.piece_picker.increment(piece_index)
+        self.piece_map.owner_added(piece_index)
+
+    def register_bitfield(self, peer, bitfield_bytes):
+        with self.piece_acquisition_lock:
+            # A peer that has already been removed must not be counted again
+            if not peer.alive:
+                return
+            for piece_index in peer.bitfield.load(bitfield_bytes):
+                self.add_piece_owner(peer, piece_index)
+
+    def register_have(self, peer, piece_index):
+        if piece_index >= self.num_pieces:
+            return
+        with self.piece_acquisition_lock:
+            if peer.alive and peer.bitfield.set(piece_index):
+                self.add_piece_owner(peer, piece_index)
+
+    def remove_peer(self, peer):
+        # The peer's lock keeps a message still being handled from adding or storing requests while they are released
+        with peer.piece_lock, self.piece_acquisition_lock:
+            for piece_index in peer.bitfield.set_indices():
+                self.piece_picker.decrement(piece_index)
+                self.piece_map.owner_removed(piece_index)
+            peer.bitfield.reset()
+
+            self.buffer_pool.remove_waiter(peer.wake_up)
+            # Only the blocks the peer had in flight are given back, blocks it delivered stay with their pieces
+            for (piece_index, block_begin), request in peer.outstanding_requests.items():
+                if request[2].release_block(peer, block_begin / PeerConnection.MAX_BLOCK_LENGTH):
+                    self.partial_pieces.add(request[2])
+            peer.outstanding_requests.clear()
+            if peer.assigned_piece is not None:
+                peer.assigned_piece.remove_assigned_peer(peer)
+
+    def release_piece_buffer(self, piece):
+        # Return the piece's buffer to the pool, which wakes any peers that were waiting for one
+        if piece.buffer is None:
+            return
+        # Under the piece's lock, so a block being stored either lands before the buffer goes or sees it gone
+        with piece.lock:
+            buffer = piece.buffer
+            piece.buffer = None
+        self.buffer_pool.release(buffer)
 
     def get_next_piece(self, peer):
-        self.piece_acquisition_lock.acquire()
-
-        sorted_pieces = sorted(self.piece_map, key=lambda x: len(x.owners))
-        undownloaded_pieces = [piece for piece in sorted_pieces if piece.status == Piece.NOT_FOUND]
-        rarest_pieces = [piece for piece in undownloaded_pieces if peer.bitfield[piece.index] == 1]
-
-        if rarest_pieces:
-            rarest_piece = rarest_pieces[0]
-            rarest_piece.assign_peer(peer)
-            peer.assigned_piece = rarest_piece
-        else:
+        # Move the peer on from its assigned piece, preferring pieces other peers have started that still have blocks
+        # to request, then the rarest new piece, then in endgame a piece to duplicate requests on. Returns False
+        # without assigning anything when a new piece is needed but every piece buffer is in use, the peer is woken
+        # up once one is released.
+        with self.piece_acquisition_lock:
+            previous_piece = peer.assigned_piece
+            if previous_piece is not None:
+                previous_piece.remove_assigned_peer(peer)
             peer.assigned_piece = None
-
-        self.piece_acquisition_lock.release()
-
-    def peer_dispatch_worker(self):
-        while not self.complete:
-            # Remove dead connections
-            dead_peers = [peer for peer in self.connected_peers if peer.alive is False]
-            for peer in dead_peers:
-                self.dead_peers.append(peer.peer_ip)
-                self.log_msg('Removing dead peer: {}'.format(peer.peer_ip))
-                self.connected_peers.remove(peer)
-                if peer.assigned_piece:
-                    peer.assigned_piece.remove_owner(peer)
-
-            # Connect to new peers
-            # Check to see that there are pieces left to download, otherwise, no need to connect to new peers
-            pieces_left = len([piece for piece in self.piece_map if piece.status == Piece.NOT_FOUND])
-            if pieces_left:
-                connected_peer_ips = [peer.peer_ip for peer in self.connected_peers]
-                eligible_peers = [p for p in self.available_peers
-                                  if (p['ip'] not in connected_peer_ips) and p['ip'] not in self.dead_peers]
-                for peer in eligible_peers:
-                    if len(self.connected_peers) >= self.peer_limit or pieces_left == 0:
-                        break
-                    pieces_left -= 1
-                    self.connected_peers.append(PeerConnection.PeerConnection(peer['ip'], peer['port'], self))
+            peer.endgame = False
+
+            piece = self.get_partial_piece(peer, previous_piece)
+            if piece is None:
+                piece_index = self.piece_picker.pick(peer.bitfield)
+                if piece_index is not None:
+                    buffer = self.buffer_pool.checkout(self.info['piece length'], peer.wake_up)
+                    if buffer is None:
+                        return False
+                    piece = self.piece_map.activate(piece_index)
+                    piece.start_download(buffer, self.get_num_blocks(piece_index))
+                    self.piece_picker.set_wanted(piece_index, False)
+                    self.partial_pieces.add(piece)
+                elif not self.piece_picker.pieces_available():
+                    piece = self.get_endgame_piece(peer, previous_piece)
+                    peer.endgame = piece is not None
+
+            if piece is not None:
+                piece.assign_peer(peer)
+                peer.assigned_piece = piece
+        return True
+
+    def get_partial_piece(self, peer, previous_piece):
+        for piece in list(self.partial_pieces):
+            if piece.fully_requested() or self.piece_map.active.get(piece.index) is not piece:
+                self.partial_pieces.discard(piece)
+            elif piece is not previous_piece and peer.bitfield[piece.index]:
+                return piece
+        return None
+
+    def block_released(self, piece):
+        # A block of piece can be requested again, let other peers pick it up
+        with self.piece_acquisition_lock:
+            if piece in self.partial_pieces or self.piece_map.active.get(piece.index) is not piece:
+                return
+            self.partial_pieces.add(piece)
+        self.connection_manager.notify()
+
+    def pieces_wanted(self):
+        # Pieces a new connection could help with
+        return self.piece_picker.pieces_wanted() + len(self.partial_pieces)
+
+    def get_num_blocks(self, piece_index):
+        block_length = PeerConnection.MAX_BLOCK_LENGTH
+        return (self.get_piece_length(piece_index) + block_length - 1) / block_length
+
+    def get_endgame_piece(self, peer, previous_piece):
+        # The in flight piece the peer owns with the fewest peers on it and the most blocks still missing
+        candidates = [piece for piece in self.piece_map.active.itervalues()
+                      if len(piece.assigned_peers) < ENDGAME_PEERS_PER_PIECE and piece is not previous_piece
+                      and peer.bitfield[piece.index] and not piece.received_blocks.complete()]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda piece: (len(piece.assigned_peers),
+                                                  piece.received_blocks.count - len(piece.received_blocks)))
+
+    def piece_downloaded(self, peer, piece, hasher, hashed_length):
+        # Peers still requesting from the piece in endgame let go of it and look for another
+        with self.piece_acquisition_lock:
+            for partner in piece.detach_peers():
+                if partner is not peer:
+                    partner.wake_up()
+
+        # hasher already covers the first hashed_length bytes of the piece. Finish it inline when nothing is left,
+        # otherwise hand the remainder to the hash pool.
+        if hashed_length == self.get_piece_length(piece.index):
+            self.piece_verified(peer, piece, hasher.digest())
+        else:
+            piece_view = memoryview(piece.buffer)[hashed_length:self.get_piece_length(piece.index)]
+            # Called on a connection's thread, possibly the shared PeerEngine thread, so this must not wait for room
+            self.hash_pool.submit(hasher, [piece_view], lambda digest: self.piece_verified(peer, piece, digest),
+                                  block=False)
+
+    def piece_verified(self, peer, piece, piece_hash):
+        if piece_hash == piece.sha1_hash:
+            self.queue_write(piece)
+            return
+
+        expected_hash = repr(piece.sha1_hash.tobytes()).replace('\'', '')
+        actual_hash = repr(piece_hash).replace('\'', '')
+        self.log_msg('Hash mismatch on piece {} expected:{} got:{}'.format(piece.index, expected_hash, actual_hash))
+        self.piece_failed(piece)
+
+    def piece_failed(self, piece):
+        # Throw away a downloaded piece that could not be verified or written, so it is downloaded again
+        with self.piece_acquisition_lock:
+            piece.unassign()
+            self.partial_pieces.discard(piece)
+            self.piece_picker.set_wanted(piece.index, True)
+            self.release_piece_buffer(piece)
+            self.piece_map.deactivate(piece.index)
+        # The piece is wanted again and may need a new peer
+        self.connection_manager.notify()
+
+    def peer_interested(self, peer):
+        self.choker.notify()
+
+    def read_block(self, piece_index, block_begin, block_length):
+        return self.read_cache.read_block(piece_index, block_begin, block_length)
+
+    def block_uploaded(self, block_length):
+        with self.upload_lock:
+            self.uploaded += block_length
+        self.upload_meter.add(block_length)
+
+    def block_downloaded(self, block_length):
+        self.download_meter.add(block_length)
+
+    def set_rate_limits(self, download=None, upload=None, peer_download=None, peer_upload=None):
+        # Bytes per second or RateLimiter.UNLIMITED, None leaves a limit as it is. Open connections pick up the change
+        # within RateLimiter.MAX_THROTTLE_WAIT seconds.
+        if download is not None:
+            self.download_bucket.set_rate(download)
+        if upload is not None:
+            self.upload_bucket.set_rate(upload)
+        if peer_download is not None:
+            self.peer_download_limit = peer_download
+        if peer_upload is not None:
+            self.peer_upload_limit = peer_upload
+        if peer_download is not None or peer_upload is not None:
+            for connection in list(self.connection_manager.connections):
+                connection.download_bucket.set_rate(self.peer_download_limit)
+                connection.upload_bucket.set_rate(self.peer_upload_limit)
+
+    def download_rate(self):
+        return self.download_meter.rate()
+
+    def upload_rate(self):
+        return self.upload_meter.rate()
+
+    def peer_rates(self):
+        # [(ip, port, download rate, upload rate)] for every connected peer, in bytes per second
+        return [(peer.peer_ip, peer.peer_port, peer.download_meter.rate(), peer.upload_meter.rate())
+                for peer in list(self.connection_manager.established)]
+
+    def connection_closed(self, peer):
+        self.connection_manager.connection_closed(peer)
+
+    def connection_established(self, peer):
+        self.connection_manager.connection_established(peer)
+
+    def accept_connection(self, accepted_socket, address, handshake):
+        # Called by the Session on its engine thread with a connection whose handshake named this torrent
+        connection = PeerEngine.EventPeerConnection(address[0], address[1], self, self.peer_engine, accepted_socket,
+                                                    handshake)
+        self.connection_manager.add_incoming(connection)
+
+    def create_peer_connection(self, ip, port):
+        if self.peer_engine is not None:
+            return PeerEngine.EventPeerConnection(ip, port, self, self.peer_engine)
+        return PeerConnection.PeerConnection(ip, port, self)
+
+    def announce(self, event=None):
+        # Returns the number of seconds until the next announce is due
+        return self.trackers.announce(self.announce_params(), self.update_available_peers, event)
+
+    def announce_stopped(self):
+        self.announce('stopped')
+        self.trackers.close()
 
     def peer_request_worker(self):
-        interval = None
-
-        while not self.complete:
-            event = 'started' if interval is None else None
-            peer_data = self.request_peers(event=event)
-            interval = peer_data['interval']
-            self.update_available_peers(peer_data['peers'])
-            self.log_msg('Peer Update: {}'.format(self.available_peers))
-            time.sleep(interval)
+        while not self.stopped:
+            self.stop_event.wait(self.announce())
 
     def allocate_files(self):
-        for dl_file in self.files:
-            file_path = os.path.join(self.download_directory, dl_file['path'])
-            if not os.path.exists(os.path.dirname(file_path)):
-                os.makedirs(os.path.dirname(file_path))
-            with open(file_path, 'wb') as output_file:
-                output_file.seek(dl_file['length'] - 1)
-                output_file.write('\0')
-                output_file.close()
+        # Runs in the background, writing a piece waits only for the files that piece touches
+        self.storage.allocate(self.allocation)
+
+    def queue_write(self, piece):
+        if self.writes_finished:
+            # Verified after the torrent stopped, the writer may be gone
+            self.write_piece(piece)
+        elif self.disk_pool is not None:
+            # Jobs under one key run in order, so writes still follow allocate_files
+            self.disk_pool.submit(self, self.write_piece, piece)
+        else:
+            self.finished_piece_queue.put(piece)
 
     def write_piece(self, piece):
-        piece_size = self.info['piece length']
-        piece_byte_position = (piece.index * piece_size)
-        piece_end = piece_byte_position + piece_size
-
+        if self.writes_finished:
+            with self.piece_acquisition_lock:
+                self.release_piece_buffer(piece)
+                self.piece_map.deactivate(piece.index)
+            return
+        piece_view = memoryview(piece.buffer)[:self.get_piece_length(piece.index)]
+        try:
+            self.storage.write(piece.index * self.info['piece length'], piece_view)
+        except (IOError, OSError) as e:
+            self.log_msg('Writing piece {} failed: {}'.format(piece.index, e))
+            self.piece_failed(piece)
+            return
         # Mark the piece as complete
         piece.status = Piece.COMPLETE
 
-        # Find file/s the piece spans
-        if 'files' in self.info.keys():
-            piece_files = []
-            for dl_file in self.files:
-                dl_start = dl_file['byte_position']
-                dl_end = dl_start + dl_file['length']
-                total_range_width = min(dl_start, piece_byte_position) + max(dl_end, piece_end)
-                piece_and_file_width = dl_file['length'] + piece_size
-                if total_range_width <= piece_and_file_width:
-                    piece_files.append(dl_file)
-        else:
-            piece_files = self.files
-
-        for dl_file in piece_files:
-            file_path = os.path.join(self.download_directory, dl_file['path'])
-            with open(file_path, 'rb+') as f:
-                # Seek to offset in piece
-                piece_offset = max(0, dl_file['byte_position'] - piece_byte_position)
-                piece.bytes.seek(piece_offset)
+        # Hand the buffer back for the next piece
+        with self.piece_acquisition_lock:
+            self.release_piece_buffer(piece)
+            self.piece_map.deactivate(piece.index)
 
-                # Seek to offset in file
-                file_offset = 0
-                if piece_byte_position > dl_file['byte_position']:
-                    file_offset = piece_byte_position - dl_file['byte_position']
-                    f.seek(file_offset)
-
-                bytes_to_end_of_file = dl_file['length'] - file_offset
-
-                num_bytes_to_write = min(piece_size, dl_file['length'], bytes_to_end_of_file)
-                f.write(piece.bytes.read(num_bytes_to_write))
-
-        # Free the memory for the bytes that were just written
-        piece.bytes = BytesIO()
+        self.completed_pieces.set(piece.index)
+        self.downloaded += len(piece_view)
+        for peer in list(self.connection_manager.established):
+            peer.send_have(piece.index)
+        if time.time() - self.last_resume_save >= RESUME_SAVE_INTERVAL:
+            self.save_resume_data()
 
         # Check if all pieces have been written
-        num_pieces = len(self.piece_map)
-        num_complete_pieces = 0
-        for piece in self.piece_map:
-            if piece.status == Piece.COMPLETE:
-                num_complete_pieces += 1
+        num_pieces = self.num_pieces
+        num_complete_pieces = self.completed_pieces.count
 
         if num_pieces == num_complete_pieces:
             self.complete_torrent_transfer()
-            print "\n\n\n\n\n\n=============================================================================\nFINISHED"
-            print "=============================================================================\n\n\n\n\n\n\n"
+            self.log_msg('FINISHED {}'.format(self.name))
         else:
-            print "\n\n\n\n\n\n"
-            print "============================================================================="
-            print "||                 PERCENT COMPLETE: {}% ".format((float(num_complete_pieces)/num_pieces)*100)
-            print "=============================================================================\n\n\n\n\n\n\n"
+            self.log_msg('PERCENT COMPLETE: {}%'.format((float(num_complete_pieces)/num_pieces)*100))
 
     def complete_torrent_transfer(self):
         self.complete = True
         self.finished_piece_queue.put(None)
+        self.save_resume_data()
+        if self.session is not None:
+            # Jobs under one key run in order, so this follows any announce already running
+            self.session.announce_pool.submit(self, self.announce, 'completed')
+            self.session.torrent_completed(self)
+        else:
+            self.announce('completed')
+        if not self.seed:
+            self.stop()
+
+    def stop(self):
+        self.stopped = True
+        self.stop_event.set()
+        # Wakes the write thread, pieces queued before this are still written
+        self.finished_piece_queue.put(None)
+        self.connection_manager.stop()
+        self.choker.stop()
+        for thread in (self.connection_manager, self.choker):
+            if thread.is_alive() and thread is not threading.current_thread():
+                thread.join()
+        for peer in list(self.connection_manager.connections):
+            peer.kill()
+        self.read_cache.clear()
+        if self.session is not None:
+            # Jobs under one key run in order, so the resume file is saved after every write already queued, and
+            # trackers hear about the stop after any announce still running
+            self.disk_pool.submit(self, self.finish_writes)
+            self.session.announce_pool.submit(self, self.announce_stopped)
+            self.session.torrent_stopped(self)
+            return
+        # Trackers that know about us hear we are gone, waiting STOPPED_ROUND_TIMEOUT at most
+        self.announce_stopped()
+        if self.peer_engine is not None:
+            self.peer_engine.stop()
+            if self.peer_engine is not threading.current_thread():
+                self.peer_engine.join()
+        # The write thread saves the resume file itself once it reaches the None queued above
+        write_thread = self.file_write_thread
+        if write_thread is None or not write_thread.is_alive():
+            self.finish_writes()
+        elif write_thread is not threading.current_thread():
+            write_thread.join()
+
+    def finish_writes(self):
+        # Runs after the last piece write, so the file stats saved match the data on disk
+        self.writes_finished = True
+        self.save_resume_data()
+        self.storage.close()
+        # The buffer pool may be shared, pieces left unfinished give their buffers back to the other torrents. Pieces
+        # with every block received are being hashed or written, and write_piece releases those.
+        with self.piece_acquisition_lock:
+            for piece in self.piece_map.active.values():
+                if piece.buffer is not None and not piece.received_blocks.complete():
+                    self.release_piece_buffer(piece)
 
     def file_write_worker(self):
-        self.allocate_files()
+        # finish_writes runs however the writer ends, pieces verified after that release their buffers in queue_write
+        try:
+            self.allocate_files()
 
-        while True:
-            finished_piece = self.finished_piece_queue.get()
-            if finished_piece is None:
-                break
-            self.write_piece(finished_piece)
+            while True:
+                finished_piece = self.finished_piece_queue.get()
+                if finished_piece is None:
+                    break
+                self.write_piece(finished_piece)
+        finally:
+            self.finish_writes()
 
     def start(self):
+        if self.session is not None:
+            # The Session announces for us, and the connection manager and choker run on its engine
+            self.disk_pool.submit(self, self.allocate_files)
+            self.connection_manager.attach(self.peer_engine)
+            self.choker.attach(self.peer_engine)
+            return
+        if self.engine == EVENT_ENGINE:
+            self.peer_engine = PeerEngine.PeerEngine()
+            self.peer_engine.start()
         peer_request_thread = threading.Thread(target=self.peer_request_worker)
         peer_request_thread.start()
-        peer_dispatch_thread = threading.Thread(target=self.peer_dispatch_worker)
-        peer_dispatch_thread.start()
-        file_write_thread = threading.Thread(target=self.file_write_worker)
-        file_write_thread.start()
+        self.connection_manager.start()
+        self.choker.start()
+        self.file_write_thread = threading.Thread(target=self.file_write_worker)
+        self.file_write_thread.start()
 
     @staticmethod
     def log_msg(message):
         if DEBUG:
             print message
 
-    def tracker_request(self, event):
-        # Send request to tracker
-        data = {'info_hash': self.info_hash_bytes,
+    def announce_params(self):
+        return {'info_hash': self.info_hash_bytes,
                 'peer_id': self.peer_id,
                 'port': self.port,
                 'uploaded': self.uploaded,
                 'downloaded': self.downloaded,
-                'left': self.total_size - self.downloaded,
-                'compact': 1}
-
-        if event:
-            data['event'] = event
-
-        tracker_url = self.document[0]['announce']
-        self.log_msg('Tracker Request Data: {}'.format(data))
-        response = requests.get(url=tracker_url, params=data)
-        self.log_msg('Tracker Request URL: {}'.format(response.url))
-        self.log_msg('Tracker Response: {}'.format(response.content))
-        tracker_data = bencode.bdecode(response.content)
-        self.log_msg('Tracker Response Decoded: {}'.format(tracker_data))
-
-        if 'failure reason' in tracker_data.keys():
-            raise Exception('No Peers Found. Error: {}'.format(tracker_data['failure reason']))
-
-        return tracker_data
-
-    def request_peers(self, event=''):
-        peer_data = self.tracker_request(event=event)
-
-        # Read IPV4 peers
-        if 'peers' in peer_data:
-            peers = peer_data['peers']
-            peer_list = []
-            if len(peers) % 6 != 0:
-                raise Exception('Unexpected peer byte length')
-            while peers:
-                ip_addr_bytes = peers[:4]
-                port = peers[4:6]
-                peers = peers[6:]
-                ip_str = '.'.join([str(b) for b in bytearray(ip_addr_bytes)])
-                port_num = struct.unpack('>H', port)[0]
-                peer_list.append({'ip': ip_str,
-                                  'port': port_num})
-            peer_data['peers'] = peer_list
-
-        # Get ipv6 peers
-        for peer_dict in peer_data.get('peers6', []):
-            ipbytes = peer_dict['ip']
-            ipv6 = []
-            while True:
-                next_two = hex(struct.unpack('>H', ipbytes[0:2])[0]).replace('0x', '')
-                ipv6.append(next_two)
-                ipbytes = ipbytes[2:]
-                if not ipbytes:
-                    break
-            ipv6 = ':'.join(ipv6)
-            peer_dict['ip'] = ipv6
-
-        self.log_msg('Found Peers:{}'.format(peer_data))
-        return peer_data
+                'left': self.bytes_left(),
+                'compact': 1,
+                'numwant': Tracker.NUMWANT}
 
     @staticmethod
     def get_hash_bytes(hash_string):
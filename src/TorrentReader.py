@@ -1,164 +1,221 @@
-import struct
+import os
+import time
 import hashlib
-STRING = 0
-INT = 1
-LIST = 2
-DICTIONARY = 3
 
-info_dict_position = None
-info_dict_size = None
-
-
-def check_next_char(file):
-    next_char = file.read(1)
-    file.seek(file.tell()-1)
-    return next_char
-
-
-def read_number(file):
-    digits = ''
-    while True:
-        next_digit = file.read(1)
-        if next_digit.isdigit():
-            digits += next_digit
+import PieceHasher
+
+DIGITS = frozenset('0123456789')
+
+# Marks the end of a list or dictionary on the encoder's stack
+END = object()
+
+# Automatic piece lengths are powers of two in this range, aiming for about TARGET_PIECES pieces
+MIN_PIECE_LENGTH = 2**14
+MAX_PIECE_LENGTH = 2**24
+TARGET_PIECES = 1500
+
+
+def decode(data, start=0, info_spans=None):
+    """
+    Decode the bencoded value starting at data[start] and return (value, end). Containers are tracked on an explicit
+    stack so deeply nested documents do not hit the recursion limit. When info_spans is a list, the (start, end) span
+    of the value stored under a top level 'info' key is appended to it.
+    """
+    # Each stack frame is [container, dictionary key or None for lists, start of the value for that key]. Dictionary
+    # keys are read as soon as the previous value is stored, which saves a trip around the main loop for every key.
+    stack = []
+    position = start
+    index = data.index
+    try:
+        while True:
+            char = data[position]
+            if char in DIGITS:
+                colon = index(':', position)
+                end = colon + 1 + int(data[position:colon])
+                if end > len(data):
+                    raise ValueError('String runs past the end of the data at {}'.format(position))
+                value = data[colon + 1:end]
+                position = end
+            elif char == 'i':
+                end = index('e', position)
+                value = int(data[position + 1:end])
+                position = end + 1
+            elif char == 'l':
+                stack.append([[], None, None])
+                position += 1
+                continue
+            elif char == 'd':
+                position += 1
+                frame = [{}, None, None]
+                stack.append(frame)
+                if data[position] != 'e':
+                    colon = index(':', position)
+                    end = colon + 1 + int(data[position:colon])
+                    frame[1] = data[colon + 1:end]
+                    frame[2] = position = end
+                continue
+            elif char == 'e' and stack:
+                frame = stack.pop()
+                if frame[2] == position:
+                    raise ValueError('Dictionary key without a value at {}'.format(position))
+                value = frame[0]
+                position += 1
+            else:
+                raise ValueError('Unknown data type: {} at {}'.format(repr(char), position))
+
+            if not stack:
+                return value, position
+
+            frame = stack[-1]
+            key = frame[1]
+            if key is None:
+                frame[0].append(value)
+            else:
+                if info_spans is not None and key == 'info' and len(stack) == 1:
+                    info_spans.append((frame[2], position))
+                frame[0][key] = value
+                if data[position] != 'e':
+                    colon = index(':', position)
+                    end = colon + 1 + int(data[position:colon])
+                    frame[1] = data[colon + 1:end]
+                    frame[2] = position = end
+    except IndexError:
+        raise ValueError('Unexpected end of data')
+
+
+def encode(value):
+    # Bencode value. Like decode, nesting is handled with an explicit stack.
+    parts = []
+    append = parts.append
+    pending = [value]
+    while pending:
+        item = pending.pop()
+        item_type = type(item)
+        if item_type is unicode:
+            item = item.encode('utf-8')
+            item_type = str
+        if item_type is str:
+            append(str(len(item)))
+            append(':')
+            append(item)
+        elif item_type is int or item_type is long:
+            append('i{}e'.format(item))
+        elif item_type is list or item_type is tuple:
+            append('l')
+            pending.append(END)
+            pending.extend(reversed(item))
+        elif item_type is dict:
+            append('d')
+            pending.append(END)
+            # Keys must come out sorted, the stack reverses them
+            for key in sorted(item, reverse=True):
+                pending.append(item[key])
+                pending.append(key)
+        elif item is END:
+            append('e')
         else:
-            file.seek(file.tell()-1)
-            break
-
-    #print "get_data_size_and_delimiter detected size: {} with delimiter: {}".format(digits, repr(next_digit))
-
-    digits = int(digits)
-
-    return digits
-
-
-def get_next_list(file):
-    next_list = []
-    list_specifier = file.read(1)
-    while True:
-        data_type = get_next_datatype(file)
-        value = type_to_func[data_type](file)
-        next_list.append(value)
-        if check_next_char(file) == 'e':
-            file.read(1)
-            break
-
-    return next_list
-
-
-def get_next_string(file):
-    data_size = read_number(file)
-    delimiter = file.read(1)
-    if delimiter != ':':
-        raise (Exception("Unexpected delimiter: {}".format(delimiter)))
-    next_string = file.read(data_size)
-    return next_string
-
-
-def get_next_int(file):
-    int_specifier = file.read(1)
-    number = read_number(file)
-    end_specifier = file.read(1)
-    return number
-
-
-def get_next_dictionary(file):
-    global info_dict_position
-    global info_dict_size
-    next_dict = dict()
-    file.read(1)
-    while True:
-        key = get_next_string(file)
-        #print "Key: {} at: {}".format(repr(key),file.tell())
-        if key == 'info':
-            info_dict_position = file.tell()
-        data_type = get_next_datatype(file)
-        value = type_to_func[data_type](file)
-        if key == 'info':
-            info_dict_size = file.tell() - info_dict_position
-        #print "Key: {} ends at: {}".format(key,file.tell())
-        #print "key: {} value: {}".format(key,value)
-        next_dict[key] = value
-        if check_next_char(file) == 'e':
-            file.read(1)
-            break
-
-    return next_dict
-
-
-def get_next_datatype(file):
-    next_char = check_next_char(file)
-    if next_char == '':
-        data_type = None
-    elif next_char.isdigit():
-        data_type = STRING
-    elif next_char == 'l':
-        data_type = LIST
-    elif next_char == 'i':
-        data_type = INT
-    elif next_char == 'd':
-        data_type = DICTIONARY
-    else:
-        raise (Exception("Unknown data type: {}".format(repr(next_char))))
-
-    #print "Found datatype: {}".format(data_type)
-
-    return data_type
-
-type_to_func = {STRING: get_next_string,
-                LIST: get_next_list,
-                INT: get_next_int,
-                DICTIONARY: get_next_dictionary}
-
-
-def get_next_element(file):
-    while True:
-        data_type = get_next_datatype(file)
-        if data_type is None:
-            break
-        element = type_to_func[data_type](file)
-        yield element
+            raise TypeError('Cannot bencode {}'.format(repr(item)))
+    return ''.join(parts)
 
 
 def read_torrent(file_path):
-    document = []
-    info_hash = None
-
     with open(file_path, 'rb') as input_file:
-        document = [element for element in get_next_element(input_file)]
-        if info_dict_size and info_dict_position:
-            input_file.seek(info_dict_position)
-            info = input_file.read(info_dict_size)
-            hash_obj = hashlib.sha1(info)
-            info_hash = hash_obj.hexdigest()
-
-    return document, info_hash
-
-
-def get_peers(bytes):
-    peer_list = []
-    while True:
-        next_peer = bytes[:6]
-        if not next_peer:
-            break
-        bytes = bytes[6:]
-        ipa = struct.unpack("B",next_peer[0])[0]
-        ipb = struct.unpack("B",next_peer[1])[0]
-        ipc = struct.unpack("B",next_peer[2])[0]
-        ipd = struct.unpack("B",next_peer[3])[0]
-        ip = '{}.{}.{}.{}'.format(ipa,ipb,ipc,ipd)
-        port_bytes = next_peer[4:]
-        port = struct.unpack(">H",port_bytes)[0]
-        #print 'found: {}:{}'.format(ip,port)
-        peer_list.append((ip,port))
-    return peer_list
-
-
+        data = input_file.read()
 
+    document = []
+    info_spans = []
+    position = 0
+    while position < len(data):
+        element, position = decode(data, position, info_spans)
+        document.append(element)
 
-#print read_torrent(r"C:\Users\Andrew\Downloads\_idea.torrent")
+    info_hash = None
+    if info_spans:
+        info_start, info_end = info_spans[-1]
+        info_hash = hashlib.sha1(buffer(data, info_start, info_end - info_start)).hexdigest()
 
-import StringIO
-import socket
+    return document, info_hash
 
 
+def choose_piece_length(total_size):
+    piece_length = MIN_PIECE_LENGTH
+    while piece_length < MAX_PIECE_LENGTH and total_size // piece_length > TARGET_PIECES:
+        piece_length *= 2
+    return piece_length
+
+
+def list_source_files(source_path):
+    # (path, path elements relative to source_path, length) for every file, in a stable order
+    if os.path.isfile(source_path):
+        return [(source_path, [], os.path.getsize(source_path))]
+    source_files = []
+    for directory, directory_names, file_names in os.walk(source_path):
+        directory_names.sort()
+        relative_directory = os.path.relpath(directory, source_path)
+        path_elements = [] if relative_directory == os.curdir else relative_directory.split(os.sep)
+        for file_name in sorted(file_names):
+            file_path = os.path.join(directory, file_name)
+            source_files.append((file_path, path_elements + [file_name], os.path.getsize(file_path)))
+    return source_files
+
+
+def hash_pieces(file_paths, piece_length, num_threads=None):
+    # Read the files back to back as one stream, pieces that cross file boundaries included, and hash each piece on a
+    # HashPool. Returns the concatenated piece hashes.
+    digests = {}
+    pool = PieceHasher.HashPool(num_threads)
+    piece_chunks = []
+    piece_filled = 0
+    piece_index = 0
+    for file_path in file_paths:
+        with open(file_path, 'rb') as source_file:
+            while True:
+                chunk = source_file.read(piece_length - piece_filled)
+                if not chunk:
+                    break
+                piece_chunks.append(chunk)
+                piece_filled += len(chunk)
+                if piece_filled == piece_length:
+                    pool.submit(hashlib.sha1(), piece_chunks,
+                                lambda digest, piece_index=piece_index: digests.__setitem__(piece_index, digest))
+                    piece_chunks = []
+                    piece_filled = 0
+                    piece_index += 1
+    if piece_chunks:
+        pool.submit(hashlib.sha1(), piece_chunks,
+                    lambda digest, piece_index=piece_index: digests.__setitem__(piece_index, digest))
+        piece_index += 1
+    # Waits for every queued piece
+    pool.stop()
+    return ''.join(digests[index] for index in range(piece_index))
+
+
+def create_torrent(source_path, torrent_path, announce=None, announce_list=None, piece_length=None, comment=None,
+                   private=False, num_threads=None):
+    # Build a .torrent for a file or directory and write it to torrent_path. Returns the info hash.
+    source_path = os.path.abspath(source_path)
+    source_files = list_source_files(source_path)
+    total_size = sum(length for _, _, length in source_files)
+    piece_length = piece_length or choose_piece_length(total_size)
+
+    info = {'name': os.path.basename(source_path),
+            'piece length': piece_length,
+            'pieces': hash_pieces([file_path for file_path, _, _ in source_files], piece_length, num_threads)}
+    if os.path.isfile(source_path):
+        info['length'] = total_size
+    else:
+        info['files'] = [{'length': length, 'path': path_elements} for _, path_elements, length in source_files]
+    if private:
+        info['private'] = 1
+
+    metainfo = {'info': info, 'creation date': int(time.time()), 'created by': 'Accipyter'}
+    if announce:
+        metainfo['announce'] = announce
+    if announce_list:
+        metainfo['announce-list'] = announce_list
+    if comment:
+        metainfo['comment'] = comment
+
+    with open(torrent_path, 'wb') as torrent_file:
+        torrent_file.write(encode(metainfo))
+    return hashlib.sha1(encode(info)).hexdigest()
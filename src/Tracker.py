@@ -1,17 +1,408 @@
+import os
+import time
+import random
+import socket
+import struct
+import threading
+import urlparse
+
 import requests
 
+import TorrentReader
+import PeerStore
+import WorkerPool
+
+DEBUG = True
+
+# Seconds to wait on a single announce before treating the tracker as down
+ANNOUNCE_TIMEOUT = 10
+# Peers asked for in each announce
+NUMWANT = 200
+# Announce interval used when a tracker does not send one
+DEFAULT_INTERVAL = 1800
+# Retry delay after a tracker fails, doubling with every consecutive failure up to MAX_BACKOFF
+MIN_BACKOFF = 15
+MAX_BACKOFF = 3600
+# Connections kept open to each tracker host
+POOL_SIZE = 8
+# Longest an announce round waits for answers. Each request is cut off at the same deadline, HTTP ones within one socket
+# timeout of it, and a tracker still working after that hands over its peers when it answers while the caller, in a
+# Session a thread shared by every torrent, moves on.
+ANNOUNCE_ROUND_TIMEOUT = 20
+# The stopped announce is a courtesy, a stopping torrent waits this long at most for it
+STOPPED_ROUND_TIMEOUT = 5
+# Threads making tracker requests, shared by every torrent. Requests to one tracker run one at a time.
+TRACKER_THREADS = 8
+
+# UDP tracker protocol (BEP 15)
+UDP_PROTOCOL_ID = 0x41727101980
+UDP_CONNECT = 0
+UDP_ANNOUNCE = 1
+UDP_SCRAPE = 2
+UDP_ERROR = 3
+UDP_EVENTS = {None: 0, '': 0, 'completed': 1, 'started': 2, 'stopped': 3}
+# A connection ID may be reused for this long after the tracker hands it out
+UDP_CONNECTION_LIFETIME = 60
+# Request n waits UDP_TIMEOUT * 2**n seconds for an answer. BEP 15 allows up to 8 retransmits, fewer keep a dead tracker
+# from holding up its tier for the better part of an hour.
+UDP_TIMEOUT = 15
+UDP_RETRANSMITS = 3
+# Most info hashes that fit in one scrape packet
+UDP_SCRAPE_LIMIT = 74
+UDP_PACKET_SIZE = 2048
+
+UDP_HEADER = struct.Struct('>QII')
+UDP_RESPONSE_HEADER = struct.Struct('>II')
+UDP_ANNOUNCE_REQUEST = struct.Struct('>QII20s20sQQQIIIiH')
+UDP_ANNOUNCE_RESPONSE = struct.Struct('>IIIII')
+UDP_SCRAPE_ENTRY = struct.Struct('>III')
+
+
+class TrackerError(Exception):
+    pass
+
+
+def parse_peers(tracker_data):
+    # Returns [(ip, port)] from compact IPv4 and IPv6 peer strings or the original dictionary model
+    peers = tracker_data.get('peers', '')
+    try:
+        if isinstance(peers, str):
+            peer_list = PeerStore.decode_compact(peers)
+        else:
+            peer_list = [(peer['ip'], peer['port']) for peer in peers]
+        peer_list.extend(PeerStore.decode_compact6(tracker_data.get('peers6', '')))
+    except (ValueError, KeyError, TypeError) as e:
+        raise TrackerError('Bad peer list: {}'.format(e))
+    return peer_list
+
+
+class Tracker(object):
+    """
+    A single announce URL and its retry state.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.failures = 0
+        self.retry_time = 0
+        self.interval = DEFAULT_INTERVAL
+        self.started = False
+        self.tracker_id = None
+        # Set while an announce is in flight, which may outlast the round that started it
+        self.announcing = False
+
+    def ready(self, now, event=None):
+        # Completed and stopped are sent to every tracker that knows about us, whatever its interval
+        if event in ('completed', 'stopped') and self.started:
+            return not self.announcing
+        return not self.announcing and now >= self.retry_time
+
+    def healthy(self):
+        # Answered its last announce, so it is only waiting out its interval
+        return self.started and not self.failures
+
+    def announce(self, session, params, event, deadline=None):
+        params = dict(params)
+        # Every tracker needs to hear 'started' once, whichever one the torrent first reached
+        if not self.started:
+            event = 'started'
+        if event:
+            params['event'] = event
+        if self.tracker_id is not None:
+            params['trackerid'] = self.tracker_id
+
+        try:
+            response = session.get(self.url, params=params, timeout=request_timeout(ANNOUNCE_TIMEOUT, deadline))
+            tracker_data = TorrentReader.decode(response.content)[0]
+        except (requests.RequestException, ValueError, IndexError) as e:
+            raise TrackerError('Announce to {} failed: {}'.format(self.url, e))
+        if not isinstance(tracker_data, dict):
+            raise TrackerError('Announce to {} returned {}'.format(self.url, repr(tracker_data)))
+        if 'failure reason' in tracker_data:
+            raise TrackerError('Announce to {} failed: {}'.format(self.url, tracker_data['failure reason']))
+
+        self.announce_succeeded(tracker_data.get('interval', DEFAULT_INTERVAL))
+        self.tracker_id = tracker_data.get('tracker id', self.tracker_id)
+        return parse_peers(tracker_data)
+
+    def announce_succeeded(self, interval):
+        self.started = True
+        self.failures = 0
+        self.interval = interval
+        self.retry_time = time.time() + interval
+
+    def announce_failed(self):
+        self.failures += 1
+        self.retry_time = time.time() + min(MAX_BACKOFF, MIN_BACKOFF * 2 ** (self.failures - 1))
+
+    def scrape(self, session, info_hashes):
+        # Returns {info hash: (seeders, completed, leechers)} using the scrape URL convention
+        path_start = self.url.rfind('/') + 1
+        if not self.url.startswith('announce', path_start):
+            raise TrackerError('{} does not support scrape'.format(self.url))
+        scrape_url = self.url[:path_start] + 'scrape' + self.url[path_start + len('announce'):]
+        try:
+            response = session.get(scrape_url, params={'info_hash': list(info_hashes)}, timeout=ANNOUNCE_TIMEOUT)
+            files = TorrentReader.decode(response.content)[0]['files']
+        except (requests.RequestException, ValueError, IndexError, KeyError, TypeError) as e:
+            raise TrackerError('Scrape of {} failed: {}'.format(scrape_url, e))
+        return dict((info_hash, (stats.get('complete', 0), stats.get('downloaded', 0), stats.get('incomplete', 0)))
+                    for info_hash, stats in files.items())
+
+
+class UDPTracker(Tracker):
+    """
+    A udp:// announce URL. Connection IDs are shared between every UDPTracker talking to the same host, so torrents
+    announcing to one tracker only pay for the connect exchange once a minute.
+    """
+
+    connection_ids = {}
+    connection_lock = threading.Lock()
+
+    def __init__(self, url):
+        Tracker.__init__(self, url)
+        parsed_url = urlparse.urlparse(url)
+        self.address = (parsed_url.hostname, parsed_url.port)
+        self.key = struct.unpack('>I', os.urandom(4))[0]
+
+    def announce(self, session, params, event, deadline=None):
+        if not self.started:
+            event = 'started'
+        sock = self.open_socket()
+        try:
+            def build_announce(connection_id, transaction_id):
+                return UDP_ANNOUNCE_REQUEST.pack(connection_id, UDP_ANNOUNCE, transaction_id, params['info_hash'],
+                                                 params['peer_id'], params['downloaded'], params['left'],
+                                                 params['uploaded'], UDP_EVENTS[event], 0, self.key,
+                                                 params.get('numwant', -1), params['port'])
+            response = self.transact(sock, UDP_ANNOUNCE, build_announce, deadline)
+            if len(response) < UDP_ANNOUNCE_RESPONSE.size:
+                raise TrackerError('Short announce response from {}'.format(self.url))
+            interval = UDP_ANNOUNCE_RESPONSE.unpack_from(response)[2]
+            peers = response[UDP_ANNOUNCE_RESPONSE.size:]
+            compact_key = 'peers6' if sock.family == socket.AF_INET6 else 'peers'
+        finally:
+            sock.close()
+
+        self.announce_succeeded(interval or DEFAULT_INTERVAL)
+        return parse_peers({compact_key: peers})
+
+    def scrape(self, session, info_hashes):
+        info_hashes = list(info_hashes)
+        results = {}
+        sock = self.open_socket()
+        try:
+            for batch_start in range(0, len(info_hashes), UDP_SCRAPE_LIMIT):
+                batch = info_hashes[batch_start:batch_start + UDP_SCRAPE_LIMIT]
+
+                def build_scrape(connection_id, transaction_id):
+                    return UDP_HEADER.pack(connection_id, UDP_SCRAPE, transaction_id) + ''.join(batch)
+                response = self.transact(sock, UDP_SCRAPE, build_scrape)
+                for index, info_hash in enumerate(batch):
+                    offset = UDP_RESPONSE_HEADER.size + index * UDP_SCRAPE_ENTRY.size
+                    if offset + UDP_SCRAPE_ENTRY.size > len(response):
+                        break
+                    results[info_hash] = UDP_SCRAPE_ENTRY.unpack_from(response, offset)
+        finally:
+            sock.close()
+        return results
+
+    def open_socket(self):
+        if not self.address[0] or not self.address[1]:
+            raise TrackerError('Bad UDP tracker URL: {}'.format(self.url))
+        try:
+            family, socket_type, protocol, _, address = socket.getaddrinfo(self.address[0], self.address[1], 0,
+                                                                          socket.SOCK_DGRAM)[0]
+            sock = socket.socket(family, socket_type, protocol)
+            sock.connect(address)
+        except socket.error as e:
+            raise TrackerError('Cannot reach {}: {}'.format(self.url, e))
+        return sock
+
+    def transact(self, sock, action, build_request, deadline=None):
+        # Send the request built by build_request(connection_id, transaction_id), retransmitting on the BEP 15
+        # schedule until deadline, and return the response datagram. A fresh connection ID is fetched whenever the
+        # cached one is missing or stale.
+        for attempt in range(UDP_RETRANSMITS + 1):
+            timeout = request_timeout(UDP_TIMEOUT * 2 ** attempt, deadline)
+            if timeout <= 0:
+                break
+            connection_id = self.cached_connection_id()
+            if connection_id is None:
+                connection_id = self.connect(sock, timeout)
+                if connection_id is None:
+                    continue
+            transaction_id = struct.unpack('>I', os.urandom(4))[0]
+            response = self.exchange(sock, build_request(connection_id, transaction_id), action, transaction_id,
+                                     timeout)
+            if response is not None:
+                return response
+        raise TrackerError('No answer from {}'.format(self.url))
+
+    def connect(self, sock, timeout):
+        transaction_id = struct.unpack('>I', os.urandom(4))[0]
+        response = self.exchange(sock, UDP_HEADER.pack(UDP_PROTOCOL_ID, UDP_CONNECT, transaction_id), UDP_CONNECT,
+                                 transaction_id, timeout)
+        if response is None:
+            return None
+        if len(response) < 16:
+            raise TrackerError('Short connect response from {}'.format(self.url))
+        connection_id = struct.unpack_from('>Q', response, 8)[0]
+        with self.connection_lock:
+            self.connection_ids[self.address] = (connection_id, time.time() + UDP_CONNECTION_LIFETIME)
+        return connection_id
+
+    def cached_connection_id(self):
+        with self.connection_lock:
+            connection_id, expiry_time = self.connection_ids.get(self.address, (None, 0))
+        return connection_id if time.time() < expiry_time else None
+
+    def exchange(self, sock, request, action, transaction_id, timeout):
+        # One send and the matching response, or None on timeout. Datagrams for other transactions are ignored.
+        deadline = time.time() + timeout
+        try:
+            sock.send(request)
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                sock.settimeout(remaining)
+                response = sock.recv(UDP_PACKET_SIZE)
+                if len(response) < UDP_RESPONSE_HEADER.size:
+                    continue
+                response_action, response_transaction_id = UDP_RESPONSE_HEADER.unpack_from(response)
+                if response_transaction_id != transaction_id:
+                    continue
+                if response_action == UDP_ERROR:
+                    raise TrackerError('{} returned an error: {}'.format(self.url,
+                                                                          response[UDP_RESPONSE_HEADER.size:]))
+                if response_action == action:
+                    return response
+        except socket.timeout:
+            return None
+        except socket.error as e:
+            raise TrackerError('Announce to {} failed: {}'.format(self.url, e))
+
+
+def request_timeout(timeout, deadline):
+    # timeout, shortened to what is left before deadline if there is one
+    if deadline is None:
+        return timeout
+    return min(timeout, deadline - time.time())
+
+
+def make_tracker(url):
+    if url.startswith('udp://'):
+        return UDPTracker(url)
+    return Tracker(url)
+
+
+# Runs the requests of every TrackerGroup, keyed by tracker
+tracker_pool = WorkerPool.WorkerPool(TRACKER_THREADS, 'TrackerPool')
+
+
+class TrackerGroup(object):
+    """
+    Every tracker of a torrent, in announce-list tiers. Trackers within a tier are announced to concurrently on the
+    shared tracker_pool and their peers merged; later tiers are only tried when every tracker due in the earlier ones
+    failed or timed out, not while one of them is just waiting out its interval. All announces share one pooled HTTP
+    session.
+    """
+
+    def __init__(self, document):
+        if document.get('announce-list'):
+            self.tiers = [[make_tracker(url) for url in tier] for tier in document['announce-list'] if tier]
+            # Tiers are shuffled once so every client does not hammer the first tracker of each tier
+            for tier in self.tiers:
+                random.shuffle(tier)
+        else:
+            self.tiers = [[make_tracker(document['announce'])]]
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # Guards the answers of a round and is notified as each announce finishes
+        self.peers_lock = threading.Condition()
+        tracker_pool.start()
+
+    def announce(self, params, peers_callback, event=None):
+        # Announce to the first tier with a working tracker. peers_callback(peers, url) is called with each tracker's
+        # peers as soon as they arrive, so the fastest tracker decides how soon connections can start. Returns the
+        # number of seconds until the next announce is due, within ANNOUNCE_ROUND_TIMEOUT.
+        deadline = time.time() + (STOPPED_ROUND_TIMEOUT if event == 'stopped' else ANNOUNCE_ROUND_TIMEOUT)
+        for tier in self.tiers:
+            now = time.time()
+            if now >= deadline:
+                # The tiers left are tried next round
+                break
+            ready_trackers = [tracker for tracker in tier if tracker.ready(now, event)]
+            # A tracker that answered last time and is only waiting out its interval keeps the round in this tier
+            waiting = any(tracker.healthy() and not tracker.announcing and tracker not in ready_trackers
+                          for tracker in tier)
+            if not ready_trackers:
+                if waiting:
+                    return self.next_due(tier)
+                continue
+
+            answered = []
+            pending = [len(ready_trackers)]
+            for tracker in ready_trackers:
+                tracker.announcing = True
+                tracker_pool.submit(tracker, self.announce_worker, tracker, params, event, deadline, peers_callback,
+                                    answered, pending)
+            with self.peers_lock:
+                while pending[0] and time.time() < deadline:
+                    self.peers_lock.wait(deadline - time.time())
+                answered = list(answered)
+            if answered:
+                # Trackers that answered move to the front of their tier for next time
+                tier.sort(key=lambda tracker: tracker not in answered)
+                return min(tracker.interval for tracker in answered)
+            if waiting:
+                return self.next_due(tier)
+
+        # Nobody answered, try again once the first tracker that is not still announcing is due
+        return self.next_due([tracker for tier in self.tiers for tracker in tier])
+
+    @staticmethod
+    def next_due(trackers):
+        # Seconds until the first of trackers that is not still announcing is due
+        retry_times = [tracker.retry_time for tracker in trackers if not tracker.announcing]
+        if not retry_times:
+            return ANNOUNCE_ROUND_TIMEOUT
+        return max(1, min(retry_times) - time.time())
+
+    def announce_worker(self, tracker, params, event, deadline, peers_callback, answered, pending):
+        peers = None
+        try:
+            peers = tracker.announce(self.session, params, event, deadline)
+        except TrackerError as e:
+            self.log_msg(e)
+            tracker.announce_failed()
+        finally:
+            tracker.announcing = False
+            # The round stops waiting once every tracker has finished, however it finished
+            with self.peers_lock:
+                if peers is not None:
+                    answered.append(tracker)
+                    peers_callback(peers, tracker.url)
+                pending[0] -= 1
+                self.peers_lock.notify_all()
+
+    def scrape(self, info_hashes):
+        # Swarm statistics from the first tracker that answers, {info hash: (seeders, completed, leechers)}
+        for tier in self.tiers:
+            for tracker in tier:
+                try:
+                    return tracker.scrape(self.session, info_hashes)
+                except TrackerError as e:
+                    self.log_msg(e)
+        return {}
+
+    def close(self):
+        self.session.close()
 
-def get_peers(tracker_url, info_hash, peer_id, port, uploaded=0, downloaded=0, left=0, event='started'):
-    info_hash = requests.utils.quote(info_hash)
-
-    data = {'info_hash': info_hash,
-            'peer_id': peer_id,
-            'port': port,
-            'uploaded': uploaded,
-            'downloaded': downloaded,
-            'left': left,
-            'event': event,
-            'numwant': 100,
-            'no_peer_id': 1}
-    response = requests.get(url=tracker_url, data=data)
-    print response
\ No newline at end of file
+    @staticmethod
+    def log_msg(message):
+        if DEBUG:
+            print message
@@ -0,0 +1,91 @@
+import threading
+from collections import deque
+
+DEBUG = True
+
+
+class WorkerPool(object):
+    """
+    A fixed set of threads shared by every torrent. Jobs submitted under the same key run one at a time in the order
+    they were submitted, so a torrent's jobs keep the ordering they would have on a thread of their own, while jobs
+    for different keys run side by side. Keys with work waiting take turns, one job each, so a busy torrent cannot
+    hold up the rest.
+    """
+
+    def __init__(self, num_threads, name='WorkerPool'):
+        self.num_threads = num_threads
+        self.name = name
+        self.condition = threading.Condition()
+        # Pending jobs for each key, and the keys with jobs waiting that are not running one right now
+        self.jobs = {}
+        self.ready = deque()
+        self.running_keys = set()
+        self.threads = []
+        self.running = True
+
+    def start(self):
+        # Thread safe, and does nothing once the threads are running
+        with self.condition:
+            while len(self.threads) < self.num_threads:
+                thread = threading.Thread(target=self.worker, name='{}-{}'.format(self.name, len(self.threads)))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, key, func, *args):
+        # Thread safe: run func(*args) on a pool thread after every job submitted under key before it
+        with self.condition:
+            key_jobs = self.jobs.get(key)
+            if key_jobs is None:
+                key_jobs = self.jobs[key] = deque()
+                if key not in self.running_keys:
+                    self.ready.append(key)
+                    self.condition.notify()
+            key_jobs.append((func, args))
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def next_job(self):
+        # Called with the condition held
+        key = self.ready.popleft()
+        key_jobs = self.jobs[key]
+        job = key_jobs.popleft()
+        if not key_jobs:
+            del self.jobs[key]
+        self.running_keys.add(key)
+        return key, job
+
+    def job_done(self, key):
+        # Called with the condition held. A key with more work goes to the back of the line.
+        self.running_keys.discard(key)
+        if key in self.jobs:
+            self.ready.append(key)
+            self.condition.notify()
+
+    def worker(self):
+        while True:
+            with self.condition:
+                while self.running and not self.ready:
+                    self.condition.wait()
+                # Jobs submitted before stop still run, torrents queue their final resume save that way
+                if not self.ready:
+                    break
+                key, (func, args) = self.next_job()
+            try:
+                func(*args)
+            except Exception as e:
+                # Jobs handle the failures they expect, this only keeps the thread alive for the other keys
+                self.log_msg('{} job {} failed: {}'.format(self.name, getattr(func, '__name__', func), e))
+            with self.condition:
+                self.job_done(key)
+
+    @staticmethod
+    def log_msg(message):
+        if DEBUG:
+            print message